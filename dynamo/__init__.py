@@ -23,7 +23,10 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import atexit
 import os.path
+import sys
+import threading
 from os.path import join, dirname
 import subprocess
 import pwem
@@ -41,10 +44,13 @@ class Plugin(pwem.Plugin):
     _homeVar = DYNAMO_HOME
     _pathVars = [DYNAMO_HOME]
     _processingField = [TOMO]
+    _workerPools = {}
+    _workerPoolsLock = threading.Lock()
 
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(DYNAMO_HOME, 'dynamo-{}'.format(DEFAULT_VERSION))
+        cls._defineVar(DYNAMO_WORKERS, 0)
 
     @classmethod
     def getEnviron(cls, gpuId=0):
@@ -71,11 +77,49 @@ class Plugin(pwem.Plugin):
         return join(cls.getHome(), 'matlab', 'bin', DYNAMO_PROGRAM)
 
     @classmethod
-    def runDynamo(cls, protocol, args, cwd=None, gpuId=0):
-        """ Run Dynamo command from a given protocol. """
+    def getWorkerPool(cls, gpuId=0):
+        """ Pool of warm Dynamo sessions shared by the calls made from the current process. It is None unless
+        the variable DYNAMO_WORKERS sets the number of sessions to keep open. Its default, 0, starts a new Dynamo
+        session for each script, as the plugin has always done, and it is the safe choice: the pool sends the
+        scripts to the Dynamo console through its standard input (see worker_pool.genJobCmd), which is not the
+        documented way of running them in the standalone version (dynamo <script>.m)."""
+        nWorkers = int(cls.getVar(DYNAMO_WORKERS) or 0)
+        if nWorkers <= 0:
+            return None
+        with cls._workerPoolsLock:
+            pool = cls._workerPools.get(gpuId, None)
+            if pool is None:
+                from .worker_pool import DynamoWorkerPool
+                pool = DynamoWorkerPool(nWorkers, [cls.getDynamoProgram()], env=cls.getEnviron(gpuId=gpuId))
+                cls._workerPools[gpuId] = pool
+                atexit.register(pool.close)
+        return pool
+
+    @classmethod
+    def runDynamo(cls, protocol, args, cwd=None, gpuId=0, logFile=None):
+        """ Run Dynamo command from a given protocol. If there is a pool of Dynamo workers (see getWorkerPool),
+        the script is run in one of its sessions instead of starting a new one. The output is written to logFile
+        if provided. The protocol may be None when called from outside a protocol step."""
         # args will be the .doc file which contains the MATLAB code
-        program = cls.getDynamoProgram()
-        protocol.runJob(program, args, env=cls.getEnviron(gpuId=gpuId), cwd=cwd)
+        pool = cls.getWorkerPool(gpuId=gpuId)
+        if pool:
+            # The log file is written as the output is received, so it can be followed while the script runs
+            result = pool.run(args.strip(), cwd=cwd, logFile=logFile)
+            if not logFile:
+                sys.stdout.write(result.log)
+                sys.stdout.flush()
+            if result.status != 0:
+                # Same exception as when the script is run in a new session (see runJob)
+                raise subprocess.CalledProcessError(result.status, 'Dynamo script %s' % args.strip())
+        else:
+            program = cls.getDynamoProgram()
+            if logFile:
+                args += ' > %s' % logFile
+            if protocol:
+                protocol.runJob(program, args, env=cls.getEnviron(gpuId=gpuId), cwd=cwd)
+            else:
+                from pyworkflow.utils.process import runJob
+                runJob(None, program, args, env=cls.getEnviron(gpuId=gpuId), cwd=cwd)
 
     @classmethod
     def defineBinaries(cls, env):
@@ -32,6 +32,9 @@ DYNAMO_VERSION_1_1_532 = '1.1.532'
 DEFAULT_VERSION = DYNAMO_VERSION_1_1_532
 MINIMUM_VERSION_NUM = int(DYNAMO_VERSION_1_1_532.replace('.', ''))
 DYNAMO_SHIPPED_MCR = 'dynamo_activate_linux_shipped_MCR.sh'
+# Number of Dynamo sessions kept open to run the scripts of a protocol. The default, 0, starts a new session for each
+# script, as the standalone version is documented to run them (dynamo <script>.m), and is the safe choice
+DYNAMO_WORKERS = 'DYNAMO_WORKERS'
 
 # Dynamo files and dirs
 PROJECT_DIR = 'project'
@@ -39,6 +42,9 @@ TOMOGRAMS_DIR = 'tomograms'
 CATALOG_BASENAME = 'project'
 CATALOG_FILENAME = '%s.ctlg' % CATALOG_BASENAME
 VLL_FILE = 'tomograms.vll'
+MRC_EXTENSIONS = ['.mrc', '.rec', '.map']  # Read by the native engines
+STAGING_MANIFEST = 'staging.json'  # Content of a data folder, to reuse it
+PRIVATE_STAGING_MANIFEST = 'staging_private.json'  # Same, for a data folder not reused by other protocols
 PRJ_FROM_VIEWER = 'prjFromViewer.txt'
 DATA_MODIFIED_FROM_VIEWER = 'modified.txt'
 
@@ -24,108 +24,104 @@
 # *
 # **************************************************************************
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 from dynamo import Plugin
+from dynamo.native import readStackVolume, writeParticle
 from pwem.convert import transformations
 from pwem.convert.transformations import euler_from_matrix, translation_from_matrix
 import math, os
 import numpy as np
 from scipy.io import loadmat
 import pyworkflow.utils as pwutils
-from pyworkflow.utils.process import runJob
 from pwem.convert.headers import getFileFormat, MRC
 from pwem.emlib.image.image_handler import ImageHandler
 from pwem.objects.data import Transform, Volume
 from tomo.objects import Coordinate3D, TomoAcquisition
 import tomo.constants as const
-import random
+import warnings
 
 logger = logging.getLogger(__file__)
 
+# Dynamo table columns. Those from 37 on are not used by Dynamo, but are written for compatibility
+DYN_TBL_COLUMNS = ['tag', 'aligned', 'averaged', 'dx', 'dy', 'dz', 'tdrot', 'tilt', 'narot', 'cc', 'cc2', 'cpu',
+                   'ftype', 'ymintilt', 'ymaxtilt', 'xmintilt', 'xmaxtilt', 'fs1', 'fs2', 'tomo', 'reg', 'class',
+                   'annotation', 'x', 'y', 'z', 'dshift', 'daxis', 'dnarot', 'dcc', 'otag', 'npar', 'ref', 'sref',
+                   'apix', 'def', 'col37', 'col38', 'col39', 'col40']
+DYN_TBL_INT_COLUMNS = ['tag', 'aligned', 'averaged', 'cpu', 'ftype', 'tomo', 'reg', 'class', 'annotation',
+                       'otag', 'npar', 'ref', 'sref']
+# Threshold used by transformations.euler_from_matrix to detect the gimbal lock
+EULER_EPS = np.finfo(float).eps * 4.0
+
 
 def convertOrLinkVolume(inVolume: Volume, outVolume: str):
     """Converts the inVolume into a compatible (mrc) dynamo volume named outVolume
     or links it if already compatible"""
 
     inFn = inVolume.getFileName()
+    index = inVolume.getIndex()
 
-    # If compatible with dynamo. Attention!! Assuming is not a stack of mrc volumes!!
+    # If compatible with dynamo
     if getFileFormat(inFn) == MRC:
-        pwutils.createLink(os.path.abspath(inFn), outVolume)
+        if index:
+            # Volume of a stack (e.g. particles extracted as a stack per tomogram), read directly from it
+            writeParticle(outVolume, readStackVolume(inFn, index), sRate=inVolume.getSamplingRate())
+        else:
+            pwutils.createLink(os.path.abspath(inFn), outVolume)
     else:
         ih = ImageHandler()
         ih.convert(inVolume, outVolume)
 
 
-def writeSetOfVolumes(setOfVolumes, outputFnRoot, name):
-    if name == 'id':  # write the ID of the object in the name
-        for volume in setOfVolumes.iterSubtomos():
-            convertOrLinkVolume(volume, "%s%03d.mrc" % (outputFnRoot, volume.getObjId()))
-    if name == 'ix':  # write the INDEX of the object in the name
-        for ix, volume in enumerate(setOfVolumes.iterSubtomos()):
-            convertOrLinkVolume(volume, "%s%03d.mrc" % (outputFnRoot, int(ix + 1)))
+def getVolumeFileNames(outputFnRoot: str, numbers: List[int]) -> List[str]:
+    """Names outputFnRoot<number>.mrc of a list of volumes, with the numbers zero-padded to the same width, of 3
+    digits at least, so the files sort in the same order as the numbers"""
+    width = max([3] + [len(str(number)) for number in numbers])
+    return ['%s%0*d.mrc' % (outputFnRoot, width, number) for number in numbers]
+
+
+def writeSetOfVolumes(setOfVolumes, outputFnRoot, name, nThreads: int = 1) -> List[str]:
+    """Writes the volumes of a set as outputFnRoot<number>.mrc (see getVolumeFileNames), being the number the id of
+    each volume (name 'id') or its position in the set, from 1 (name 'ix'). The MRC volumes are linked, or read from
+    their stacks, in nThreads parallel threads, and the rest are converted one by one.
+    :return: the list of files written, in the order of the set.
+    """
+    volumes = [volume.clone() for volume in setOfVolumes]
+    numbers = [volume.getObjId() for volume in volumes] if name == 'id' else list(range(1, len(volumes) + 1))
+    outFiles = getVolumeFileNames(outputFnRoot, numbers)
+    isMrc = [getFileFormat(volume.getFileName()) == MRC for volume in volumes]
+    with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+        # Consume the results to raise the exceptions, if any
+        list(executor.map(convertOrLinkVolume,
+                          [volume for volume, mrc in zip(volumes, isMrc) if mrc],
+                          [outFile for outFile, mrc in zip(outFiles, isMrc) if mrc]))
+    for volume, outFile, mrc in zip(volumes, outFiles, isMrc):
+        if not mrc:
+            convertOrLinkVolume(volume, outFile)
+    return outFiles
 
 
 def writeDynTable(fhTable, setOfSubtomograms, randomizeOrientation=False):
-    for subtomo in setOfSubtomograms.iterSubtomos():
-        # Get 3d coordinates or 0, 0, 0
-        if subtomo.hasCoordinate3D():
-            x = subtomo.getCoordinate3D().getX(const.BOTTOM_LEFT_CORNER)
-            y = subtomo.getCoordinate3D().getY(const.BOTTOM_LEFT_CORNER)
-            z = subtomo.getCoordinate3D().getZ(const.BOTTOM_LEFT_CORNER)
-        else:
-            x = 0.0
-            y = 0.0
-            z = 0.0
+    DynamoTable.fromSubtomos(setOfSubtomograms, randomizeOrientation=randomizeOrientation).write(fhTable)
 
-        # Get alignment information
-        if randomizeOrientation:
-            # This the sphere point picking
-            u = random.uniform(0, 1)
-            v = random.uniform(0, 1)
-            tilt = np.rad2deg(np.arccos(2*v-1))
-            narot = 360.0*u
-            tdrot = 360.0*random.uniform(0, 1)
-            shiftx = 0.0
-            shifty = 0.0
-            shiftz = 0.0
-        else:
-            tdrot, tilt, narot, shiftx, shifty, shiftz = matrix2eulerAngles(subtomo.getTransform().getMatrix())
 
-        if subtomo.hasAcquisition():
-            anglemin = subtomo.getAcquisition().getAngleMin()
-            anglemax = subtomo.getAcquisition().getAngleMax()
-        else:
-            anglemin = 0
-            anglemax = 0
-        fhTable.write('%.3f 1 1 %.3f %.3f %.3f %.3f %.3f %.3f 0 0 0 1 %.3f %.3f 0 0 0 0 0 0 1 0 %.3f %.3f %.3f 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n'
-                      % (subtomo.getObjId(), shiftx, shifty, shiftz, tdrot, tilt, narot, anglemin, anglemax, x, y, z))
-
-
-def dynTableLine2Subtomo(inLine, subtomo, subtomoSet=None, tomo=None, coordSet=None):
-    if type(inLine) != list:
-        inLine = inLine.rstrip().split()
-    # inLine = inLine.rstrip()
-    subtomo.setObjId(int(inLine[0]))
-    shiftx = inLine[3]
-    shifty = inLine[4]
-    shiftz = inLine[5]
-    tdrot = inLine[6]
-    tilt = inLine[7]
-    narot = inLine[8]
-    A = eulerAngles2matrix(tdrot, tilt, narot, shiftx, shifty, shiftz)
+def dynTableLine2Subtomo(inLine, subtomo, subtomoSet=None, tomo=None, coordSet=None, matrix=None):
+    """Fills a subtomogram with the data of a Dynamo table row. It can be a record of a DynamoTable, a text
+    line of a .tbl file or the list of its values. The transformation matrix of the row can be provided if
+    it was already calculated for the whole table (see DynamoTable.getMatrices)."""
+    row = inLine if isinstance(inLine, np.void) else DynamoTable.fromLines([inLine])[0]
+    subtomo.setObjId(int(row['tag']))
+    if matrix is None:
+        matrix = eulerAngles2matrix(row['tdrot'], row['tilt'], row['narot'], row['dx'], row['dy'], row['dz'])
     transform = Transform()
-    transform.setMatrix(A)
+    transform.setMatrix(matrix)
     subtomo.setTransform(transform)
-    angleMin = inLine[13]
-    angleMax = inLine[14]
     acquisition = TomoAcquisition()
-    acquisition.setAngleMin(angleMin)
-    acquisition.setAngleMax(angleMax)
+    acquisition.setAngleMin(row['ymintilt'])
+    acquisition.setAngleMax(row['ymaxtilt'])
     subtomo.setAcquisition(acquisition)
-    volId = int(inLine[19])
-    subtomo.setVolId(volId)
-    classId = inLine[21]
-    subtomo.setClassId(classId)
+    subtomo.setVolId(int(row['tomo']))
+    subtomo.setClassId(int(row['class']))
     if tomo:
         tomoOrigin = tomo.getOrigin()
         subtomo.setVolName(tomo.getFileName())
@@ -133,12 +129,9 @@ def dynTableLine2Subtomo(inLine, subtomo, subtomoSet=None, tomo=None, coordSet=N
         coordinate3d = Coordinate3D()
         coordinate3d.setVolId(tomo.getObjId())
         coordinate3d.setVolume(tomo)
-        x = inLine[23]
-        y = inLine[24]
-        z = inLine[25]
-        coordinate3d.setX(float(x), const.BOTTOM_LEFT_CORNER)
-        coordinate3d.setY(float(y), const.BOTTOM_LEFT_CORNER)
-        coordinate3d.setZ(float(z), const.BOTTOM_LEFT_CORNER)
+        coordinate3d.setX(float(row['x']), const.BOTTOM_LEFT_CORNER)
+        coordinate3d.setY(float(row['y']), const.BOTTOM_LEFT_CORNER)
+        coordinate3d.setZ(float(row['z']), const.BOTTOM_LEFT_CORNER)
         subtomo.setCoordinate3D(coordinate3d)
         coordSet.append(coordinate3d)
     if subtomoSet is not None:
@@ -146,31 +139,173 @@ def dynTableLine2Subtomo(inLine, subtomo, subtomoSet=None, tomo=None, coordSet=N
 
 
 def readDynCoord(tableFile, coord3DSet, tomo, scaleFactor=1):
-    with open(tableFile) as fhTable:
-        for nline in fhTable:
-            coordinate3d = Coordinate3D()
-            nline = nline.rstrip().split()
-            shiftx = nline[3]
-            shifty = nline[4]
-            shiftz = nline[5]
-            tdrot = nline[6]
-            tilt = nline[7]
-            narot = nline[8]
-            A = eulerAngles2matrix(tdrot, tilt, narot, shiftx, shifty, shiftz)
-            x = nline[23]
-            y = nline[24]
-            z = nline[25]
-            groupId = nline[21]
-            coordinate3d.setVolume(tomo)
-            coordinate3d.setX(float(x) * scaleFactor, const.BOTTOM_LEFT_CORNER)
-            coordinate3d.setY(float(y) * scaleFactor, const.BOTTOM_LEFT_CORNER)
-            coordinate3d.setZ(float(z) * scaleFactor, const.BOTTOM_LEFT_CORNER)
-            coordinate3d.setGroupId(int(groupId))
-            coordinate3d.setMatrix(A)
-            coord3DSet.append(coordinate3d)
+    table = DynamoTable.read(tableFile)
+    for row, A in zip(table, table.getMatrices()):
+        coordinate3d = Coordinate3D()
+        coordinate3d.setVolume(tomo)
+        coordinate3d.setX(float(row['x']) * scaleFactor, const.BOTTOM_LEFT_CORNER)
+        coordinate3d.setY(float(row['y']) * scaleFactor, const.BOTTOM_LEFT_CORNER)
+        coordinate3d.setZ(float(row['z']) * scaleFactor, const.BOTTOM_LEFT_CORNER)
+        coordinate3d.setGroupId(int(row['class']))
+        coordinate3d.setMatrix(A)
+        coord3DSet.append(coordinate3d)
+
+
+class DynamoTable:
+    """Dynamo table (.tbl) held in a NumPy structured array with one named float64 field per column (see
+    https://wiki.dynamo.biozentrum.unibas.ch/w/index.php/Table_convention). The whole table is parsed and
+    written in one go instead of line by line."""
+
+    def __init__(self, data):
+        self._data = data
+
+    # --------------------------- Creation ----------------------------
+    @staticmethod
+    def getDtype(nCols=len(DYN_TBL_COLUMNS)) -> np.dtype:
+        names = DYN_TBL_COLUMNS[:nCols] + ['col%i' % (i + 1) for i in range(len(DYN_TBL_COLUMNS), nCols)]
+        return np.dtype([(name, np.float64) for name in names])
+
+    @classmethod
+    def blank(cls, nRows: int) -> 'DynamoTable':
+        """Table of nRows particles tagged from 1 to nRows, with the rest of the values set as Dynamo does
+        in its blank tables."""
+        data = np.zeros(nRows, dtype=cls.getDtype())
+        data['tag'] = np.arange(1, nRows + 1)
+        for colName in ('aligned', 'averaged', 'ftype', 'class'):
+            data[colName] = 1
+        return cls(data)
+
+    @classmethod
+    def fromArray(cls, values: np.ndarray) -> 'DynamoTable':
+        """Table from a 2D array of shape (nParticles, nColumns)"""
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return cls.blank(0)
+        values = np.atleast_2d(values)
+        data = np.empty(len(values), dtype=cls.getDtype(values.shape[1]))
+        for ind, colName in enumerate(data.dtype.names):
+            data[colName] = values[:, ind]
+        return cls(data)
+
+    @classmethod
+    def fromLines(cls, lines) -> 'DynamoTable':
+        """Table from a list of .tbl lines, each one as a string or as the list of its values"""
+        return cls.fromArray([line.split() if isinstance(line, str) else line for line in lines])
+
+    @classmethod
+    def read(cls, tblFile: str) -> 'DynamoTable':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # Empty tables
+            return cls.fromArray(np.loadtxt(tblFile, dtype=np.float64, ndmin=2))
+
+    @classmethod
+    def fromSubtomos(cls, setOfSubtomograms, randomizeOrientation=False) -> 'DynamoTable':
+        tags = []
+        coords = []
+        matrices = []
+        tiltRanges = []
+        for subtomo in setOfSubtomograms.iterSubtomos():
+            tags.append(subtomo.getObjId())
+            # Get 3d coordinates or 0, 0, 0
+            if subtomo.hasCoordinate3D():
+                coords.append(subtomo.getCoordinate3D().getPosition(const.BOTTOM_LEFT_CORNER))
+            else:
+                coords.append((0.0, 0.0, 0.0))
+            if not randomizeOrientation:
+                matrices.append(subtomo.getTransform().getMatrix())
+            if subtomo.hasAcquisition():
+                acq = subtomo.getAcquisition()
+                tiltRanges.append((acq.getAngleMin(), acq.getAngleMax()))
+            else:
+                tiltRanges.append((0, 0))
+
+        nParticles = len(tags)
+        table = cls.blank(nParticles)
+        data = table._data
+        data['tag'] = tags
+        # Get alignment information
+        if randomizeOrientation:
+            table.setAngles(getRandomEulerAngles(nParticles))
+        elif nParticles:
+            angles, shifts = matrices2eulerAngles(matrices)
+            table.setAngles(angles)
+            table.setShifts(shifts)
+        if nParticles:
+            table.setCoords(coords)
+            tiltRanges = np.asarray(tiltRanges, dtype=np.float64)
+            data['ymintilt'] = tiltRanges[:, 0]
+            data['ymaxtilt'] = tiltRanges[:, 1]
+        return table
+
+    # --------------------------- Access ----------------------------
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, item):
+        """A column array if item is a column name, a row record if it is an index"""
+        return self._data[item]
+
+    def __setitem__(self, colName, values):
+        self._data[colName] = values
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def getData(self) -> np.ndarray:
+        return self._data
+
+    def getColumnNames(self):
+        return self._data.dtype.names
+
+    def getTags(self) -> np.ndarray:
+        return self._data['tag'].astype(int)
+
+    def _getCols(self, colNames) -> np.ndarray:
+        return np.column_stack([self._data[colName] for colName in colNames]) if len(self) else np.empty((0, 3))
+
+    def _setCols(self, colNames, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(colNames))
+        for ind, colName in enumerate(colNames):
+            self._data[colName] = values[:, ind]
+
+    def getShifts(self) -> np.ndarray:
+        return self._getCols(('dx', 'dy', 'dz'))
+
+    def setShifts(self, shifts):
+        self._setCols(('dx', 'dy', 'dz'), shifts)
+
+    def getAngles(self) -> np.ndarray:
+        return self._getCols(('tdrot', 'tilt', 'narot'))
+
+    def setAngles(self, angles):
+        self._setCols(('tdrot', 'tilt', 'narot'), angles)
+
+    def getCoords(self) -> np.ndarray:
+        return self._getCols(('x', 'y', 'z'))
+
+    def setCoords(self, coords):
+        self._setCols(('x', 'y', 'z'), coords)
+
+    def getMatrices(self) -> np.ndarray:
+        """Transformation matrices (Scipion convention) of all the particles as an array of shape (N, 4, 4)"""
+        return eulerAngles2matrices(self.getAngles(), self.getShifts())
+
+    # --------------------------- Output ----------------------------
+    def write(self, fhTable):
+        """Writes the table into a .tbl file. It can be a file name or an opened file handler"""
+        fmt = ['%i' if colName in DYN_TBL_INT_COLUMNS else '%.3f' for colName in self.getColumnNames()]
+        np.savetxt(fhTable, self._data, fmt=fmt, delimiter=' ')
 
 
 # matrix2euler dynamo
+def getRandomEulerAngles(nParticles: int) -> np.ndarray:
+    """Dynamo angles (tdrot, tilt, narot), in degrees, of nParticles orientations uniformly distributed, as an
+    array of shape (N, 3)"""
+    # This the sphere point picking
+    u, v, w = np.random.uniform(0, 1, size=(3, nParticles))
+    return np.column_stack((360.0 * w, np.rad2deg(np.arccos(2 * v - 1)), 360.0 * u))
+
+
 def matrix2eulerAngles(matrix):
     # Relevant info:
     #   * Dynamo's transformation system is ZXZ
@@ -205,6 +340,63 @@ def eulerAngles2matrix(tdrot, tilt, narot, shiftx, shifty, shiftz):
     return M
 
 
+def eulerAngles2matrices(angles, shifts=None) -> np.ndarray:
+    """Vectorized version of eulerAngles2matrix for N particles at once.
+    :param angles: array of shape (N, 3) with the Dynamo angles (tdrot, tilt, narot), in degrees.
+    :param shifts: array of shape (N, 3) with the Dynamo shifts (shiftx, shifty, shiftz). Zero if not provided.
+    :return: array of shape (N, 4, 4) with the transformation matrices in Scipion convention.
+    """
+    # Relevant info:
+    #   * Dynamo's transformation system is ZXZ
+    #   * Sscipion = R * (-Sdynamo) ==> Sdynamo = Rinv * (-Sscipion)
+    angles = np.deg2rad(np.asarray(angles, dtype=np.float64).reshape(-1, 3))
+    nParticles = len(angles)
+    # Same expressions as transformations.euler_matrix for axes='szxz'
+    si, sj, sk = np.sin(angles).T
+    ci, cj, ck = np.cos(angles).T
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+    M = np.zeros((nParticles, 4, 4))
+    M[:, 3, 3] = 1
+    M[:, 2, 2] = cj
+    M[:, 2, 0] = sj * si
+    M[:, 2, 1] = sj * ci
+    M[:, 0, 2] = sj * sk
+    M[:, 0, 0] = -cj * ss + cc
+    M[:, 0, 1] = -cj * cs - sc
+    M[:, 1, 2] = -sj * ck
+    M[:, 1, 0] = cj * sc + cs
+    M[:, 1, 1] = cj * cc - ss
+    if shifts is not None:
+        Sdynamo = np.asarray(shifts, dtype=np.float64).reshape(-1, 3)
+        M[:, :3, 3] = - np.einsum('nij,nj->ni', M[:, :3, :3], Sdynamo)
+    return M
+
+
+def matrices2eulerAngles(matrices):
+    """Vectorized version of matrix2eulerAngles for N particles at once.
+    :param matrices: array of shape (N, 4, 4) with the transformation matrices in Scipion convention.
+    :return: two arrays of shape (N, 3), one with the Dynamo angles (tdrot, tilt, narot), in degrees, and the
+    other with the Dynamo shifts (shiftx, shifty, shiftz).
+    """
+    # Relevant info:
+    #   * Dynamo's transformation system is ZXZ
+    #   * Sscipion = R * (-Sdynamo) ==> Sdynamo = Rinv * (-Sscipion)
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    M = matrices[:, :3, :3]
+    # Same expressions as transformations.euler_from_matrix for axes='szxz'
+    sy = np.hypot(M[:, 2, 0], M[:, 2, 1])
+    regular = sy > EULER_EPS
+    tdrot = np.where(regular, np.arctan2(M[:, 2, 0], M[:, 2, 1]), np.arctan2(-M[:, 0, 1], M[:, 0, 0]))
+    tilt = np.arctan2(sy, M[:, 2, 2])
+    narot = np.where(regular, np.arctan2(M[:, 0, 2], -M[:, 1, 2]), 0.0)
+    angles = np.rad2deg(np.column_stack((tdrot, tilt, narot)))
+    # R is a rotation, so Rinv is its transpose
+    shiftsScipion = - matrices[:, :3, 3]
+    shiftsDynamo = np.einsum('nji,nj->ni', M, shiftsScipion)
+    return angles, shiftsDynamo
+
+
 def readDynCatalogue(ctlg_path, save_path):
     # MatLab script to convert an object into a structure
     matPath = os.path.join(save_path, 'structure.mat')
@@ -221,7 +413,7 @@ def readDynCatalogue(ctlg_path, save_path):
     codeFid.write(content)
     codeFid.close()
     args = ' %s' % codeFilePath
-    runJob(None, Plugin.getDynamoProgram(), args, env=Plugin.getEnviron())
+    Plugin.runDynamo(None, args)
 
     # Read MatLab binary into Python
     return loadmat(matPath, struct_as_record=False, squeeze_me=True)['s']
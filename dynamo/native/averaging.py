@@ -0,0 +1,309 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from os.path import exists
+from typing import List, Optional, Tuple
+import numpy as np
+from scipy.ndimage import affine_transform
+from .cropping import readStackVolume
+
+
+def alignParticle(data: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Applies to a particle, indexed as [z, y, x], the transformation matrix (4x4, in Scipion convention) that
+    moves it to the reference, with linear interpolation, as daverage does. The rotation is around the voxel
+    size // 2 of each dimension (the center of the box for Dynamo) and the voxels coming from out of the box
+    are set to 0.
+    :return: the aligned particle, as float64.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    # Each aligned voxel x is interpolated at M^-1 x in the particle. Being M = [R | t], M^-1 = [R^T | -R^T t]
+    rotInv = matrix[:3, :3].T
+    shiftInv = -rotInv @ matrix[:3, 3]
+    # From (x, y, z) to the (z, y, x) indices of the array, relative to the center
+    zyxRot = rotInv[::-1, ::-1]
+    center = np.array([size // 2 for size in data.shape], dtype=np.float64)
+    offset = center - zyxRot @ center + shiftInv[::-1]
+    return affine_transform(np.asarray(data, dtype=np.float64), zyxRot, offset=offset, order=1,
+                            mode='constant', cval=0.0)
+
+
+def getSphericalMask(boxSize: int) -> np.ndarray:
+    """Mask of the voxels inside the sphere inscribed in a box, centered at voxel boxSize // 2, as used in the
+    implicit rotation masking of Dynamo"""
+    coords = np.arange(boxSize) - boxSize // 2
+    z, y, x = np.meshgrid(coords, coords, coords, indexing='ij', sparse=True)
+    return x ** 2 + y ** 2 + z ** 2 <= (boxSize / 2) ** 2
+
+
+def getHalves(ids) -> np.ndarray:
+    """Half (0 for the even and 1 for the odd) of each particle, given its id. As the half depends only on the id,
+    it does not change when new particles are added to the set"""
+    return np.asarray(ids, dtype=np.int64) % 2
+
+
+@lru_cache(maxsize=8)
+def getWedgeMask(boxSize: int, tiltMin: float, tiltMax: float) -> np.ndarray:
+    """Fourier coefficients sampled by a single axis tilt series, tilted around y from tiltMin to tiltMax degrees,
+    in the frame of the particle. The array (bool) is indexed as [z, y, x] and centered, with the origin at the
+    voxel boxSize // 2 as after np.fft.fftshift. With no tilt range (tiltMin >= tiltMax), as for the particles
+    without acquisition, no wedge is considered. As the mask does not change along y, it is a read-only view of a
+    single plane, so each one cached (most particles share a few tilt ranges) takes boxSize ** 2 bytes.
+    """
+    shape = (boxSize, boxSize, boxSize)
+    if tiltMin >= tiltMax:
+        return np.broadcast_to(np.ones((1, 1, 1), dtype=bool), shape)
+    coords = np.arange(boxSize) - boxSize // 2
+    z, _, x = np.meshgrid(coords, coords, coords, indexing='ij', sparse=True)
+    # The image tilted by an angle samples the plane containing y and (cos(angle), 0, -sin(angle))
+    angles = (np.degrees(np.arctan2(-z, x)) + 90) % 180 - 90
+    return np.broadcast_to((angles >= tiltMin) & (angles <= tiltMax), shape)
+
+
+def alignWedge(wedge: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Missing wedge weights of a particle (see getWedgeMask) once aligned with its transformation matrix. Only the
+    rotation applies, as the shifts just change the phases"""
+    rotation = np.eye(4)
+    rotation[:3, :3] = np.asarray(matrix, dtype=np.float64)[:3, :3]
+    return alignParticle(wedge, rotation)
+
+
+def _sumAlignedParticles(fileNames: List[str], indices: List[int], matrices: np.ndarray, halves: np.ndarray,
+                         tiltRanges: Optional[np.ndarray] = None) -> Tuple[List[Optional[np.ndarray]],
+                                                                            List[Optional[np.ndarray]]]:
+    """Sums of the particles of each half once aligned (see alignParticle) and, if tiltRanges, the sums of their
+    centered Fourier transforms weighted by the aligned wedges and the sums of those weights (see
+    sumHalfParticlesFourier). None for an empty half or the weights if no tiltRanges"""
+    halfSums = [None, None]
+    halfWeights = [None, None]
+    try:
+        for ind, (fileName, index, matrix, half) in enumerate(zip(fileNames, indices, matrices, halves)):
+            aligned = alignParticle(readStackVolume(fileName, index), matrix)
+            if tiltRanges is not None:
+                weights = alignWedge(getWedgeMask(aligned.shape[0], *tiltRanges[ind]), matrix)
+                aligned = np.fft.fftshift(np.fft.fftn(aligned)) * weights
+                halfWeights[half] = _addSums(halfWeights[half], weights)
+            if halfSums[half] is None:
+                halfSums[half] = aligned
+            else:
+                halfSums[half] += aligned
+    finally:
+        # Only the partial sums are kept by the worker processes once done
+        getWedgeMask.cache_clear()
+    return halfSums, halfWeights
+
+
+def _addSums(sum1: Optional[np.ndarray], sum2: Optional[np.ndarray]) -> Optional[np.ndarray]:
+    if sum1 is None:
+        return sum2
+    if sum2 is None:
+        return sum1
+    return sum1 + sum2
+
+
+def _sumHalves(fileNames: List[str], indices: List[int], matrices, halves, tiltRanges=None,
+               nWorkers: int = 1) -> Tuple[List[Optional[np.ndarray]], List[Optional[np.ndarray]]]:
+    """Splits the particles in nWorkers groups summed in parallel processes (see _sumAlignedParticles) and adds
+    their partial sums"""
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    halves = np.asarray(halves, dtype=np.int64)
+    if tiltRanges is not None:
+        tiltRanges = np.asarray(tiltRanges, dtype=np.float64).reshape(-1, 2)
+    chunks = np.array_split(np.arange(len(matrices)), max(min(nWorkers, len(matrices)), 1))
+    chunkArgs = [([fileNames[i] for i in chunk], [indices[i] for i in chunk], matrices[chunk], halves[chunk],
+                  None if tiltRanges is None else tiltRanges[chunk])
+                 for chunk in chunks if len(chunk)]
+    if nWorkers > 1 and len(chunkArgs) > 1:
+        with ProcessPoolExecutor(max_workers=nWorkers) as executor:
+            partialSums = list(executor.map(_sumAlignedParticles, *zip(*chunkArgs)))
+    else:
+        partialSums = [_sumAlignedParticles(*args) for args in chunkArgs]
+    halfSums = [None, None]
+    halfWeights = [None, None]
+    for partialHalfSums, partialHalfWeights in partialSums:
+        halfSums = [_addSums(*sums) for sums in zip(halfSums, partialHalfSums)]
+        halfWeights = [_addSums(*weights) for weights in zip(halfWeights, partialHalfWeights)]
+    return halfSums, halfWeights
+
+
+def sumHalfParticles(fileNames: List[str], indices: List[int], matrices, halves,
+                     nWorkers: int = 1) -> List[Optional[np.ndarray]]:
+    """Sums separately the particles of the even and odd halves, aligned with their transformation matrices and
+    accumulating in float64, in a single pass over the particles. They are read directly from their files and split
+    in nWorkers groups summed in parallel processes, each one keeping only its partial sums in memory.
+    :param fileNames: MRC file of each particle.
+    :param indices: index (from 1) of each particle in its file if it is a stack, or 0 otherwise.
+    :param matrices: array of shape (N, 4, 4) with the transformation matrices in Scipion convention.
+    :param halves: half of each particle, 0 or 1 (see getHalves).
+    :param nWorkers: number of processes.
+    :return: list with the sums of the halves 0 and 1, None for an empty half.
+    """
+    return _sumHalves(fileNames, indices, matrices, halves, nWorkers=nWorkers)[0]
+
+
+def sumHalfParticlesFourier(fileNames: List[str], indices: List[int], matrices, halves, tiltRanges,
+                            nWorkers: int = 1) -> Tuple[List[Optional[np.ndarray]], List[Optional[np.ndarray]]]:
+    """Same as sumHalfParticles, but accumulating in Fourier space the particles weighted by their missing wedge,
+    and the wedge weights, so the average can be compensated at the end (see getWedgeCompensatedAverage).
+    :param tiltRanges: array of shape (N, 2) with the minimum and maximum tilt angles of each particle (see
+    getWedgeMask).
+    :return: lists with the sums of the centered Fourier transforms (complex128) and the sums of the weights of the
+    halves 0 and 1, None for an empty half.
+    """
+    return _sumHalves(fileNames, indices, matrices, halves, tiltRanges=tiltRanges, nWorkers=nWorkers)
+
+
+def getWedgeCompensatedAverage(fourierSum: np.ndarray, weights: np.ndarray, minWeight: float = 1) -> np.ndarray:
+    """Average (float64) from the sums of sumHalfParticlesFourier. Each Fourier coefficient is divided by the
+    number of particles that sampled it, and by minWeight if lower, to not amplify the scarcely sampled ones"""
+    return np.real(np.fft.ifftn(np.fft.ifftshift(fourierSum / np.maximum(weights, minWeight))))
+
+
+def sumParticles(fileNames: List[str], indices: List[int], matrices, nWorkers: int = 1,
+                 rotationMasking: bool = False) -> Optional[np.ndarray]:
+    """Sums a set of particles aligned with their transformation matrices (see sumHalfParticles).
+    :param rotationMasking: if True, the sum is multiplied by the spherical mask inscribed in the box (see
+    getSphericalMask), so the material that the rotations bring in and out of the box corners is discarded.
+    :return: the sum of the aligned particles, or None if there are no particles.
+    """
+    total = sumHalfParticles(fileNames, indices, matrices, np.zeros(len(fileNames), dtype=np.int64),
+                             nWorkers=nWorkers)[0]
+    if total is not None and rotationMasking:
+        total *= getSphericalMask(total.shape[0])
+    return total
+
+
+def averageParticles(fileNames: List[str], indices: List[int], matrices, nWorkers: int = 1,
+                     rotationMasking: bool = False) -> Optional[np.ndarray]:
+    """Average (float32) of a set of particles aligned with their transformation matrices (see sumParticles)"""
+    total = sumParticles(fileNames, indices, matrices, nWorkers=nWorkers, rotationMasking=rotationMasking)
+    return None if total is None else (total / len(fileNames)).astype(np.float32)
+
+
+def getFsc(vol1: np.ndarray, vol2: np.ndarray) -> np.ndarray:
+    """Fourier shell correlation between two cubic volumes. The Fourier coefficients are binned at once in shells
+    of 1 voxel width (the distance to the origin rounded) with np.bincount, weighting by 2 those having their
+    Friedel mate out of the half spectrum computed with rfftn.
+    :return: array with the FSC of the shells 0 (origin) to boxSize // 2 (Nyquist).
+    """
+    boxSize = vol1.shape[0]
+    ft1 = np.fft.rfftn(vol1)
+    ft2 = np.fft.rfftn(vol2)
+    freqs = np.fft.fftfreq(boxSize) * boxSize
+    z, y, x = np.meshgrid(freqs, freqs, np.fft.rfftfreq(boxSize) * boxSize, indexing='ij', sparse=True)
+    shells = np.rint(np.sqrt(x ** 2 + y ** 2 + z ** 2)).astype(np.int64)
+    weights = np.full(ft1.shape[-1], 2.0)
+    weights[0] = 1
+    if boxSize % 2 == 0:
+        weights[-1] = 1  # Nyquist plane
+    weights = np.broadcast_to(weights, ft1.shape)
+    nShells = boxSize // 2 + 1
+    inside = shells < nShells
+    shells = np.broadcast_to(shells, ft1.shape)[inside]
+    weights = weights[inside]
+    ft1 = ft1[inside]
+    ft2 = ft2[inside]
+    num = np.bincount(shells, weights * np.real(ft1 * np.conj(ft2)), minlength=nShells)
+    den1 = np.bincount(shells, weights * np.abs(ft1) ** 2, minlength=nShells)
+    den2 = np.bincount(shells, weights * np.abs(ft2) ** 2, minlength=nShells)
+    den = np.sqrt(den1 * den2)
+    return np.divide(num, den, out=np.zeros(nShells), where=den > 0)
+
+
+def getFscFrequencies(boxSize: int, sRate: float) -> np.ndarray:
+    """Spatial frequency (1/A) of each shell of getFsc"""
+    return np.arange(boxSize // 2 + 1) / (boxSize * sRate)
+
+
+class RunningSum:
+    """Sums of the aligned particles of the even and odd halves (see getHalves) and the ids of the particles summed,
+    kept in a NumPy (.npz) file, so they can be extended with new particles without reading again the previous ones
+    (e.g. when averaging in streaming). If the missing wedge is compensated, the sums are the Fourier ones, together
+    with the sums of the wedge weights (see sumHalfParticlesFourier)"""
+    halfKeys = ('even', 'odd')
+    weightKeys = ('evenWeights', 'oddWeights')
+
+    def __init__(self, fileName: str):
+        self.fileName = fileName
+        self.halfTotals = [None, None]
+        self.halfWeights = [None, None]
+        self.ids = np.zeros(0, dtype=np.int64)
+        if exists(fileName):
+            with np.load(fileName) as data:
+                self.halfTotals = [data[key] if data[key].size else None for key in self.halfKeys]
+                self.halfWeights = [data[key] if key in data and data[key].size else None
+                                    for key in self.weightKeys]
+                self.ids = data['ids']
+
+    def __len__(self):
+        return len(self.ids)
+
+    def getIds(self) -> set:
+        return set(self.ids.tolist())
+
+    def add(self, halfTotals: List[Optional[np.ndarray]], ids,
+            halfWeights: Optional[List[Optional[np.ndarray]]] = None):
+        """Adds the sums of the halves of some particles (see sumHalfParticles) and their ids, and the sums of their
+        wedge weights if they are Fourier sums (see sumHalfParticlesFourier)"""
+        self.halfTotals = [_addSums(*totals) for totals in zip(self.halfTotals, halfTotals)]
+        if halfWeights is not None:
+            self.halfWeights = [_addSums(*weights) for weights in zip(self.halfWeights, halfWeights)]
+        self.ids = np.concatenate((self.ids, np.asarray(ids, dtype=np.int64)))
+
+    def isWedgeCompensated(self) -> bool:
+        return any(weights is not None for weights in self.halfWeights)
+
+    def _average(self, total: Optional[np.ndarray], weights: Optional[np.ndarray], count: int,
+                 rotationMasking: bool) -> Optional[np.ndarray]:
+        if total is None or not count:
+            return None
+        if self.isWedgeCompensated():
+            average = getWedgeCompensatedAverage(total, weights)
+        else:
+            average = total / count
+        if rotationMasking:
+            average *= getSphericalMask(average.shape[0])
+        return average.astype(np.float32)
+
+    def getAverage(self, rotationMasking: bool = False) -> Optional[np.ndarray]:
+        """Average (float32) of the particles summed (see sumParticles for the rotationMasking)"""
+        return self._average(_addSums(*self.halfTotals), _addSums(*self.halfWeights), len(self), rotationMasking)
+
+    def getHalfAverages(self, rotationMasking: bool = False) -> List[Optional[np.ndarray]]:
+        """Averages (float32) of the even and odd halves, None for an empty half"""
+        counts = np.bincount(getHalves(self.ids), minlength=2)
+        return [self._average(total, weights, count, rotationMasking)
+                for total, weights, count in zip(self.halfTotals, self.halfWeights, counts)]
+
+    def write(self):
+        """Writes the file replacing the previous one at once, so it is never left half written"""
+        tmpFile = self.fileName + '.tmp'
+        sums = {key: values if values is not None else np.zeros(0)
+                for key, values in zip(self.halfKeys + self.weightKeys, self.halfTotals + self.halfWeights)}
+        with open(tmpFile, 'wb') as fh:
+            np.savez(fh, ids=self.ids, **sums)
+        os.replace(tmpFile, self.fileName)
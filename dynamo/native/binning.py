@@ -0,0 +1,145 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import List, Optional
+import mrcfile
+import numpy as np
+
+# Downsampling methods
+FOURIER_CROP = 'fourier'
+BLOCK_AVERAGE = 'block'
+
+
+def fourierCrop(data: np.ndarray, factor: int) -> np.ndarray:
+    """Downsamples an array by the given factor keeping the central region of its Fourier transform. The
+    dimensions are expected to be divisible by the factor. The origin (voxel size // 2) is kept at the same
+    physical position."""
+    newShape = [size // factor for size in data.shape]
+    ft = np.fft.fftshift(np.fft.fftn(data))
+    slices = tuple(slice(size // 2 - newSize // 2, size // 2 - newSize // 2 + newSize)
+                   for size, newSize in zip(data.shape, newShape))
+    cropped = np.fft.ifftn(np.fft.ifftshift(ft[slices])).real
+    # Keep the same scale of values
+    return (cropped / factor ** data.ndim).astype(np.float32)
+
+
+def blockAverage(data: np.ndarray, factor: int) -> np.ndarray:
+    """Downsamples an array by averaging blocks of factor voxels per dimension. The voxels that do not fill a
+    complete block at the end of each dimension are discarded."""
+    newShape = [size // factor for size in data.shape]
+    data = data[tuple(slice(0, newSize * factor) for newSize in newShape)]
+    blocks = data.reshape([dim for newSize in newShape for dim in (newSize, factor)])
+    return blocks.mean(axis=tuple(range(1, 2 * data.ndim, 2)), dtype=np.float64).astype(np.float32)
+
+
+def binVolume(data: np.ndarray, factor: int, method: str = FOURIER_CROP) -> np.ndarray:
+    """Downsamples a volume by the given factor with one of the methods FOURIER_CROP or BLOCK_AVERAGE"""
+    if factor == 1:
+        return np.asarray(data, dtype=np.float32)
+    if method == FOURIER_CROP:
+        return fourierCrop(data, factor)
+    elif method == BLOCK_AVERAGE:
+        return blockAverage(data, factor)
+    raise ValueError('Unknown downsampling method %s' % method)
+
+
+def getBinnedDims(dims, factor: int) -> tuple:
+    """Dimensions of a volume binned by the given factor with blockAverage"""
+    return tuple(size // factor for size in dims)
+
+
+def getSafeSlabSize(tomoDims, bytesPerVoxel: int, nSlabs: int, availableMemory: int, factor: int = 1,
+                    memoryFraction: float = 0.5) -> int:
+    """Largest slab size (number of slices in z) for which nSlabs slabs of a tomogram fit at the same time in the
+    given fraction of the available memory. It is rounded down to a multiple of the binning factor, and it is at
+    least the factor and at most the size of the tomogram in z.
+    :param tomoDims: tomogram dimensions (x, y, z).
+    :param bytesPerVoxel: bytes of each voxel of the slabs in memory.
+    :param nSlabs: number of slabs in memory at the same time.
+    :param availableMemory: available memory, in bytes.
+    :param factor: binning factor.
+    :param memoryFraction: fraction of the available memory that may be used by the slabs.
+    """
+    nx, ny, nz = tomoDims
+    sliceBytes = nx * ny * bytesPerVoxel
+    slabSize = int(availableMemory * memoryFraction // (max(nSlabs, 1) * sliceBytes)) // factor * factor
+    return int(min(max(slabSize, factor), nz))
+
+
+def binTomogram(tomoFile: str, outFile: str, factor: int, slabSize: int = 300, nThreads: int = 1,
+                sRate: Optional[float] = None) -> None:
+    """Bins an MRC tomogram by the given factor averaging blocks of factor voxels per dimension (see
+    blockAverage). The tomogram is memory-mapped and processed in slabs of slabSize slices in z (rounded down to a
+    multiple of the factor), which are binned in parallel and written to their place of the output file, also
+    memory-mapped. Thus, the memory used is bounded by slabSize * nThreads slices.
+    :param tomoFile: MRC file of the tomogram.
+    :param outFile: MRC file of the binned tomogram, written as float32.
+    :param factor: binning factor, so each output voxel is the average of factor ** 3 input voxels.
+    :param slabSize: number of input slices binned at once by each thread.
+    :param nThreads: number of slabs binned at the same time.
+    :param sRate: sampling rate written in the output header. The one of the tomogram multiplied by the factor if
+    not provided.
+    """
+    binTomogramPyramid(tomoFile, [outFile], factor, slabSize=slabSize, nThreads=nThreads,
+                       sRates=None if sRate is None else [sRate])
+
+
+def binTomogramPyramid(tomoFile: str, outFiles: List[str], factor: int, slabSize: int = 300, nThreads: int = 1,
+                       sRates: Optional[List[float]] = None) -> None:
+    """Same as binTomogram, but generating several binning levels in a single read of the tomogram: each level is
+    obtained binning by the given factor the slab of the previous one, already in memory, so the level k (from 1)
+    is the tomogram binned by factor ** k. The slabs are rounded down to a multiple of factor ** nLevels, so they
+    are binned evenly at all the levels.
+    :param outFiles: MRC file of each binning level, written as float32.
+    :param sRates: sampling rate of each level. The one of the tomogram multiplied by the factor of each level if
+    not provided.
+    """
+    nLevels = len(outFiles)
+    slabFactor = factor ** nLevels
+    slabSize = max(slabSize // slabFactor, 1) * slabFactor
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        tomoData = mrc.data
+        if sRates is None:
+            sRates = [float(mrc.voxel_size.x) * factor ** level for level in range(1, nLevels + 1)]
+        outShapes = [getBinnedDims(tomoData.shape, factor ** level) for level in range(1, nLevels + 1)]
+        with ExitStack() as stack:
+            outMrcs = [stack.enter_context(mrcfile.new_mmap(outFile, shape=outShape, mrc_mode=2, overwrite=True))
+                       for outFile, outShape in zip(outFiles, outShapes)]
+
+            def _binSlab(z0):
+                slab = tomoData[z0:min(z0 + slabSize, tomoData.shape[0])]
+                for level, outMrc in enumerate(outMrcs, start=1):
+                    slab = blockAverage(slab, factor)
+                    outZ0 = z0 // factor ** level
+                    outMrc.data[outZ0:outZ0 + slab.shape[0]] = slab
+
+            with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+                # Consume the results to raise the exceptions, if any
+                list(executor.map(_binSlab, range(0, outShapes[0][0] * factor, slabSize)))
+            for outMrc, sRate in zip(outMrcs, sRates):
+                outMrc.update_header_stats()
+                outMrc.voxel_size = sRate
@@ -0,0 +1,207 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+import mrcfile
+import numpy as np
+from .binning import binVolume, FOURIER_CROP
+
+
+def getBoxStarts(coords, boxSize: int) -> np.ndarray:
+    """First voxel (0-based, in x, y, z order) of the box cropped around each coordinate. As dtcrop does, the
+    coordinates are taken as MATLAB (1-based) voxel indices and rounded, and the box center is placed at the voxel
+    boxSize // 2 + 1 of the box."""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    return np.floor(coords + 0.5).astype(np.int64) - boxSize // 2 - 1
+
+
+def getSpatialOrder(coords, slabSize: int) -> np.ndarray:
+    """Order in which the particles should be cropped to read the tomogram as sequentially as possible. Following
+    the MRC data layout, they are sorted by slabs of slabSize slices in z, and by y and x inside each slab. The
+    sort is stable, so particles at the same position keep their relative order."""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    return np.lexsort((coords[:, 0], coords[:, 1], np.floor(coords[:, 2] / max(slabSize, 1))))
+
+
+def getOutOfBoundsMask(coords, boxSize: int, tomoDims: Sequence[int]) -> np.ndarray:
+    """Particles whose box lies partially or totally out of the tomogram.
+    :param coords: array of shape (N, 3) with the coordinates (x, y, z) in the tomogram.
+    :param boxSize: box size in pixels.
+    :param tomoDims: tomogram dimensions (x, y, z).
+    """
+    starts = getBoxStarts(coords, boxSize)
+    return np.any((starts < 0) | (starts + boxSize > np.asarray(tomoDims)), axis=1)
+
+
+def getCroppedMask(coords, boxSize: int, tomoDims: Sequence[int], pad: bool = False) -> np.ndarray:
+    """Particles that will be cropped: those whose box lies inside the tomogram or, if pad, those whose box is not
+    totally out of it (see cropBox)."""
+    if not pad:
+        return ~getOutOfBoundsMask(coords, boxSize, tomoDims)
+    starts = getBoxStarts(coords, boxSize)
+    return np.all((starts + boxSize > 0) & (starts < np.asarray(tomoDims)), axis=1)
+
+
+def cropBox(tomoData: np.ndarray, start: np.ndarray, boxSize: int, pad: bool = False) -> Optional[np.ndarray]:
+    """Crops a cubic box from the tomogram data, indexed as [z, y, x]. If the box lies partially out of the
+    tomogram, it is discarded (None is returned) or, if pad, the voxels out of the tomogram are filled with the
+    mean of the cropped voxels. A box totally out of the tomogram is always discarded."""
+    zyxStart = np.asarray(start)[::-1]
+    zyxEnd = zyxStart + boxSize
+    low = np.maximum(zyxStart, 0)
+    high = np.minimum(zyxEnd, tomoData.shape)
+    if np.array_equal(low, zyxStart) and np.array_equal(high, zyxEnd):
+        return np.array(tomoData[low[0]:high[0], low[1]:high[1], low[2]:high[2]], dtype=np.float32)
+    if not pad or np.any(high <= low):
+        return None
+    inData = tomoData[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+    box = np.full((boxSize, boxSize, boxSize), inData.mean(), dtype=np.float32)
+    boxLow = low - zyxStart
+    boxHigh = high - zyxStart
+    box[boxLow[0]:boxHigh[0], boxLow[1]:boxHigh[1], boxLow[2]:boxHigh[2]] = inData
+    return box
+
+
+def getParticle(tomoData: np.ndarray, start: np.ndarray, boxSize: int, pad: bool = False, invert: bool = False,
+                binning: int = 1, binningMethod: str = FOURIER_CROP) -> Optional[np.ndarray]:
+    """Crops a box of size boxSize * binning (see cropBox) and, if binning > 1, downsamples it to boxSize (see
+    binning.binVolume). The contrast is inverted if requested."""
+    box = cropBox(tomoData, start, boxSize * binning, pad=pad)
+    if box is None:
+        return None
+    if binning > 1:
+        box = binVolume(box, binning, method=binningMethod)
+    if invert:
+        np.negative(box, out=box)
+    return box
+
+
+def writeParticle(fileName: str, data: np.ndarray, sRate: Optional[float] = None):
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(data)
+        if sRate:
+            mrc.voxel_size = sRate
+
+
+def cropParticles(tomoFile: str, coords, boxSize: int, outFiles: List[str], nThreads: int = 1, pad: bool = False,
+                  invert: bool = False, binning: int = 1, binningMethod: str = FOURIER_CROP,
+                  sRate: Optional[float] = None) -> np.ndarray:
+    """Crops the particles of a tomogram and writes each one to the corresponding file of outFiles. The tomogram
+    is memory-mapped, so only the regions covered by the boxes are read.
+    :param tomoFile: MRC file of the tomogram.
+    :param coords: array of shape (N, 3) with the particle coordinates (x, y, z) in the tomogram (see getBoxStarts).
+    :param boxSize: box size in pixels.
+    :param outFiles: list of N particle file names.
+    :param nThreads: number of threads cropping and writing the particles at the same time.
+    :param pad: behaviour with the boxes that lie partially out of the tomogram (see cropBox).
+    :param invert: if True, the contrast of the particles is inverted before writing them.
+    :param binning: if higher than 1, boxes of size boxSize * binning are cropped and downsampled to boxSize,
+    so the particles are obtained as if they were cropped from the tomogram binned by that factor.
+    :param binningMethod: downsampling method, FOURIER_CROP or BLOCK_AVERAGE (see binning.binVolume).
+    :param sRate: sampling rate written in the particle headers. The one of the tomogram (multiplied by the
+    binning) if not provided.
+    :return: boolean array of size N, False for the particles that were not cropped.
+    """
+    starts = getBoxStarts(coords, boxSize * binning)
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        tomoData = mrc.data
+        if sRate is None:
+            sRate = float(mrc.voxel_size.x) * binning
+
+        def _crop(ind):
+            box = getParticle(tomoData, starts[ind], boxSize, pad=pad, invert=invert, binning=binning,
+                              binningMethod=binningMethod)
+            if box is None:
+                return False
+            writeParticle(outFiles[ind], box, sRate=sRate)
+            return True
+
+        # Crop following the tomogram layout, so it is read almost sequentially
+        order = getSpatialOrder(coords, boxSize * binning)
+        cropped = np.zeros(len(starts), dtype=bool)
+        with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+            cropped[order] = list(executor.map(_crop, order))
+    return cropped
+
+
+def invertParticle(fileName: str, sRate: Optional[float] = None):
+    """Inverts the contrast of a particle file in place. The header statistics are updated from the previous
+    ones, so the data are read and written only once."""
+    with mrcfile.mmap(fileName, mode='r+', permissive=True) as mrc:
+        if np.issubdtype(mrc.data.dtype, np.floating):
+            np.negative(mrc.data, out=mrc.data)
+            header = mrc.header
+            header.dmin, header.dmax, header.dmean = -header.dmax, -header.dmin, -header.dmean
+        else:
+            # Integer modes cannot represent the inverted values, so the particle is rewritten as float32
+            mrc.set_data(np.negative(mrc.data, dtype=np.float32))
+        if sRate:
+            mrc.voxel_size = sRate
+
+
+def invertParticles(fileNames: List[str], nThreads: int = 1, sRate: Optional[float] = None):
+    """Inverts the contrast of a list of particle files in place (see invertParticle)"""
+    with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+        # Consume the results to raise the exceptions, if any
+        list(executor.map(lambda fileName: invertParticle(fileName, sRate=sRate), fileNames))
+
+
+def cropParticlesToStack(tomoFile: str, coords, boxSize: int, stackFile: str, nThreads: int = 1, pad: bool = False,
+                         invert: bool = False, binning: int = 1, binningMethod: str = FOURIER_CROP,
+                         sRate: Optional[float] = None) -> np.ndarray:
+    """Same as cropParticles, but the particles are written to a single MRC volume stack, in the order of the
+    coordinates and skipping those that are not cropped. For a sequential reading of the tomogram, the coordinates
+    are expected to be already sorted (see getSpatialOrder). The stack is not created if no particle is cropped.
+    :return: boolean array of size N, False for the particles that were not cropped.
+    """
+    starts = getBoxStarts(coords, boxSize * binning)
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        tomoData = mrc.data
+        if sRate is None:
+            sRate = float(mrc.voxel_size.x) * binning
+        cropped = getCroppedMask(coords, boxSize * binning, tomoData.shape[::-1], pad=pad)
+        nCropped = int(np.count_nonzero(cropped))
+        if nCropped == 0:
+            return cropped
+        with mrcfile.new_mmap(stackFile, shape=(nCropped, boxSize, boxSize, boxSize), mrc_mode=2,
+                              overwrite=True) as stack:  # Mode 2 is float32 (see new_mmap)
+
+            def _crop(stackInd, ind):
+                stack.data[stackInd] = getParticle(tomoData, starts[ind], boxSize, pad=pad, invert=invert,
+                                                   binning=binning, binningMethod=binningMethod)
+
+            with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+                list(executor.map(_crop, range(nCropped), np.flatnonzero(cropped)))
+            stack.update_header_stats()
+            stack.voxel_size = sRate
+    return cropped
+
+
+def readStackVolume(stackFile: str, index: int) -> np.ndarray:
+    """Reads the volume of a given index (from 1) of an MRC volume stack. A single volume is read for index 1."""
+    with mrcfile.mmap(stackFile, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        return np.array(data[index - 1] if data.ndim == 4 else data)
@@ -24,29 +24,48 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import logging
+import os
+import time
 from enum import Enum
-from os.path import join
-from dynamo import Plugin
-from dynamo.convert import writeDynTable, writeSetOfVolumes
-from dynamo.protocols.protocol_base_dynamo import DynamoProtocolBase
+from os.path import splitext
+from typing import List
+import numpy as np
+from dynamo import Plugin, MRC_EXTENSIONS
+from dynamo.convert import writeDynTable, eulerAngles2matrices, getRandomEulerAngles
+from dynamo.native import sumHalfParticles, sumHalfParticlesFourier, writeParticle, RunningSum, getHalves, getFsc, \
+    getFscFrequencies
+from dynamo.protocols.protocol_base_dynamo import DynamoProtocolBase, ENGINE_DYNAMO, ENGINE_NATIVE
 from pwem.convert.headers import setMRCSamplingRate
 from pwem.emlib.image.image_readers import EmImageReader
-from pyworkflow.protocol import PointerParam, BooleanParam
-from pyworkflow.utils import Message, makePath
+from pwem.objects import FSC, SetOfFSCs
+from pyworkflow.object import Integer
+from pyworkflow.protocol import PointerParam, BooleanParam, EnumParam, ProtStreamingBase
+from pyworkflow.utils import Message, makePath, cyanStr
 from tomo.objects import AverageSubTomogram
 
+logger = logging.getLogger(__name__)
+
 
 class DynAvgOuts(Enum):
     average = AverageSubTomogram
+    fscs = SetOfFSCs
 
 
-class DynamoProtAvgSubtomograms(DynamoProtocolBase):
+class DynamoProtAvgSubtomograms(DynamoProtocolBase, ProtStreamingBase):
+    """Average of a set of subtomograms. With the native engine, it works in streaming, updating the average as
+    the subtomograms are added to the input set"""
 
     _label = 'Average subtomograms'
     _possibleOutputs = DynAvgOuts
     tableName = 'initial.tbl'
     dataDirName = 'data'
     averageDirName = 'average'
+    runningSumName = 'runningSum.npz'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.nAveraged = Integer(0)
 
     # --------------- DEFINE param functions ---------------
     def _defineParams(self, form):
@@ -67,14 +86,87 @@ class DynamoProtAvgSubtomograms(DynamoProtocolBase):
                       help='If set to Yes, the orientation of the picked subtomograms will be randimized. This ensures'
                            'to fill the missing wedge obtaining a ball in the average. If set to No, then the orientation'
                            'of the subtomos will be preserve in the average.')
+        form.addParam('engine', EnumParam,
+                      choices=['Dynamo', 'Native'],
+                      default=ENGINE_DYNAMO,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Averaging engine',
+                      help='*Dynamo*: the particles are linked or converted into a Dynamo data folder and averaged '
+                           'with daverage. The input set must be closed.\n*Native*: the particles are read directly '
+                           'from their files, aligned with their transformation matrices (linear interpolation, as '
+                           'daverage) and averaged in Scipion, so neither the data folder nor MATLAB are required, '
+                           'and Dynamo does not need to be installed. The particles are split among as many processes '
+                           'as Dynamo threads. It is only available for particles in MRC format.\nIf the input set '
+                           'is open, the average is updated as the subtomograms arrive, adding only the new ones to '
+                           'the sum of the previous ones.\nThe native engine also generates, in the same pass over the '
+                           'particles, the half-maps of the subtomograms with even and odd ids and the FSC between '
+                           'them.')
+        form.addParam('compensateWedge', BooleanParam,
+                      default=False,
+                      condition='engine == %i' % ENGINE_NATIVE,
+                      label='Compensate the missing wedge?',
+                      help='If set to Yes, the aligned particles and their missing wedges, given by the tilt range '
+                           'of their acquisition, are accumulated in Fourier space, and each Fourier coefficient of '
+                           'the average is divided by the number of particles that sampled it. Particles without '
+                           'tilt range are considered to have no missing wedge.')
         self.insertBinThreads(form)
+        self._defineStreamingParams(form)
+        form.addParallelSection(threads=2, mpi=0)
+
+    def _defineStreamingParams(self, form):
+        super()._defineStreamingParams(form)
+        # Only the native engine works in streaming
+        form.getParam('streamingSleepOnWait').condition.set('engine == %i' % ENGINE_NATIVE)
+
+    @classmethod
+    def worksInStreaming(cls):
+        return True
+
+    def modeSerial(self):
+        """The steps of the native engine are run in parallel, as the steps generator (see stepsGeneratorStep)
+        runs meanwhile, and the ones of the Dynamo engine one after another, as they depend on the previous one.
+        While the form is defined, there is no engine yet, so it is the parallel mode of the streaming protocols"""
+        engine = getattr(self, 'engine', None)
+        return engine is not None and engine.get() != ENGINE_NATIVE
 
     # --------------- INSERT steps functions ----------------
     def _insertAllSteps(self):
-        self._insertFunctionStep(self.convertInputStep, needsGPU=False)
-        self._insertFunctionStep(self.avgStep, needsGPU=False)
-        self._insertFunctionStep(self.convertOutputStep, needsGPU=False)
-        self._insertFunctionStep(self.createOutputStep, needsGPU=False)
+        if self.engine.get() == ENGINE_NATIVE:
+            # Running average updated by the steps inserted in stepsGeneratorStep
+            ProtStreamingBase._insertAllSteps(self)
+        else:
+            self._insertFunctionStep(self.convertInputStep, needsGPU=False)
+            self._insertFunctionStep(self.avgStep, needsGPU=False)
+            self._insertFunctionStep(self.convertOutputStep, needsGPU=False)
+            self._insertFunctionStep(self.createOutputStep, needsGPU=False)
+
+    def stepsGeneratorStep(self) -> None:
+        """Inserts a step that adds to the running average the subtomograms added to the input set since the
+        previous poll, until the input set is closed. Only their ids are read and passed to the step"""
+        inSubtomos = self.inSubtomos.get()
+        seenIds = RunningSum(self.getRunningSumFile()).getIds()
+        prevStepIds = []
+        while True:
+            with self._lock:
+                # Checked before reading the ids, so none is missed if the set is closed meanwhile
+                isClosed = not inSubtomos.isStreamOpen()
+                newIds = sorted(inSubtomos.getIdSet() - seenIds)
+            if newIds:
+                seenIds.update(newIds)
+                stepId = self._insertFunctionStep(self.addToAverageStep, newIds,
+                                                  prerequisites=prevStepIds,
+                                                  needsGPU=False)
+                prevStepIds = [stepId]
+                logger.info(cyanStr(f'{len(newIds)} new subtomograms to be averaged'))
+            if isClosed:
+                logger.info(cyanStr('Input set closed.'))
+                self._insertFunctionStep(self.checkOutputStep,
+                                         prerequisites=prevStepIds,
+                                         needsGPU=False)
+                break
+            time.sleep(self._getStreamingSleepOnWait())
+            with self._lock:
+                inSubtomos.loadAllProperties()  # Refresh the stream state
 
     # --------------- STEPS functions -----------------------
     def convertInputStep(self):
@@ -84,7 +176,7 @@ class DynamoProtAvgSubtomograms(DynamoProtocolBase):
         avgDir = self._getExtraPath(self.dataDirName)
         makePath(*[dataDir, avgDir])
         # Generate the data folder formatted along the Dynamo convention
-        writeSetOfVolumes(inSubtomos, join(dataDir, 'particle_'), 'id')
+        self.stageSubtomos(inSubtomos, dataDir)
         # Generate the Dynamo data table
         with open(tableName, 'w') as fhTable:
             writeDynTable(fhTable, inSubtomos, randomizeOrientation=self.randomizeOrientation)
@@ -97,6 +189,44 @@ class DynamoProtAvgSubtomograms(DynamoProtocolBase):
 
         Plugin.runDynamo(self, codeFileName)
 
+    def addToAverageStep(self, ids: List[int]):
+        """Adds some subtomograms, given their ids, to the running sum, kept on disk, and publishes the updated
+        average"""
+        makePath(self._getExtraPath(self.averageDirName))
+        runningSum = RunningSum(self.getRunningSumFile())
+        # Skip those already added if the step is run again when the protocol is continued
+        idsToAdd = set(ids) - runningSum.getIds()
+        if not idsToAdd:
+            return
+        newIds, newFileNames, newIndices, matrices, tiltRanges = [], [], [], [], []
+        with self._lock:
+            inSubtomos = self.inSubtomos.get()
+            for subtomo in inSubtomos.iterItems(where='id BETWEEN %i AND %i' % (min(idsToAdd), max(idsToAdd))):
+                if subtomo.getObjId() in idsToAdd:
+                    newIds.append(subtomo.getObjId())
+                    newFileNames.append(subtomo.getFileName())
+                    newIndices.append(subtomo.getIndex())
+                    matrices.append(subtomo.getTransform().getMatrix())
+                    tiltRanges.append(self.getTiltRange(subtomo))
+        if self.randomizeOrientation.get():
+            matrices = eulerAngles2matrices(getRandomEulerAngles(len(newIds)))
+        else:
+            matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+        if self.compensateWedge.get():
+            halfTotals, halfWeights = sumHalfParticlesFourier(newFileNames, newIndices, matrices, getHalves(newIds),
+                                                              tiltRanges, nWorkers=self.binThreads.get())
+            runningSum.add(halfTotals, newIds, halfWeights=halfWeights)
+        else:
+            halfTotals = sumHalfParticles(newFileNames, newIndices, matrices, getHalves(newIds),
+                                          nWorkers=self.binThreads.get())
+            runningSum.add(halfTotals, newIds)
+        runningSum.write()
+        self.publishAverage(runningSum)
+
+    def checkOutputStep(self):
+        if not getattr(self, DynAvgOuts.average.name, None):
+            raise Exception('No subtomograms were averaged. Please check the Output Log > run.stdout and run.stderr')
+
     def convertOutputStep(self):
         # Replacing directly the .em to .mrc generates headers with non-valid dimensions (1 x 1 x boxSize),
         # So the average is converted explicitly using the Image Handler
@@ -117,11 +247,104 @@ class DynamoProtAvgSubtomograms(DynamoProtocolBase):
         self._defineSourceRelation(inSubtomos, avg)
 
     # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        inSubtomos = self.inSubtomos.get()
+        if self.engine.get() != ENGINE_NATIVE and inSubtomos.isStreamOpen():
+            errors.append('The Dynamo engine averages the whole input set at once, so it must be closed. Wait '
+                          'until it is closed or use the native engine, which averages it in streaming.')
+        firstSubtomo = inSubtomos.getFirstItem()  # None for an empty input set in streaming
+        if self.engine.get() == ENGINE_NATIVE and firstSubtomo:
+            if splitext(firstSubtomo.getFileName())[1].lower() not in MRC_EXTENSIONS:
+                errors.append('The native engine requires the subtomograms in MRC format (%s).'
+                              % ', '.join(MRC_EXTENSIONS))
+        return errors
+
+    def _summary(self):
+        summary = []
+        if self.engine.get() == ENGINE_NATIVE and self.nAveraged.get():
+            summary.append('Subtomograms averaged: *%i*' % self.nAveraged.get())
+        return summary
 
     # --------------------------- UTILS functions ----------------------------
     def getOutputFile(self, ext='em'):
         return self._getExtraPath(self.averageDirName, self.averageDirName + '.' + ext)
 
+    def getRunningSumFile(self):
+        return self._getExtraPath(self.averageDirName, self.runningSumName)
+
+    @staticmethod
+    def getTiltRange(subtomo) -> list:
+        """Minimum and maximum tilt angles of the acquisition of a subtomogram, as written in the Dynamo table
+        (ymintilt, ymaxtilt), or 0, 0 if it has no acquisition"""
+        if subtomo.hasAcquisition():
+            acq = subtomo.getAcquisition()
+            return [acq.getAngleMin() or 0, acq.getAngleMax() or 0]
+        return [0, 0]
+
+    def getHalfMapFile(self, half: int):
+        return self._getExtraPath(self.averageDirName, '%s_half%i.mrc' % (self.averageDirName, half + 1))
+
+    @staticmethod
+    def writeVolume(fileName: str, data: np.ndarray, sRate: float):
+        # Replaced at once, so the previous volume can be displayed meanwhile
+        tmpFn = fileName + '.tmp'
+        writeParticle(tmpFn, data, sRate=sRate)
+        os.replace(tmpFn, fileName)
+
+    def publishAverage(self, runningSum: RunningSum):
+        """Writes the average of the running sum, its half-maps and their FSC, registering them as outputs the
+        first time"""
+        inSubtomos = self.inSubtomos.get()
+        sRate = inSubtomos.getSamplingRate()
+        rotationMasking = self.impRotMasking.get()
+        outFn = self.getOutputFile('mrc')
+        self.writeVolume(outFn, runningSum.getAverage(rotationMasking=rotationMasking), sRate)
+        halfMaps = runningSum.getHalfAverages(rotationMasking=rotationMasking)
+        halfMapFiles = []
+        fscValues = None
+        if all(halfMap is not None for halfMap in halfMaps):
+            for half, halfMap in enumerate(halfMaps):
+                halfMapFiles.append(self.getHalfMapFile(half))
+                self.writeVolume(halfMapFiles[-1], halfMap, sRate)
+            fscValues = getFsc(*halfMaps)
+            freqs = getFscFrequencies(halfMaps[0].shape[0], sRate)
+        with self._lock:
+            self.nAveraged.set(len(runningSum))
+            self._store(self.nAveraged)
+            avg = getattr(self, DynAvgOuts.average.name, None)
+            if avg is None:
+                avg = AverageSubTomogram()
+                avg.setFileName(outFn)
+                avg.setSamplingRate(sRate)
+                avg.setHalfMaps(halfMapFiles)
+                self._defineOutputs(**{DynAvgOuts.average.name: avg})
+                self._defineSourceRelation(self.inSubtomos, avg)
+            elif halfMapFiles and not avg.hasHalfMaps():
+                avg.setHalfMaps(halfMapFiles)
+                self._store(avg)
+            if fscValues is not None:
+                self.publishFsc(freqs, fscValues)
+
+    def publishFsc(self, freqs: np.ndarray, fscValues: np.ndarray):
+        """Registers the FSC between the half-maps the first time, or updates it"""
+        fscs = getattr(self, DynAvgOuts.fscs.name, None)
+        if fscs is None:
+            fscs = self._createSetOfFSCs()
+            fsc = FSC()
+            fsc.setData(freqs.tolist(), fscValues.tolist())
+            fscs.append(fsc)
+            fscs.write()
+            self._defineOutputs(**{DynAvgOuts.fscs.name: fscs})
+            self._defineSourceRelation(self.inSubtomos, fscs)
+        else:
+            fscs.enableAppend()
+            fsc = fscs.getFirstItem()
+            fsc.setData(freqs.tolist(), fscValues.tolist())
+            fscs.update(fsc)
+            fscs.write()
+            self._store(fscs)
+
     def genAvgCmd(self):
         cmd = "daverage('%s', " % self._getExtraPath(self.dataDirName)
         cmd += "'table', '%s', " % self._getExtraPath(self.tableName)
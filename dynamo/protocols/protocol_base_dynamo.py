@@ -23,6 +23,9 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+from os.path import abspath, dirname, join
+from dynamo import STAGING_MANIFEST
+from dynamo.utils import stageSetOfVolumes
 from pwem.protocols import EMProtocol
 from pyworkflow.protocol import IntParam
 from tomo.protocols import ProtTomoBase
@@ -31,6 +34,10 @@ IN_TOMOS = 'inputTomos'
 IN_COORDS = 'inputCoords'
 BIN_THREADS_MSG = 'Threads used by Dynamo each time it is called by Scipion'
 
+# Processing engines
+ENGINE_DYNAMO = 0
+ENGINE_NATIVE = 1
+
 
 class DynamoProtocolBase(EMProtocol, ProtTomoBase):
 
@@ -44,6 +51,20 @@ class DynamoProtocolBase(EMProtocol, ProtTomoBase):
                       default=3,
                       help=helpMsg)
 
+    def usesDynamo(self) -> bool:
+        """False if the protocol runs with the native engine, which does not call Dynamo at all"""
+        engine = getattr(self, 'engine', None)
+        return engine is None or engine.get() != ENGINE_NATIVE
+
+    def validate(self):
+        """The installation of Dynamo (see Plugin.validateInstallation) is only required if the protocol calls it,
+        so its errors are discarded with the native engine, which can be run where Dynamo is not installed"""
+        errors = super().validate()
+        if not self.usesDynamo():
+            installErrors = self.validateInstallation()
+            errors = [error for error in errors if error not in installErrors]
+        return errors
+
     def getBinningFactor(self, fromDynamo: bool = True) -> int:
         """From Dynamo: a binning Factor of 1 will decrease the size of the Tomograms by 2,
         a Binning Factor of 2 by 4... So Dynamo interprets the binning factor as 2**binFactor, while IMOD
@@ -59,3 +80,13 @@ class DynamoProtocolBase(EMProtocol, ProtTomoBase):
         inCoords = getattr(self, IN_COORDS, None)
         return inCoords if isPointer else inCoords.get()
 
+    def stageSubtomos(self, inSubtomos, dataDir: str, fromProject: bool = True) -> None:
+        """Generates the Dynamo data folder of a set of subtomograms, reusing it if it was already generated from
+        the same subtomograms by this protocol or, if fromProject, by any other of the project (see
+        utils.stageSetOfVolumes). The data folders modified later, so not reusable, must not be taken from the
+        project, and neither are they offered to it."""
+        runsDir = dirname(abspath(self._getPath()))
+        stageSetOfVolumes(inSubtomos, dataDir,
+                          nThreads=self.binThreads.get(),
+                          searchPattern=join(runsDir, '*', 'extra', '*', STAGING_MANIFEST) if fromProject else None,
+                          shared=fromProject)
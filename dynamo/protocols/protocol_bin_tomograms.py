@@ -24,24 +24,35 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import logging
+import signal
+import subprocess
+import threading
+import time
 from enum import Enum
 from os.path import abspath
-from dynamo.protocols.protocol_base_dynamo import DynamoProtocolBase, IN_TOMOS
+import mrcfile
+from psutil import virtual_memory
+from dynamo.protocols.protocol_base_dynamo import DynamoProtocolBase, IN_TOMOS, ENGINE_DYNAMO, ENGINE_NATIVE
 from pwem.convert.headers import setMRCSamplingRate
 from pwem.emlib.image import ImageHandler
 from pyworkflow.object import Set
-from pyworkflow.protocol import params, GT, STEPS_PARALLEL
-from pyworkflow.utils import getExt, Message, createLink
+from pyworkflow.protocol import params, GT, STEPS_PARALLEL, ProtStreamingBase
+from pyworkflow.utils import getExt, Message, createLink, cyanStr, yellowStr
 from tomo.objects import Tomogram, SetOfTomograms
-from dynamo import Plugin
+from dynamo import Plugin, MRC_EXTENSIONS
+from dynamo.native import binTomogramPyramid, getSafeSlabSize
+
+logger = logging.getLogger(__name__)
 
 
 class DynamoBinOuts(Enum):
     tomograms = SetOfTomograms
 
 
-class DynamoBinTomograms(DynamoProtocolBase):
-    """Reduce the size of a SetOfTomograms by a binning factor"""
+class DynamoBinTomograms(DynamoProtocolBase, ProtStreamingBase):
+    """Reduce the size of a SetOfTomograms by a binning factor. It works in streaming, binning the tomograms as they
+    are added to the input set"""
 
     _label = 'bin tomograms'
     _possibleOutputs = DynamoBinOuts
@@ -50,9 +61,11 @@ class DynamoBinTomograms(DynamoProtocolBase):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.finalTomoNamesDict = {}
+        self.tomoDict = {}
         self.ih = None
         self.sRate = None
-        self.doConvertFiles = None
+        self.levels = None
+        self.binningJobsSemaphore = None
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -64,95 +77,252 @@ class DynamoBinTomograms(DynamoProtocolBase):
         form.addParam('binning', params.IntParam,
                       default=2,
                       validators=[GT(0)],
-                      label="Binning Factor",
-                      help="A Binning Factor of 1 means that no binning will be carried out.")
+                      label="Binning Factor (Dynamo convention)",
+                      help="Binning in the convention of Dynamo, which reduces the size of the tomograms by "
+                           "2^(binning factor - 1): a Binning Factor of 1 means that no binning will be carried out, "
+                           "2 halves the size, 3 reduces it by 4, 4 by 8 and so on.")
+        form.addParam('engine', params.EnumParam,
+                      choices=['Dynamo', 'Native'],
+                      default=ENGINE_DYNAMO,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Binning engine',
+                      help='*Dynamo*: the tomograms are binned with dpktomo.tools.bin.\n*Native*: the tomograms are '
+                           'memory-mapped and binned directly in Scipion, averaging the same blocks of voxels as '
+                           'Dynamo, so MATLAB is not required and Dynamo does not need to be installed. The slabs of '
+                           'each tomogram are binned in parallel using the Dynamo threads.')
+        form.addParam('nLevels', params.IntParam,
+                      default=1,
+                      validators=[GT(0)],
+                      condition='engine == %i' % ENGINE_NATIVE,
+                      label='Number of binning levels',
+                      help='Number of binning levels generated from a single read of each tomogram, each one '
+                           'obtained reducing the size of the previous one as the binning factor does. For example, '
+                           'a binning factor of 2 and 3 levels generate the tomograms reduced by 2, 4 and 8, and a '
+                           'binning factor of 3 and 2 levels, the tomograms reduced by 4 and 16, each level '
+                           'registered as a separate set of tomograms.')
         form.addParam('zChunk', params.IntParam,
-                      default=300,
+                      default=0,
                       expertLevel=params.LEVEL_ADVANCED,
                       label="Number of slices kept in memory",
                       help="Maximum number of Z slices that are kept simultaneously in the memory during the "
-                           "binning process. This parameter might be important for larger size tomograms, making "
-                           "possible to process them in vertical slabs of thickness = value introduced in the  "
-                           "current parameter. This procedure can be accelerated using the multiple threads to engage "
-                           "several cores in parallel. However, this will only make sense if the total memory occupied "
-                           "by all the slabs simultaneously in memory in a given time fits in the RAM of the machine.")
+                           "binning process, so the tomograms are processed in vertical slabs of that thickness. "
+                           "If 0, it is computed for each tomogram so the slabs of all the tomograms binned at the "
+                           "same time (Scipion threads - 1 x Dynamo threads) fit in the available memory. If a binning "
+                           "job runs out of memory, it is retried with half the slab size.")
         self.insertBinThreads(form,
                               helpMsg='Number of threads used by Dynamo each time it is called in the protocol '
-                                      'execution. For example, if 2 Scipion threads and 3 Dynamo threads are set, '
-                                      'the tomograms will be processed in groups of 2 at the same time with a call '
-                                      'of tomo3d with 3 threads each, so 6 threads will be used at the same time. '
-                                      'Beware the memory of your machine has memory enough to load together the '
-                                      'number of tomograms specified by Scipion threads.')
-        form.addParallelSection(threads=1, mpi=0)
+                                      'execution. For example, if 3 Scipion threads and 3 Dynamo threads are set, '
+                                      'the tomograms will be processed in groups of 2 at the same time (one Scipion '
+                                      'thread is kept by the protocol to generate the steps) with a call of tomo3d '
+                                      'with 3 threads each, so 6 threads will be used at the same time. '
+                                      'The number of tomograms binned at the same time is reduced if the slabs of '
+                                      'all of them do not fit in the available memory.')
+        self._defineStreamingParams(form)
+        form.addParallelSection(threads=3, mpi=0)
+
+    @classmethod
+    def worksInStreaming(cls):
+        return True
 
     # --------------------------- INSERT steps functions ----------------------
-    def _insertAllSteps(self):
+    def stepsGeneratorStep(self) -> None:
+        """Inserts the steps of the tomograms as they arrive to the input set, and the step that closes the output
+        once the input set is closed and all its tomograms are binned"""
         self._initialize()
+        inTomos = self.getInTomos()
         stepIds = []
-        for tsId in self.tomoDict.keys():
-            cInPid = self._insertFunctionStep(self.convertInputStep, tsId,
-                                              prerequisites=[],
-                                              needsGPU=False)
-            binId = self._insertFunctionStep(self.binTomosStep, tsId,
-                                             prerequisites=cInPid,
-                                             needsGPU=False)
-            cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
-                                              prerequisites=binId,
-                                              needsGPU=False)
-            stepIds.append(cOutId)
-        self._insertFunctionStep(self._closeOutputSet,
-                                 prerequisites=stepIds,
-                                 needsGPU=False)
+        while True:
+            with self._lock:
+                inTsIds = set(inTomos.getTSIds())
+            if not inTomos.isStreamOpen() and inTsIds.issubset(self.tomoDict.keys()):
+                logger.info(cyanStr('Input set closed.'))
+                self._insertFunctionStep(self.closeOutputSetStep,
+                                         prerequisites=stepIds,
+                                         needsGPU=False)
+                break
+            with self._lock:
+                newTomos = [tomo.clone() for tomo in inTomos.iterItems()
+                            if tomo.getTsId() in inTsIds and tomo.getTsId() not in self.tomoDict]
+            for tomo in newTomos:
+                tsId = tomo.getTsId()
+                self.tomoDict[tsId] = tomo
+                if self.binningJobsSemaphore is None:
+                    nJobs = self.getMaxBinningJobs(tsId)
+                    logger.info(cyanStr(f'Up to {nJobs} tomograms will be binned at the same time'))
+                    self.binningJobsSemaphore = threading.BoundedSemaphore(nJobs)
+                cInPid = self._insertFunctionStep(self.convertInputStep, tsId,
+                                                  prerequisites=[],
+                                                  needsGPU=False)
+                binId = self._insertFunctionStep(self.binTomosStep, tsId,
+                                                 prerequisites=cInPid,
+                                                 needsGPU=False)
+                cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
+                                                  prerequisites=binId,
+                                                  needsGPU=False)
+                stepIds.append(cOutId)
+                logger.info(cyanStr(f'tsId = {tsId} - Steps created'))
+            self.refreshStreaming(inTomos)
+
+    def refreshStreaming(self, inTomos: SetOfTomograms) -> None:
+        """Waits for new input tomograms and reloads the input set properties, so its stream state is updated"""
+        time.sleep(self._getStreamingSleepOnWait())
+        if inTomos.isStreamOpen():
+            with self._lock:
+                inTomos.loadAllProperties()
 
     # --------------------------- STEPS functions -----------------------------
     def _initialize(self):
         inTomos = self.getInTomos()
         self.ih = ImageHandler()
-        self.tomoDict = {tomo.getTsId(): tomo.clone() for tomo in inTomos}
-        self.doConvertFiles = not self.isCompatibleFileFormat()
-        self.sRate = inTomos.getSamplingRate() * self.getBinningFactor(fromDynamo=False)
+        self.sRate = inTomos.getSamplingRate() * self.getSizeReductionFactor()
+        self.levels = list(range(1, self.getNLevels() + 1))
+        # Tomograms already binned in a previous execution
+        outTomos = getattr(self, self.getOutputName(), None)
+        self.tomoDict = {tomo.getTsId(): tomo.clone() for tomo in outTomos} if outTomos else {}
 
     def convertInputStep(self, tsId: str):
-        if self.doConvertFiles:
+        if not self.isCompatibleFileFormat(self.tomoDict[tsId]):
             tomo = self.tomoDict[tsId]
             origName = tomo.getFileName()
             finalName = self.getConvertedOrLinkedTsFn(tsId)
             self.ih.convert(origName, finalName)
 
     def binTomosStep(self, tsId: str):
-        mFile = self.createMCodeFile(tsId)
-        args = ' %s' % mFile
-        self.runJob(Plugin.getDynamoProgram(), args, env=Plugin.getEnviron())
+        # Only the binning jobs that fit in memory are run at the same time (see getMaxBinningJobs)
+        with self.binningJobsSemaphore:
+            slabSize = self.getSlabSize(tsId)
+            minSlabSize = self.getSlabFactor()
+            while True:
+                try:
+                    self.binTomogram(tsId, slabSize)
+                    break
+                except Exception as e:
+                    if not self.isOutOfMemoryError(e) or slabSize <= minSlabSize:
+                        raise
+                    slabSize = max(slabSize // 2, minSlabSize)
+                    logger.warning(yellowStr(f'tsId = {tsId} - Out of memory. Retrying with slabs of {slabSize} '
+                                             f'slices...'))
+
+    def binTomogram(self, tsId: str, slabSize: int):
+        if self.engine.get() == ENGINE_NATIVE:
+            binTomogramPyramid(self.getInTsFn(tsId),
+                               [self.getOutTsFn(tsId, level=level) for level in self.levels],
+                               self.getSizeReductionFactor(),
+                               slabSize=slabSize,
+                               nThreads=self.binThreads.get(),
+                               sRates=[self.getLevelSamplingRate(level) for level in self.levels])
+        else:
+            mFile = self.createMCodeFile(tsId, slabSize)
+            args = ' %s' % mFile
+            Plugin.runDynamo(self, args)
 
     def createOutputStep(self, tsId: str):
         with self._lock:
-            outTomos = self.getOutputSetOfTomograms()
             inTomo = self.tomoDict[tsId]
-            outFn = self.getOutTsFn(tsId)
-            setMRCSamplingRate(outFn, self.sRate)  # Update the apix value in file header
-            tomo = Tomogram()
-            tomo.copyInfo(inTomo)
-            tomo.setSamplingRate(self.sRate)
-            tomo.setFileName(outFn)
-            outTomos.append(tomo)
-            outTomos.update(tomo)
-            outTomos.write()
-            self._store(outTomos)
+            for level in self.levels:
+                outTomos = self.getOutputSetOfTomograms(level=level)
+                outFn = self.getOutTsFn(tsId, level=level)
+                sRate = self.getLevelSamplingRate(level)
+                setMRCSamplingRate(outFn, sRate)  # Update the apix value in file header
+                tomo = Tomogram()
+                tomo.copyInfo(inTomo)
+                tomo.setSamplingRate(sRate)
+                tomo.setFileName(outFn)
+                outTomos.append(tomo)
+                outTomos.update(tomo)
+                outTomos.write()
+                self._store(outTomos)
 
     # --------------------------- DEFINE utils functions ----------------------
-    def isCompatibleFileFormat(self):
-        """Compatible with MRC and em (MRC with that extension)"""
-        compatibleExts = ['.em', '.mrc']
-        return True if (getExt(self.getInTomos().getFirstItem().getFileName())
-                        in compatibleExts) else False
+    def isCompatibleFileFormat(self, tomo: Tomogram):
+        """Compatible with MRC and em (MRC with that extension). The native engine only reads MRC"""
+        compatibleExts = MRC_EXTENSIONS if self.engine.get() == ENGINE_NATIVE else ['.em', '.mrc']
+        return True if getExt(tomo.getFileName()) in compatibleExts else False
+
+    def getDynamoBinning(self) -> int:
+        """Binning in the convention of dpktomo.tools.bin, which reduces the size by 2**binning. So it is the
+        binning introduced minus 1 (e.g. 3 for a binning of 4)"""
+        return self.binning.get() - 1
+
+    def getSizeReductionFactor(self) -> int:
+        """Factor by which the size of the tomograms is reduced: 2**(binning - 1), as Dynamo does"""
+        return 2 ** self.getDynamoBinning()
+
+    def getNLevels(self) -> int:
+        """Number of binning levels generated (only the native engine generates more than one)"""
+        return self.nLevels.get() if self.engine.get() == ENGINE_NATIVE else 1
+
+    def getLevelSamplingRate(self, level: int) -> float:
+        """Sampling rate of the tomograms of a binning level (from 1)"""
+        return self.sRate * self.getSizeReductionFactor() ** (level - 1)
+
+    def getSlabFactor(self) -> int:
+        """Factor passed to the binning call. The slabs must be a multiple of it: the size reduction factor, raised
+        to the number of levels in the native engine (see binTomogramPyramid)"""
+        return self.getSizeReductionFactor() ** self.getNLevels()
+
+    def getBytesPerVoxel(self, tsId: str) -> int:
+        """Size of each voxel of the slabs in memory. The native engine keeps the data type of the tomogram (float32
+        if it has to be converted, as done by the ImageHandler), while MATLAB works with doubles"""
+        if self.engine.get() != ENGINE_NATIVE:
+            return 8
+        tomoFile = self.tomoDict[tsId].getFileName()
+        if not self.isCompatibleFileFormat(self.tomoDict[tsId]):
+            return 4
+        with mrcfile.open(tomoFile, header_only=True, permissive=True) as mrc:
+            return mrcfile.utils.data_dtype_from_header(mrc.header).itemsize
+
+    def getNBinningThreads(self) -> int:
+        """Scipion threads left for the binning steps, as the steps generator (see stepsGeneratorStep) keeps one
+        of them busy while the protocol runs"""
+        return max(self.numberOfThreads.get() - 1, 1)
+
+    def getMaxBinningJobs(self, tsId: str) -> int:
+        """Number of tomograms like the given one that can be binned at the same time: as many as Scipion threads
+        left for the binning steps (see getNBinningThreads), as long as the slabs loaded by all of them (zChunk
+        slices per Dynamo thread, see getBytesPerVoxel) fit in the available memory. If zChunk is automatic, the
+        slabs are sized to fit (see getSlabSize)"""
+        if self.zChunk.get() <= 0:
+            return self.getNBinningThreads()
+        nx, ny, _ = self.tomoDict[tsId].getDim()
+        jobMemory = self.zChunk.get() * nx * ny * self.getBytesPerVoxel(tsId) * max(self.binThreads.get(), 1)
+        nJobs = virtual_memory().available // max(jobMemory, 1)
+        return int(max(1, min(self.getNBinningThreads(), nJobs)))
+
+    def getSlabSize(self, tsId: str) -> int:
+        """zChunk, or if automatic, the largest slab size for which the slabs of all the tomograms binned at the
+        same time (binning threads x Dynamo threads, see getNBinningThreads) fit in the available memory (see
+        getBytesPerVoxel)"""
+        if self.zChunk.get() > 0:
+            return self.zChunk.get()
+        slabSize = getSafeSlabSize(self.tomoDict[tsId].getDim(), self.getBytesPerVoxel(tsId),
+                                   self.getNBinningThreads() * max(self.binThreads.get(), 1),
+                                   virtual_memory().available,
+                                   factor=self.getSlabFactor())
+        logger.info(cyanStr(f'tsId = {tsId} - Binning in slabs of {slabSize} slices'))
+        return slabSize
+
+    @staticmethod
+    def isOutOfMemoryError(e: Exception) -> bool:
+        """If the exception comes from a binning job that ran out of memory: a MemoryError in the native engine,
+        or the Dynamo process killed (SIGKILL) by the OOM killer, directly or through the shell"""
+        if isinstance(e, MemoryError):
+            return True
+        return (isinstance(e, subprocess.CalledProcessError) and
+                e.returncode in (-signal.SIGKILL, 128 + signal.SIGKILL))
+
+    def getInTsFn(self, tsId: str):
+        """Tomogram file to be binned: the converted one if the input format is not compatible"""
+        tomo = self.tomoDict[tsId]
+        return tomo.getFileName() if self.isCompatibleFileFormat(tomo) else self.getConvertedOrLinkedTsFn(tsId)
 
     def getConvertedOrLinkedTsFn(self, tsId: str):
         return self._getExtraPath(f'in_{tsId}.mrc')
 
-    def getOutTsFn(self, tsId: str):
-        return self._getExtraPath(f'{tsId}.mrc')
+    def getOutTsFn(self, tsId: str, level: int = 1):
+        return self._getExtraPath(f'{tsId}.mrc' if level == 1 else f'{tsId}_level{level}.mrc')
 
-    def createMCodeFile(self, tsId: str):
+    def createMCodeFile(self, tsId: str, slabSize: int):
         # FROM DYNAMO:
         # ______________________________________________________________________________________________
         # bin(fileIn,fileOut,binFactor,varargin)
@@ -162,36 +332,63 @@ class DynamoBinTomograms(DynamoProtocolBase):
         # p.addParamValue('maximumMegaBytes',[]);
         # p.addParamValue('showStatistics',false,'short','sst');
         # ______________________________________________________________________________________________
-        tomo = self.tomoDict[tsId]
-        origName = abspath(tomo.getFileName())
+        origName = abspath(self.getInTsFn(tsId))
         finalName = abspath(self.getOutTsFn(tsId))
-        mFile = self._getExtraPath('binTomograms.m')
+        mFile = self._getExtraPath(f'binTomograms_{tsId}.m')  # One per tomogram, as they are binned in parallel
         with open(mFile, 'w') as codeFile:
             content = ("dpktomo.tools.bin('%s', '%s', %i, 'slabSize', %i, 'matlabWorkers', %i, "
-                       "'showStatistics', true)\n") % (origName, finalName, super().getBinningFactor(),
-                                                       self.zChunk.get(), self.binThreads.get())
+                       "'showStatistics', true)\n") % (origName, finalName, self.getDynamoBinning(),
+                                                       slabSize, self.binThreads.get())
             codeFile.write(content)
         return mFile
 
-    def getOutputSetOfTomograms(self) -> SetOfTomograms:
-        outTomograms = getattr(self, self._possibleOutputs.tomograms.name, None)
+    def closeOutputSetStep(self):
+        self._closeOutputSet()
+        if not getattr(self, self.getOutputName(), None):
+            raise Exception('No tomograms were binned. Please check the Output Log > run.stdout and run.stderr')
+
+    def getOutputName(self, level: int = 1) -> str:
+        """Name of the output set of a binning level. The first one is the main output (tomograms)"""
+        outName = self._possibleOutputs.tomograms.name
+        return outName if level == 1 else f'{outName}Level{level}'
+
+    def getOutputSetOfTomograms(self, level: int = 1) -> SetOfTomograms:
+        outName = self.getOutputName(level)
+        outTomograms = getattr(self, outName, None)
         if outTomograms:
             outTomograms.enableAppend()
             tomograms = outTomograms
         else:
-            tomograms = SetOfTomograms.create(self._getPath(), template='tomograms%s.sqlite')
+            tomograms = SetOfTomograms.create(self._getPath(), template='tomograms%s.sqlite',
+                                              suffix='' if level == 1 else f'Level{level}')
             tomograms.copyInfo(self.getInTomos())
-            tomograms.setSamplingRate(self.sRate)
+            tomograms.setSamplingRate(self.getLevelSamplingRate(level))
             tomograms.setStreamState(Set.STREAM_OPEN)
-            setattr(self, self._possibleOutputs.tomograms.name, tomograms)
-            self._defineOutputs(**{self._possibleOutputs.tomograms.name: tomograms})
+            setattr(self, outName, tomograms)
+            self._defineOutputs(**{outName: tomograms})
             self._defineSourceRelation(self.inputTomos, tomograms)
 
         return tomograms
 
     # --------------------------- DEFINE info functions ----------------------
+    def _validate(self):
+        errors = []
+        tomoDims = self.getInTomos().getDim() if self.getInTomos(isPointer=True).hasValue() else None
+        if self.engine.get() == ENGINE_NATIVE and tomoDims:  # No dims yet for an empty input set in streaming
+            minSize = min(tomoDims)
+            if minSize // self.getSlabFactor() < 1:
+                errors.append('The tomograms of size %i are too small for %i binning levels.'
+                              % (minSize, self.getNLevels()))
+        return errors
+
     def _methods(self):
-        methodsMsgs = ["*Binning Factor*: %s" % self.binning.get()]
+        reductionFactor = self.getSizeReductionFactor()
+        methodsMsgs = ["*Binning Factor*: %i (Dynamo convention), so the size of the tomograms is reduced by %i"
+                       % (self.binning.get(), reductionFactor)]
+        if self.getNLevels() > 1:
+            methodsMsgs.append("*Binning levels*: %i, with the size reduced by %s"
+                               % (self.getNLevels(), ', '.join(str(reductionFactor ** level)
+                                                                for level in range(1, self.getNLevels() + 1))))
         return methodsMsgs
 
     def _summary(self):
@@ -199,7 +396,7 @@ class DynamoBinTomograms(DynamoProtocolBase):
         if self.getOutputsSize() >= 1:
             for _, outTomos in self.iterOutputAttributes():
                 summary.append("Output *%s*:" % outTomos.getNameId().split('.')[1])
-                summary.append("    * Binning Factor: *%s*" % self.binning.get())
+                summary.append("    * Sampling rate: *%.2f Å/px*" % outTomos.getSamplingRate())
                 summary.append("    * Number of Tomograms Binned: *%s*" %
                                outTomos.getSize())
         else:
@@ -23,38 +23,70 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import copy
 import glob
 import logging
+import re
+import warnings
 from enum import Enum
-from os.path import abspath, join
-from typing import List
-import mrcfile
-from dynamo.protocols.protocol_base_dynamo import IN_TOMOS, IN_COORDS, DynamoProtocolBase
-from dynamo.utils import getCatalogFile
+from os.path import abspath, join, splitext, exists
+from typing import List, Dict, Tuple, NamedTuple, Optional
+import numpy as np
+from dynamo.protocols.protocol_base_dynamo import IN_TOMOS, IN_COORDS, DynamoProtocolBase, ENGINE_DYNAMO, \
+    ENGINE_NATIVE
+from dynamo.utils import getCatalogFile, getInputsKey, writeManifest, readManifest, writeBinaryTable, \
+    readBinaryTable, genMCode4ReadBinaryTable, bulkInsert
+from pwem.constants import NO_INDEX
 from pwem.objects import Transform
-from pyworkflow.object import Boolean
-from pyworkflow.protocol import PointerParam, EnumParam, IntParam, BooleanParam, STEPS_PARALLEL
-from pyworkflow.utils import removeExt, Message, makePath, cyanStr, redStr
+from pyworkflow.object import Integer, Set
+from pyworkflow.protocol import PointerParam, EnumParam, IntParam, BooleanParam, STEPS_PARALLEL, LEVEL_ADVANCED
+from pyworkflow.utils import removeExt, Message, makePath, cyanStr, redStr, cleanPath, cleanPattern
 from tomo.constants import BOTTOM_LEFT_CORNER, TR_DYNAMO
-from tomo.objects import SetOfSubTomograms, SubTomogram
-from dynamo import Plugin, VLL_FILE
-from dynamo.convert import matrix2eulerAngles
-from tomo.utils import scaleTrMatrixShifts
+from tomo.objects import SetOfSubTomograms, SubTomogram, Coordinate3D
+from dynamo import Plugin, VLL_FILE, MRC_EXTENSIONS
+from dynamo.convert import matrices2eulerAngles
+from dynamo.native import cropParticles, invertParticles, cropParticlesToStack, getOutOfBoundsMask, \
+    getCroppedMask, getSpatialOrder, FOURIER_CROP, BLOCK_AVERAGE
 
 logger = logging.getLogger(__name__)
 CROP_DIR = 'Crop'
 LOG_FILE_NAME = 'log.txt'
+PARTICLE_TAG_REGEX = re.compile(r'(\d+)\.mrc$')
+PARTICLE_FILE_PATTERN = 'particle_%05i.mrc'  # As named by dtcrop
+PARTICLE_STACK_FILE = 'particles.mrc'
+PARTICLE_STACK_INDEX_FILE = 'particles_index.txt'
+OUT_OF_BOUNDS_FILE = 'outOfBounds.txt'
+MANIFEST_FILE = 'manifest.json'
+COORDS_FILE = 'coords.bin'  # Columns: x, y, z, chunk, tag, tdrot, tilt, narot
 
 # Tomogram type constants for particle extraction
 SAME_AS_PICKING = 0
 OTHER = 1
 
+# Output layouts
+LAYOUT_FILES = 0
+LAYOUT_STACK = 1
+
+# Policies for the particles whose box lies partially out of the tomogram
+OUT_OF_BOUNDS_SKIP = 0
+OUT_OF_BOUNDS_PAD = 1
+
+# Downsampling methods, in the order of the param choices
+DOWNSAMPLING_METHODS = [FOURIER_CROP, BLOCK_AVERAGE]
+
 
 class DynSubtomoExtractOuts(Enum):
     subtomograms = SetOfSubTomograms
 
 
+class TomoCoordinates(NamedTuple):
+    """Coordinates of a tomogram, sorted by id"""
+    ids: np.ndarray
+    positions: np.ndarray  # Shape (N, 3), referred to the bottom left corner
+    matrices: np.ndarray  # Shape (N, 4, 4)
+    template: Coordinate3D  # Copy of the first coordinate, with the same attributes, extended ones included
+    values: List[tuple]  # Pairs (attribute name, value) of the stored attributes of each coordinate
+
+
 class DynamoExtraction(DynamoProtocolBase):
     """Extraction of subtomograms using Dynamo"""
 
@@ -67,7 +99,9 @@ class DynamoExtraction(DynamoProtocolBase):
         self.dynamoTomoIdDict = {}
         self.scaleFactor = None
         self.tomoTsIdDict = None
-        self.coordsRemoved = Boolean()
+        self.coordsTsIdDict = None
+        self.nExcludedParticles = Integer(0)
+        self.nPaddedParticles = Integer(0)
         self.failedItems = []
 
     # --------------------------- DEFINE param functions ----------------------
@@ -96,6 +130,61 @@ class DynamoExtraction(DynamoProtocolBase):
                       help='The subtomograms are extracted as a cubic box of this size. '
                            'The wizard will select the box size considering the sampling rate ratio between the '
                            'introduced coordinates and the tomograms that will br used for the extraction.')
+        form.addParam('engine', EnumParam,
+                      choices=['Dynamo', 'Native'],
+                      default=ENGINE_DYNAMO,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Cropping engine',
+                      help='*Dynamo*: the particles are cropped with dtcrop, after building a Dynamo catalogue for '
+                           'each tomogram.\n*Native*: the tomograms are memory-mapped and the particles are cropped '
+                           'directly in Scipion, following the same conventions as dtcrop, so neither MATLAB nor '
+                           'the catalogue are required, and Dynamo does not need to be installed. It is only '
+                           'available for tomograms in MRC format.')
+        form.addParam('outputLayout', EnumParam,
+                      choices=['one file per particle', 'one stack per tomogram'],
+                      default=LAYOUT_FILES,
+                      condition='engine == %i' % ENGINE_NATIVE,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Output layout',
+                      help='*one file per particle*: each particle is written to its own MRC file.\n'
+                           '*one stack per tomogram*: the particles of each tomogram are written to a single MRC '
+                           'volume stack, together with an index file with the particle tags. Recommended for '
+                           'large numbers of particles, as it avoids creating one file per particle.')
+        form.addParam('downsampling', IntParam,
+                      default=1,
+                      condition='engine == %i' % ENGINE_NATIVE,
+                      label='Downsampling factor',
+                      help='If higher than 1, the particles are cropped from the tomograms with a box of the box '
+                           'size multiplied by this factor and downsampled to the box size, so the result is the '
+                           'same as extracting them from the tomograms binned by this factor, but without '
+                           'generating the binned tomograms.')
+        form.addParam('downsamplingMethod', EnumParam,
+                      choices=['Fourier cropping', 'block averaging'],
+                      default=0,
+                      condition='engine == %i and downsampling > 1' % ENGINE_NATIVE,
+                      display=EnumParam.DISPLAY_HLIST,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Downsampling method',
+                      help='*Fourier cropping*: the central region of the Fourier transform of each particle is '
+                           'kept, so its frequencies are not altered up to the new Nyquist frequency.\n'
+                           '*block averaging*: each voxel is the mean of the corresponding block of voxels, which '
+                           'is faster but attenuates the high frequencies.')
+        form.addParam('outOfBoundsPolicy', EnumParam,
+                      choices=['skip', 'pad'],
+                      default=OUT_OF_BOUNDS_SKIP,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Particles partially out of the tomogram',
+                      help='Behaviour with the particles whose box lies partially out of the tomogram:\n'
+                           '*skip*: they are not extracted.\n'
+                           '*pad*: they are extracted and the region out of the tomogram is filled with the mean '
+                           'value of the region inside it.\n'
+                           'The particles whose box lies totally out of the tomogram are always skipped.')
+        form.addParam('chunkSize', IntParam,
+                      default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Particles per cropping chunk',
+                      help='The coordinates of each tomogram are split into chunks that are cropped in parallel '
+                           'by the Dynamo threads. If set to 0, they are split evenly among the Dynamo threads.')
         form.addSection(label='Postprocess')
         form.addParam('doInvert', BooleanParam,
                       default=True,
@@ -115,17 +204,24 @@ class DynamoExtraction(DynamoProtocolBase):
                                            tsId,
                                            prerequisites=[],
                                            needsGPU=False)
-            pId = self._insertFunctionStep(self.launchDynamoExtractStep,
+            extractStep = self.nativeExtractStep if self.engine.get() == ENGINE_NATIVE \
+                else self.launchDynamoExtractStep
+            pId = self._insertFunctionStep(extractStep,
                                            tsId,
                                            prerequisites=pId,
                                            needsGPU=False)
-            if self.doInvert.get():
+            # The native engine inverts the contrast while cropping
+            if self.doInvert.get() and self.engine.get() != ENGINE_NATIVE:
                 pId = self._insertFunctionStep(self.invertContrastStep,
                                                tsId,
                                                prerequisites=pId,
                                                needsGPU=False)
+            pId = self._insertFunctionStep(self.createOutputStep,
+                                           tsId,
+                                           prerequisites=pId,
+                                           needsGPU=False)
             closeSetStepDeps.append(pId)
-        self._insertFunctionStep(self.createOutputStep,
+        self._insertFunctionStep(self.closeOutputSetStep,
                                  prerequisites=closeSetStepDeps,
                                  needsGPU=False)
 
@@ -142,6 +238,8 @@ class DynamoExtraction(DynamoProtocolBase):
         samplingRateCoord = inCoords.getSamplingRate()
         samplingRateTomo = inTomos.getFirstItem().getSamplingRate()
         self.scaleFactor = float(samplingRateCoord / samplingRateTomo)
+        # Load the coordinates of each tomogram at once, so the parallel steps do not need to query the set
+        self.coordsTsIdDict = self._loadCoordinates(inCoords, commonTomoIds)
 
     def writeSetOfCoordinates3D(self, tsId: str) -> None:
         logger.info(cyanStr(f"tsId = {tsId} - Writing the coordinates of tomogram into Dynamo format..."))
@@ -149,19 +247,29 @@ class DynamoExtraction(DynamoProtocolBase):
             makePath(self._getTomoResultsDir(tsId))
             tomoFile = self._getVllFileName(tsId)
             tomo = self.tomoTsIdDict[tsId]
-            # Write the VLL file, the coords file and the angles file as expected by Dynamo
-            with open(self._getCoordsFileName(tsId), "w") as outC, \
-                    open(self._getAnglesFileName(tsId), 'w') as outA, \
-                    open(tomoFile, 'w') as tomoFid:
+            # Write the VLL file and the coords file (binary table with the coordinates and the angles)
+            with open(tomoFile, 'w') as tomoFid:
                 tomoFid.write(f'{abspath(tomo.getFileName())}\n')
-                with self._lock:
-                    for coord in self.getInCoords().iterCoordinates(tomo):
-                        angles_coord = matrix2eulerAngles(coord.getMatrix())
-                        x = self.scaleFactor * coord.getX(BOTTOM_LEFT_CORNER)
-                        y = self.scaleFactor * coord.getY(BOTTOM_LEFT_CORNER)
-                        z = self.scaleFactor * coord.getZ(BOTTOM_LEFT_CORNER)
-                        outC.write("%.2f\t%.2f\t%.2f\t1\n" % (x, y, z))
-                        outA.write("%.2f\t%.2f\t%.2f\n" % (angles_coord[0], angles_coord[1], angles_coord[2]))
+            tomoCoords = self.coordsTsIdDict[tsId]
+            coords = self.scaleFactor * tomoCoords.positions
+            angles, _ = matrices2eulerAngles(tomoCoords.matrices)
+            # Detect the boxes out of the tomogram before cropping. The particles that will not be cropped
+            # are kept in the file, so all the tags are there, but not assigned to any chunk
+            tomoDims = tomo.getDim()
+            boxSize = self._getCropBoxSize()
+            outOfBounds = getOutOfBoundsMask(coords, boxSize, tomoDims)
+            cropped = getCroppedMask(coords, boxSize, tomoDims, pad=self._doPadding())
+            self._writeOutOfBoundsFile(tsId, outOfBounds, cropped)
+            # Particles tagged with the position of their coordinate, starting from 1, but written sorted
+            # by their position in the tomogram, so it is read almost sequentially and each chunk covers
+            # a compact region of it
+            tags = np.arange(1, len(coords) + 1)
+            order = getSpatialOrder(coords, boxSize)
+            croppedOrder = order[cropped[order]]
+            chunkTags = np.zeros(len(coords), dtype=int)
+            chunkTags[croppedOrder] = self._getChunkTags(len(croppedOrder))
+            writeBinaryTable(self._getCoordsFileName(tsId),
+                             np.column_stack((coords, chunkTags, tags, angles))[order])
         except Exception as e:
             self.failedItems.append(tsId)
             logger.error(redStr(f'tsId = {tsId} -> input conversion failed with the exception -> {e}'))
@@ -169,73 +277,135 @@ class DynamoExtraction(DynamoProtocolBase):
     def launchDynamoExtractStep(self, tsId: str):
         logger.info(cyanStr(f"tsId = {tsId} - Extracting the particles from tomogram..."))
         if tsId not in self.failedItems:
+            if self._readManifest(tsId):
+                logger.info(cyanStr(f"tsId = {tsId} - The particles were already extracted. Skipping..."))
+                return
             try:
+                self._cleanResults(tsId)
                 codeFilePath = self.writeMatlabCode(tsId)
-                args = ' %s > %s' % (codeFilePath, self._getLogFileName(tsId))
-                self.runJob(Plugin.getDynamoProgram(), args, env=Plugin.getEnviron())
+                Plugin.runDynamo(self, ' %s' % codeFilePath, logFile=self._getLogFileName(tsId))
+                self._writeManifest(tsId, inverted=False)
             except Exception as e:
                 self.failedItems.append(tsId)
                 logger.error(redStr(f'tsId = {tsId} -> Dynamo extraction failed with the exception -> {e}'))
 
+    def nativeExtractStep(self, tsId: str):
+        logger.info(cyanStr(f"tsId = {tsId} - Extracting the particles from tomogram..."))
+        if tsId not in self.failedItems:
+            if self._readManifest(tsId):
+                logger.info(cyanStr(f"tsId = {tsId} - The particles were already extracted. Skipping..."))
+                return
+            try:
+                self._cleanResults(tsId)
+                coordsData = readBinaryTable(self._getCoordsFileName(tsId))
+                # Only the particles assigned to a chunk, in the order written (see writeSetOfCoordinates3D)
+                coordsData = coordsData[coordsData[:, 3] > 0]
+                coords = coordsData[:, :3]
+                tags = coordsData[:, 4].astype(int)
+                tomoFile = self.tomoTsIdDict[tsId].getFileName()
+                cropArgs = {'nThreads': self.binThreads.get(),
+                            'pad': self._doPadding(),
+                            'invert': self.doInvert.get(),
+                            'binning': self._getDownsampling(),
+                            'binningMethod': DOWNSAMPLING_METHODS[self.downsamplingMethod.get()],
+                            'sRate': self._getOutSamplingRate()}
+                if self._useStackLayout():
+                    cropped = cropParticlesToStack(tomoFile, coords, self.boxSize.get(),
+                                                   self._getParticleStackFileName(tsId), **cropArgs)
+                    # Tags of the stacked particles, in the stack order
+                    np.savetxt(self._getParticleStackIndexFileName(tsId), tags[cropped], fmt='%i')
+                else:
+                    # Single crop dir, with the particles tagged as in the Dynamo engine
+                    cropDir = self._getCroppedParticlesDir(tsId) + '1'
+                    makePath(cropDir)
+                    outFiles = [join(cropDir, PARTICLE_FILE_PATTERN % tag) for tag in tags]
+                    cropParticles(tomoFile, coords, self.boxSize.get(), outFiles, **cropArgs)
+                self._writeManifest(tsId, inverted=self.doInvert.get())
+            except Exception as e:
+                self.failedItems.append(tsId)
+                logger.error(redStr(f'tsId = {tsId} -> Native extraction failed with the exception -> {e}'))
+
     def invertContrastStep(self, tsId: str):
         logger.info(cyanStr(f"tsId = {tsId} - Inverting the contrast of the particles extracted..."))
         if tsId not in self.failedItems:
+            # The files were just checked or written by the extraction step
+            manifest = self._readManifest(tsId, verify=False)
+            if manifest and manifest.get('inverted', False):
+                logger.info(cyanStr(f"tsId = {tsId} - The particles were already inverted. Skipping..."))
+                return
             try:
-                for subTomoFile in self._getSubtomoFileNames(tsId):
-                    # Read the subtomo file
-                    with mrcfile.mmap(subTomoFile, mode='r', permissive=True) as mrc:
-                        invertedData = -1 * mrc.data
-                    # Write the result
-                    with mrcfile.new_mmap(subTomoFile, overwrite=True, shape=invertedData.shape,
-                                          mrc_mode=2) as mrc:  # Mode 2 is float32 (see new_mmap)
-                        for i in range(len(invertedData)):
-                            mrc.data[i, :, :] = invertedData[i, :, :]
-                        mrc.update_header_from_data()
-                        mrc.voxel_size = self.getInputTomograms().getSamplingRate()
+                invertParticles(self._getSubtomoFileNames(tsId),
+                                nThreads=self.binThreads.get(),
+                                sRate=self.getInputTomograms().getSamplingRate())
+                self._writeManifest(tsId, inverted=True)
             except Exception as e:
                 self.failedItems.append(tsId)
                 logger.error(redStr(f'tsId = {tsId} -> Invert contrast failed with the exception -> {e}'))
 
-    def createOutputStep(self):
-        logger.info(cyanStr("Registering the results..."))
-        outSubtomos = self.getOutSetOfSubtomos()
-        for tsId in self.tomoTsIdDict.keys():
-            if tsId in self.failedItems:
-                continue
+    def createOutputStep(self, tsId: str):
+        logger.info(cyanStr(f"tsId = {tsId} - Registering the results..."))
+        if tsId not in self.failedItems:
             try:
                 tomo = self.tomoTsIdDict[tsId]
-                tomoFileName = tomo.getFileName()
-                sRate = tomo.getSamplingRate()
-                currentSubtomoFiles = sorted(self._getSubtomoFileNames(tsId))
-                excludedIndices = self._getDynamoExcludedPartInds(tsId)
+                tomoCoords = self.coordsTsIdDict[tsId]
+                tomoLocationsDict = self._getSubtomoLocationsDict(tsId)
+                # Particles are tagged with the position of their coordinate, starting from 1
+                tags = np.arange(1, len(tomoCoords.ids) + 1)
+                excludedIndices, paddedIndices = self._readOutOfBoundsFile(tsId)
+                notCropped = sorted(set(tags.tolist()) - tomoLocationsDict.keys() - set(excludedIndices))
+                if notCropped:
+                    logger.warning(redStr(f"tsId = {tsId} - The following particles were not cropped "
+                                          f"[{len(notCropped)}] {notCropped}"))
+                # Scale the shifts of all the matrices at once (see tomo.utils.scaleTrMatrixShifts)
+                matrices = tomoCoords.matrices.copy()
+                matrices[:, :3, 3] *= self.scaleFactor / self._getDownsampling()
+                # Subtomogram location, transformation matrix and coordinate of each cropped particle, sorted by
+                # coordinate id
+                subtomosData = [(coordId, tomoLocationsDict[tag], matrix, coordValues)
+                                for tag, coordId, matrix, coordValues in zip(tags.tolist(), tomoCoords.ids.tolist(),
+                                                                             matrices, tomoCoords.values)
+                                if tag in tomoLocationsDict]
                 if excludedIndices:
-                    logger.info(cyanStr(f"===> tsId = {tsId} - Excluded indices [{len(excludedIndices)}] by "
-                                        f"Dynamo {excludedIndices}"))
+                    logger.info(cyanStr(f"===> tsId = {tsId} - Excluded indices (box out of the tomogram) "
+                                        f"[{len(excludedIndices)}] {excludedIndices}"))
                 else:
-                    logger.info(cyanStr(f"tsId = {tsId} - No indices were excluded by Dynamo..."))
-                coordCounter = 0
-                for i, inCoord in enumerate(self.getInCoords().iterCoordinates(volume=tomo)):
-                    if i in excludedIndices:
-                        continue
-                    subtomogram = SubTomogram()
-                    transform = Transform()
-                    subtomoFile = currentSubtomoFiles[coordCounter]
-                    subtomogram.setSamplingRate(sRate)
-                    subtomogram.setFileName(subtomoFile)
-                    subtomogram.setVolName(tomoFileName)
-                    subtomogram.setCoordinate3D(inCoord)
-                    trMatrix = copy.copy(inCoord.getMatrix())
-                    transform.setMatrix(scaleTrMatrixShifts(trMatrix, self.scaleFactor))
-                    subtomogram.setTransform(transform, convention=TR_DYNAMO)
-                    outSubtomos.append(subtomogram)
-                    outSubtomos.update(subtomogram)
-                    coordCounter += 1
+                    logger.info(cyanStr(f"tsId = {tsId} - No indices were excluded..."))
+                if paddedIndices:
+                    logger.info(cyanStr(f"===> tsId = {tsId} - Padded indices (box partially out of the tomogram) "
+                                        f"[{len(paddedIndices)}] {paddedIndices}"))
+                # The same subtomogram and coordinate are filled for each particle, from the coordinates read at
+                # the beginning (see _loadCoordinates), so the set of coordinates is not read again
+                subtomogram = SubTomogram()
+                transform = Transform()
+                coordinate = tomoCoords.template.clone()
+                with self._lock:
+                    outSubtomos = self.getOutSetOfSubtomos()
+                    # The rows are inserted in batches (see bulkInsert), all of them within the same transaction,
+                    # committed when the set is written
+                    with bulkInsert(outSubtomos):
+                        for coordId, subtomoLocation, matrix, coordValues in subtomosData:
+                            self._fillCoordinate(coordinate, coordId, coordValues)
+                            subtomogram.cleanObjId()
+                            subtomogram.setSamplingRate(tomo.getSamplingRate() * self._getDownsampling())
+                            subtomogram.setLocation(subtomoLocation)
+                            subtomogram.setVolName(tomo.getFileName())
+                            subtomogram.setCoordinate3D(coordinate)
+                            transform.setMatrix(matrix)
+                            subtomogram.setTransform(transform, convention=TR_DYNAMO)
+                            outSubtomos.append(subtomogram)
+                    outSubtomos.write()
+                    self._store(outSubtomos)
+                    self.nExcludedParticles.set(self.nExcludedParticles.get() + len(excludedIndices))
+                    self.nPaddedParticles.set(self.nPaddedParticles.get() + len(paddedIndices))
+                    self._store(self.nExcludedParticles, self.nPaddedParticles)
             except Exception as e:
                 logger.error(redStr(f'tsId = {tsId} -> Unable to register the output with '
                                     f'exception {e}. Skipping... '))
-                continue
-        self._defineOutputs(**{self._possibleOutputs.subtomograms.name: outSubtomos})
-        self._defineSourceRelation(self.getInCoords(isPointer=True), outSubtomos)
+
+    def closeOutputSetStep(self):
+        if not getattr(self, self._possibleOutputs.subtomograms.name, None):
+            raise Exception(redStr('No subtomograms were extracted. Check the logs for more details.'))
+        self._closeOutputSet()
 
     # --------------------------- DEFINE utils functions ----------------------
     def getInputTomograms(self):
@@ -254,28 +424,67 @@ class DynamoExtraction(DynamoProtocolBase):
             content += "box = %i\n" % self.boxSize.get()
             content += "dcm -create '%s' -fromvll '%s'\n" % (removeExt(catalogue), self._getVllFileName(tsId))
             content += "c = dread('%s')\n" % catalogue
-            content += "coordsData = readmatrix('%s')\n" % self._getCoordsFileName(tsId)
-            content += "angles = readmatrix('%s')\n" % self._getAnglesFileName(tsId)
+            content += genMCode4ReadBinaryTable('coordsData', self._getCoordsFileName(tsId))
             content += "coords = coordsData(:,1:3)\n"
-            content += "tags = coordsData(:,4)'\n"
-            content += "parfor(tag=unique(tags), %i)\n" % self.binThreads.get()
+            content += "tags = coordsData(:,4)'\n"  # Chunk of each coordinate
+            content += "partIds = coordsData(:,5)\n"  # Position of each coordinate in the whole tomogram
+            content += "angles = coordsData(:,6:8)\n"
+            # Particles not assigned to any chunk are not cropped (see writeSetOfCoordinates3D)
+            content += "parfor(tag=unique(tags(tags > 0)), %i)\n" % self.binThreads.get()
             content += "tomoCoords = coords(tags == tag, :)\n"
             content += "tomoAngles = angles(tags == tag, :)\n"
             content += "t = dynamo_table_blank(size(tomoCoords, 1), 'r', tomoCoords, 'angles', tomoAngles)\n"
-            content += "dtcrop(c.volumes{tag}.fullFileName, t, strcat(savePath, num2str(tag)), box, 'ext', 'mrc')\n"
+            # Particles tagged with the position of their coordinate in the whole tomogram, so each particle file
+            # can be mapped to its coordinate no matter the chunk
+            content += "t(:, 1) = partIds(tags == tag)\n"
+            content += ("dtcrop(c.volumes{1}.fullFileName, t, strcat(savePath, num2str(tag)), box, 'ext', 'mrc', "
+                        "'allow_padding', %i)\n" % int(self._doPadding()))
             content += "end\n"
             codeFid.write(content)
 
         return codeFilePath
 
+    @staticmethod
+    def _loadCoordinates(inCoords, tsIds) -> Dict[str, TomoCoordinates]:
+        """Reads the ids, positions, matrices and stored values of the coordinates of the given tomograms in a single
+        pass over the set of coordinates. Dictionary of type {key = tsId, value = TomoCoordinates}"""
+        idsDict, positionsDict, matricesDict, valuesDict, templatesDict = {}, {}, {}, {}, {}
+        for coord in inCoords.iterCoordinates():
+            tsId = coord.getTomoId()
+            if tsId not in tsIds:
+                continue
+            idsDict.setdefault(tsId, []).append(coord.getObjId())
+            positionsDict.setdefault(tsId, []).append(coord.getPosition(BOTTOM_LEFT_CORNER))
+            matricesDict.setdefault(tsId, []).append(coord.getMatrix())
+            valuesDict.setdefault(tsId, []).append(DynamoExtraction._getCoordinateValues(coord))
+            if tsId not in templatesDict:
+                templatesDict[tsId] = coord.clone()
+        return {tsId: TomoCoordinates(np.array(idsDict[tsId], dtype=np.int64),
+                                      np.array(positionsDict[tsId], dtype=np.float64).reshape(-1, 3),
+                                      np.array(matricesDict[tsId], dtype=np.float64).reshape(-1, 4, 4),
+                                      templatesDict[tsId],
+                                      valuesDict[tsId])
+                for tsId in idsDict}
+
+    @staticmethod
+    def _getCoordinateValues(coord: Coordinate3D) -> tuple:
+        """Pairs (attribute name, value) of the stored attributes of a coordinate, extended ones included. The
+        nested attributes are named with dots, as in Object.getMappedDict"""
+        return tuple((attrName, attr.getObjValue()) for attrName, attr in coord.getMappedDict().items())
+
+    @staticmethod
+    def _fillCoordinate(coordinate: Coordinate3D, coordId: int, coordValues: tuple) -> None:
+        """Sets the values read with _getCoordinateValues to a coordinate with the same attributes (e.g. a copy of
+        any coordinate of the same set). A missing attribute raises an error instead of being ignored"""
+        coordinate.setObjId(coordId)
+        for attrName, value in coordValues:
+            coordinate.setAttributeValue(attrName, value, ignoreMissing=False)
+
     def _getTomoResultsDir(self, tsId: str) -> str:
         return self._getExtraPath(tsId)
 
     def _getCoordsFileName(self, tsId: str) -> str:
-        return join(self._getTomoResultsDir(tsId), 'coords.txt')
-
-    def _getAnglesFileName(self, tsId: str) -> str:
-        return join(self._getTomoResultsDir(tsId), 'angles.txt')
+        return join(self._getTomoResultsDir(tsId), COORDS_FILE)
 
     def _getVllFileName(self, tsId: str) -> str:
         return join(self._getTomoResultsDir(tsId), VLL_FILE)
@@ -289,33 +498,148 @@ class DynamoExtraction(DynamoProtocolBase):
     def _getLogFileName(self, tsId: str) -> str:
         return join(self._getTomoResultsDir(tsId), LOG_FILE_NAME)
 
+    def _getParticleStackFileName(self, tsId: str) -> str:
+        return join(self._getTomoResultsDir(tsId), PARTICLE_STACK_FILE)
+
+    def _getParticleStackIndexFileName(self, tsId: str) -> str:
+        return join(self._getTomoResultsDir(tsId), PARTICLE_STACK_INDEX_FILE)
+
+    def _getOutOfBoundsFileName(self, tsId: str) -> str:
+        return join(self._getTomoResultsDir(tsId), OUT_OF_BOUNDS_FILE)
+
+    def _getManifestFileName(self, tsId: str) -> str:
+        return join(self._getTomoResultsDir(tsId), MANIFEST_FILE)
+
+    def _getExtractionKey(self, tsId: str) -> str:
+        """Key of the inputs that determine the particles extracted from a tomogram"""
+        values = [self.tomoTsIdDict[tsId].getFileName(), self.boxSize.get(), self.engine.get(),
+                  self.outOfBoundsPolicy.get()]
+        if self.engine.get() == ENGINE_NATIVE:
+            values += [self.outputLayout.get(), self.doInvert.get(), self._getDownsampling(),
+                       self.downsamplingMethod.get()]
+        return getInputsKey([self._getCoordsFileName(tsId), self._getOutOfBoundsFileName(tsId)], values)
+
+    def _getResultFiles(self, tsId: str) -> List[str]:
+        if self._useStackLayout():
+            resultFiles = [self._getParticleStackFileName(tsId), self._getParticleStackIndexFileName(tsId)]
+            return [resultFile for resultFile in resultFiles if exists(resultFile)]
+        return self._getSubtomoFileNames(tsId)
+
+    def _writeManifest(self, tsId: str, inverted: bool) -> None:
+        """Writes the manifest of the particles extracted from a tomogram, used to skip it when the protocol is
+        continued (see _readManifest)"""
+        excludedIndices, _ = self._readOutOfBoundsFile(tsId)
+        writeManifest(self._getManifestFileName(tsId), self._getExtractionKey(tsId), self._getResultFiles(tsId),
+                      nThreads=self.binThreads.get(),
+                      excluded=excludedIndices,
+                      inverted=inverted)
+
+    def _readManifest(self, tsId: str, verify: bool = True) -> Optional[dict]:
+        """Manifest of the particles extracted from a tomogram if they were extracted with the current coordinates
+        and parameters. If verify, the files listed must also be unchanged. With the Dynamo engine, the contrast is
+        inverted in a later step (see invertContrastStep), so particles not inverted yet can be reused whether they
+        have to be inverted or not, but the inverted ones only if they have to be inverted"""
+        manifest = readManifest(self._getManifestFileName(tsId), self._getExtractionKey(tsId),
+                                nThreads=self.binThreads.get(), verifyFiles=verify)
+        if manifest and manifest.get('inverted', False) and not self.doInvert.get():
+            return None
+        return manifest
+
+    def _cleanResults(self, tsId: str) -> None:
+        """Removes the results of a previous extraction from a tomogram, if any"""
+        cleanPattern(self._getCroppedParticlesDir(tsId) + '*')
+        cleanPath(self._getParticleStackFileName(tsId),
+                  self._getParticleStackIndexFileName(tsId),
+                  self._getManifestFileName(tsId))
+
+    def _getDownsampling(self) -> int:
+        return max(self.downsampling.get(), 1) if self.engine.get() == ENGINE_NATIVE else 1
+
+    def _getCropBoxSize(self) -> int:
+        """Size of the box cropped from the tomograms, before the downsampling, if any"""
+        return self.boxSize.get() * self._getDownsampling()
+
+    def _getOutSamplingRate(self) -> float:
+        return self.getInputTomograms().getSamplingRate() * self._getDownsampling()
+
+    def _doPadding(self) -> bool:
+        return self.outOfBoundsPolicy.get() == OUT_OF_BOUNDS_PAD
+
+    def _writeOutOfBoundsFile(self, tsId: str, outOfBounds: np.ndarray, cropped: np.ndarray) -> None:
+        """Writes the tags of the particles whose box lies out of the tomogram, together with a flag indicating
+        if they will be cropped (padded) or not (excluded)"""
+        outOfBoundsTags = np.flatnonzero(outOfBounds) + 1
+        np.savetxt(self._getOutOfBoundsFileName(tsId),
+                   np.column_stack((outOfBoundsTags, cropped[outOfBounds])),
+                   fmt='%i', header='tag padded')
+
+    def _readOutOfBoundsFile(self, tsId: str) -> Tuple[List[int], List[int]]:
+        """Returns the tags of the excluded and the padded particles (see _writeOutOfBoundsFile)"""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # No particles out of the tomogram
+            data = np.loadtxt(self._getOutOfBoundsFileName(tsId), dtype=int, ndmin=2).reshape(-1, 2)
+        padded = data[:, 1].astype(bool)
+        return data[~padded, 0].tolist(), data[padded, 0].tolist()
+
+    def _useStackLayout(self) -> bool:
+        return self.engine.get() == ENGINE_NATIVE and self.outputLayout.get() == LAYOUT_STACK
+
     def getOutSetOfSubtomos(self) -> SetOfSubTomograms:
-        outSubtomos = SetOfSubTomograms.create(self._getPath(), template='submograms%s.sqlite')
-        inTomos = self.getInputTomograms()
-        finalSRate = inTomos.getSamplingRate()
-        outSubtomos.setSamplingRate(finalSRate)
-        outSubtomos.setCoordinates3D(self.getInCoords())
-        inTomosAcq = inTomos.getAcquisition()
-        if inTomosAcq:
-            outSubtomos.setAcquisition(inTomosAcq)
+        """Output set, created and defined the first time, so it grows as the tomograms are processed"""
+        outSubtomos = getattr(self, self._possibleOutputs.subtomograms.name, None)
+        if outSubtomos:
+            outSubtomos.enableAppend()
+        else:
+            outSubtomos = SetOfSubTomograms.create(self._getPath(), template='submograms%s.sqlite')
+            inTomos = self.getInputTomograms()
+            outSubtomos.setSamplingRate(self._getOutSamplingRate())
+            outSubtomos.setCoordinates3D(self.getInCoords())
+            inTomosAcq = inTomos.getAcquisition()
+            if inTomosAcq:
+                outSubtomos.setAcquisition(inTomosAcq)
+            outSubtomos.setStreamState(Set.STREAM_OPEN)
+            setattr(self, self._possibleOutputs.subtomograms.name, outSubtomos)
+            self._defineOutputs(**{self._possibleOutputs.subtomograms.name: outSubtomos})
+            self._defineSourceRelation(self.getInCoords(isPointer=True), outSubtomos)
         return outSubtomos
 
     def _getSubtomoFileNames(self, tsId: str) -> List[str]:
         return glob.glob(join(f'{self._getCroppedParticlesDir(tsId)}*', '*.mrc'))
 
-    def _getDynamoExcludedPartInds(self, tsId: str) -> List[int]:
-        indices = []
-        logFile = self._getLogFileName(tsId)
-        with open(logFile, 'r') as file:
-            for line in file:
-                if line.startswith("ATTENTION: cannot crop particle"):
-                    parts = line.strip().split()
-                    # The particle index is expected to be the last element in the line
-                    index = int(parts[-1])
-                    indices.append(index)
-        return indices
-
-        # --------------------------- DEFINE info functions ----------------------
+    def _getSubtomoLocationsDict(self, tsId: str) -> Dict[int, Tuple[int, str]]:
+        """Dictionary of type {key = particle tag, value = particle location (index, file)}. With one file per
+        particle, the tag is read from the file name generated by Dynamo (e.g. particle_00012.mrc). With one stack
+        per tomogram, the tags are read from the stack index file"""
+        if self._useStackLayout():
+            indexFile = self._getParticleStackIndexFileName(tsId)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)  # No particles cropped
+                tags = np.loadtxt(indexFile, dtype=int, ndmin=1)
+            stackFile = self._getParticleStackFileName(tsId)
+            return {int(tag): (stackInd + 1, stackFile) for stackInd, tag in enumerate(tags)}
+        return {int(PARTICLE_TAG_REGEX.search(subtomoFile).group(1)): (NO_INDEX, subtomoFile)
+                for subtomoFile in self._getSubtomoFileNames(tsId)}
+
+    def _getChunkTags(self, nParticles: int) -> np.ndarray:
+        """Chunk (from 1 on) each particle belongs to. Consecutive particles are grouped into chunks of the size
+        introduced, or into as many chunks as Dynamo threads if it is 0"""
+        chunkSize = self.chunkSize.get()
+        if not chunkSize or chunkSize <= 0:
+            chunkSize = max(int(np.ceil(nParticles / max(self.binThreads.get(), 1))), 1)
+        return np.arange(nParticles) // chunkSize + 1
+
+    # --------------------------- DEFINE info functions ----------------------
+    def _validate(self):
+        errors = []
+        if self.engine.get() == ENGINE_NATIVE:
+            tomoFile = self.getInputTomograms().getFirstItem().getFileName()
+            if splitext(tomoFile)[1].lower() not in MRC_EXTENSIONS:
+                errors.append('The native cropping engine requires the tomograms to be in MRC format (%s).'
+                              % ', '.join(MRC_EXTENSIONS))
+            if self.downsampling.get() < 1:
+                errors.append('The downsampling factor must be an integer higher than or equal to 1.')
+        return errors
+
     def _methods(self):
         methodsMsgs = []
         if self.getOutputsSize() >= 1:
@@ -335,11 +659,19 @@ class DynamoExtraction(DynamoProtocolBase):
         summary = []
         if self.isFinished():
             summary.append("Tomogram source: *%s*" % self.getEnumText("tomoSource"))
-            if self.coordsRemoved.get():
-                summary.append('*Some coordinates were removed* (This is because the box associated to those '
+            nExcluded = self.nExcludedParticles.get()
+            if nExcluded:
+                summary.append('*%i coordinates were removed* (This is because the box associated to those '
                                'coordinates partially or totally lay out of the corresponding tomogram. A good way to '
-                               'avoid this is to decrease the box size).')
+                               'avoid this is to decrease the box size or to pad them).' % nExcluded)
+            nPadded = self.nPaddedParticles.get()
+            if nPadded:
+                summary.append('*%i particles were padded* (their box partially lay out of the corresponding '
+                               'tomogram).' % nPadded)
 
+            if self._getDownsampling() > 1:
+                summary.append('*Particles downsampled by a factor of %i* (%s).'
+                               % (self._getDownsampling(), self.getEnumText('downsamplingMethod')))
             if self.doInvert:
                 summary.append('*Contrast was inverted.*')
         return summary
@@ -32,11 +32,10 @@ from pwem.emlib.image.image_readers import EmImageReader
 from pyworkflow.object import Float
 from pyworkflow.protocol.params import PointerParam, FloatParam
 from pyworkflow.utils.path import createLink, makePath
-from pwem.emlib.image import ImageHandler
 from tomo.protocols.protocol_base import ProtTomoImportFiles
 from tomo.objects import SubTomogram, SetOfSubTomograms, SetOfCoordinates3D
 from .protocol_base_dynamo import DynamoProtocolBase, IN_TOMOS
-from ..convert import dynTableLine2Subtomo
+from ..convert import dynTableLine2Subtomo, DynamoTable
 
 
 class DynImportSubtomosOuts(Enum):
@@ -119,7 +118,6 @@ class DynamoImportSubtomos(ProtTomoImportFiles, DynamoProtocolBase):
             self.tblSubtomoFilesDict[tblFile] = files2store
 
     def importSubTomogramsStep(self):
-        imgh = ImageHandler()
         samplingRate = self.sRate.get()
         coordSet = None
         subtomoSet = SetOfSubTomograms.create(self._getPath(), template='subtomograms%s.sqlite')
@@ -133,12 +131,11 @@ class DynamoImportSubtomos(ProtTomoImportFiles, DynamoProtocolBase):
             coordSet.setSamplingRate(samplingRate)
             coordSet.setBoxSize(20)
         for tblFile, tomo in self.tblTomoDict.items():
-            with open(tblFile, 'r') as fhTable:
-                lines = fhTable.readlines()
-                # The subtomograms files are generated in the same directory as the .tbl file, one for each tomogram
-                for line, fileName in zip(lines, self.tblSubtomoFilesDict[tblFile]):
-                    _, _, _, n = imgh.getDimensions(fileName)
-                    self._fillSubtomogram(line, subtomo, subtomoSet, fileName, tomo=tomo, coordSet=coordSet)
+            dynTable = DynamoTable.read(tblFile)
+            # The subtomograms files are generated in the same directory as the .tbl file, one for each tomogram
+            for row, matrix, fileName in zip(dynTable, dynTable.getMatrices(), self.tblSubtomoFilesDict[tblFile]):
+                self._fillSubtomogram(row, subtomo, subtomoSet, fileName, tomo=tomo, coordSet=coordSet,
+                                      matrix=matrix)
         # Needs to be registered before assigning it to the set of subtomograms
         self._defineOutputs(**{self._possibleOutputs.coordinates.name: coordSet})
         if tomograms:
@@ -148,11 +145,11 @@ class DynamoImportSubtomos(ProtTomoImportFiles, DynamoProtocolBase):
             self._defineSourceRelation(tomograms, subtomoSet)
 
     @staticmethod
-    def _fillSubtomogram(line, subtomo, subtomoSet, newFileName, tomo=None, coordSet=None):
+    def _fillSubtomogram(row, subtomo, subtomoSet, newFileName, tomo=None, coordSet=None, matrix=None):
         """ adds a subtomogram to a set """
         subtomo.cleanObjId()
         subtomo.setFileName(newFileName)
-        dynTableLine2Subtomo(line, subtomo, subtomoSet=subtomoSet, tomo=tomo, coordSet=coordSet)
+        dynTableLine2Subtomo(row, subtomo, subtomoSet=subtomoSet, tomo=tomo, coordSet=coordSet, matrix=matrix)
 
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
@@ -173,7 +173,7 @@ class DynamoModelWorkflow(EMProtocol, ProtTomoBase):
         commandsFile = self.writeMatlabFile(tomoId, modelName, modelFile)
         args = ' %s' % commandsFile
         try:
-            self.runJob(Plugin.getDynamoProgram(), args, env=Plugin.getEnviron())
+            Plugin.runDynamo(self, args)
         except:
             self.failedList.append(dict(zip(FAILED_MODEL_KEYS, [tomoId, modelName, modelFile])))
 
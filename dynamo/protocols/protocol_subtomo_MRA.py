@@ -39,7 +39,7 @@ from pyworkflow.protocol.params import PointerParam, BooleanParam, IntParam, Str
 from pyworkflow.utils import Message
 from pyworkflow.utils.path import makePath
 from dynamo import Plugin
-from dynamo.convert import writeSetOfVolumes, writeDynTable, dynTableLine2Subtomo
+from dynamo.convert import writeSetOfVolumes, writeDynTable, dynTableLine2Subtomo, DynamoTable
 from tomo.protocols.protocol_base import ProtTomoSubtomogramAveraging
 from tomo.objects import AverageSubTomogram, SetOfSubTomograms
 
@@ -93,6 +93,7 @@ class DynamoSubTomoMRA(DynamoProtocolBase, ProtTomoSubtomogramAveraging):
     def __init__(self, **args):
         ProtTomoSubtomogramAveraging.__init__(self, **args)
         self.dynTableDict = None
+        self.dynMatricesDict = None
         self.dimRounds = String()
         self.masksDir = None
         self.doMra = None
@@ -417,8 +418,8 @@ class DynamoSubTomoMRA(DynamoProtocolBase, ProtTomoSubtomogramAveraging):
         inputVols = self.inputVolumes.get()
         # Convert the input particles into .em if necessary
         areInEmFormat = inputVols.getFirstItem().getFileName().endswith('.em')
-        dataDirName = join(dataDir, "particle_")
-        writeSetOfVolumes(inputVols, dataDirName, 'id')
+        # Not taken from another protocol, as the particles are converted into .em in the data folder
+        self.stageSubtomos(inputVols, dataDir, fromProject=False)
 
         # Write the tbl file with the data read from the introduced particles
         fnTable = self._getExtraPath(INI_TABLE)
@@ -718,7 +719,7 @@ class DynamoSubTomoMRA(DynamoProtocolBase, ProtTomoSubtomogramAveraging):
             item._appendItem = False
         else:
             # row to subtomo
-            dynTableLine2Subtomo(row, item)
+            dynTableLine2Subtomo(row, item, matrix=self.dynMatricesDict[item.getObjId()])
 
     def prepareMask(self, maskObj):
         if maskObj:
@@ -775,12 +776,11 @@ class DynamoSubTomoMRA(DynamoProtocolBase, ProtTomoSubtomogramAveraging):
 
     def _loadDynamoTable(self):
         """Reads a Dynamo tbl file and stores it in a dictionary of type:
-        {key = objId (first number in a Dynamo table row), value = line}"""
-        tblFile = self.getResultsTblFile()
-        with open(tblFile, 'r') as dynTable:
-            self.dynTableDict = {}
-            for lineNum, line in enumerate(dynTable):
-                self.dynTableDict[int(line.split()[0])] = line
+        {key = objId (first number in a Dynamo table row), value = DynamoTable row}"""
+        dynTable = DynamoTable.read(self.getResultsTblFile())
+        tags = dynTable.getTags().tolist()
+        self.dynTableDict = dict(zip(tags, dynTable))
+        self.dynMatricesDict = dict(zip(tags, dynTable.getMatrices()))
 
     # --------------------------- INFO functions --------------------------------
     def _validate(self):
@@ -0,0 +1,104 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark of the native cropping reading the tomogram in the order of the coordinates (as they come from the
+database) versus in spatial order (see dynamo.native.getSpatialOrder). A synthetic tomogram is generated if not
+provided. The pages of the tomogram are dropped from the OS cache before each run, so the reads hit the disk.
+
+    python -m dynamo.tests.benchmark_native_cropping --dims 4096 4096 1024 --particles 5000 --box 64
+
+Note that the default 4k x 4k x 1k tomogram takes 64 GB of disk.
+"""
+import argparse
+import os
+import tempfile
+import time
+from os.path import join
+import mrcfile
+import numpy as np
+from dynamo.native import cropParticlesToStack, getSpatialOrder
+
+
+def writeSyntheticTomogram(tomoFile, dims, slabSize=32):
+    """Writes a tomogram of dims (x, y, z) filled with noise, slab by slab"""
+    nx, ny, nz = dims
+    rng = np.random.default_rng(0)
+    with mrcfile.new_mmap(tomoFile, shape=(nz, ny, nx), mrc_mode=2, overwrite=True) as mrc:
+        for z0 in range(0, nz, slabSize):
+            z1 = min(z0 + slabSize, nz)
+            mrc.data[z0:z1] = rng.standard_normal((z1 - z0, ny, nx), dtype=np.float32)
+        mrc.voxel_size = 1
+
+
+def dropFromCache(fileName):
+    with open(fileName, 'rb') as fh:
+        os.fsync(fh.fileno())
+        os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def timeCropping(tomoFile, coords, boxSize, stackFile, nThreads):
+    dropFromCache(tomoFile)
+    t0 = time.perf_counter()
+    cropParticlesToStack(tomoFile, coords, boxSize, stackFile, nThreads=nThreads)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tomo', help='MRC tomogram. A synthetic one is generated if not provided')
+    parser.add_argument('--dims', type=int, nargs=3, default=[4096, 4096, 1024],
+                        help='Dimensions (x, y, z) of the synthetic tomogram')
+    parser.add_argument('--particles', type=int, default=5000)
+    parser.add_argument('--box', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--workDir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    tomoFile = args.tomo
+    if not tomoFile:
+        tomoFile = join(args.workDir, 'syntheticTomo.mrc')
+        print('Writing a synthetic tomogram of dims %s to %s...' % (args.dims, tomoFile))
+        writeSyntheticTomogram(tomoFile, args.dims)
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        dims = np.array(mrc.data.shape[::-1])
+    # Random coordinates with the whole box inside the tomogram, in random order
+    rng = np.random.default_rng(1)
+    coords = rng.uniform(args.box, dims - args.box, size=(args.particles, 3))
+    stackFile = join(args.workDir, 'benchmarkParticles.mrc')
+    try:
+        randomTime = timeCropping(tomoFile, coords, args.box, stackFile, args.threads)
+        sortedCoords = coords[getSpatialOrder(coords, args.box)]
+        sortedTime = timeCropping(tomoFile, sortedCoords, args.box, stackFile, args.threads)
+    finally:
+        if os.path.exists(stackFile):
+            os.remove(stackFile)
+    print('Particles: %i, box: %i, tomogram: %s' % (args.particles, args.box, ' x '.join(map(str, dims))))
+    print('Input order:   %.2f s' % randomTime)
+    print('Spatial order: %.2f s (x%.2f)' % (sortedTime, randomTime / sortedTime))
+
+
+if __name__ == '__main__':
+    main()
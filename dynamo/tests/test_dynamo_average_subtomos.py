@@ -24,6 +24,10 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import mrcfile
+import numpy as np
+from dynamo.native import getSphericalMask
+from dynamo.protocols.protocol_base_dynamo import ENGINE_NATIVE
 from dynamo.protocols.protocol_extraction import SAME_AS_PICKING
 from dynamo.tests.test_dynamo_base import TestDynamoStaBase
 from pyworkflow.tests import DataSet
@@ -69,3 +73,34 @@ class TestDynamoAverageSubtomograms(TestDynamoStaBase):
                              expectedSRate=DataSetEmd10439.bin2SRate.value,
                              expectedBoxSize=self.bin2BoxSize,
                              hasHalves=False)  # Dynamo average protocol doesn't generate halves
+
+    def test_average_native(self):
+        protAvg = super().runAverageSubtomograms(self.subtomosExtracted, engine=ENGINE_NATIVE, returnProtocol=True)
+        super().checkAverage(protAvg.average,
+                             expectedSRate=DataSetEmd10439.bin2SRate.value,
+                             expectedBoxSize=self.bin2BoxSize,
+                             hasHalves=True)  # Even and odd halves generated by the native engine
+        fscs = getattr(protAvg, protAvg._possibleOutputs.fscs.name, None)
+        self.assertIsNotNone(fscs, 'The FSC between the half-maps was not generated')
+        self.assertEqual(fscs.getSize(), 1)
+
+    def test_average_native_vs_dynamo(self):
+        # The native engine must apply the transformations as daverage does with the Dynamo table (direction of
+        # the rotations and the shifts), so both averages of the same subtomograms must be almost the same
+        dynamoAvg = super().runAverageSubtomograms(self.subtomosExtracted)
+        nativeAvg = super().runAverageSubtomograms(self.subtomosExtracted, engine=ENGINE_NATIVE)
+        with mrcfile.open(dynamoAvg.getFileName(), permissive=True) as mrc:
+            dynamoData = mrc.data.astype(np.float64)
+        with mrcfile.open(nativeAvg.getFileName(), permissive=True) as mrc:
+            nativeData = mrc.data.astype(np.float64)
+        self.assertEqual(dynamoData.shape, nativeData.shape)
+        mask = np.broadcast_to(getSphericalMask(self.bin2BoxSize), dynamoData.shape)
+        correlation = np.corrcoef(dynamoData[mask], nativeData[mask])[0, 1]
+        self.assertGreater(correlation, 0.95, 'The native average does not match the one of Dynamo')
+
+    def test_average_native_wedge(self):
+        avg = super().runAverageSubtomograms(self.subtomosExtracted, engine=ENGINE_NATIVE, compensateWedge=True)
+        super().checkAverage(avg,
+                             expectedSRate=DataSetEmd10439.bin2SRate.value,
+                             expectedBoxSize=self.bin2BoxSize,
+                             hasHalves=True)
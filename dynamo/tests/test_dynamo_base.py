@@ -26,8 +26,8 @@
 from typing import Optional
 
 from dynamo.protocols import DynamoBinTomograms, DynamoProtAvgSubtomograms
-from dynamo.protocols.protocol_base_dynamo import IN_COORDS, IN_TOMOS
-from dynamo.protocols.protocol_extraction import SAME_AS_PICKING, OTHER, DynamoExtraction
+from dynamo.protocols.protocol_base_dynamo import IN_COORDS, IN_TOMOS, ENGINE_DYNAMO
+from dynamo.protocols.protocol_extraction import SAME_AS_PICKING, OTHER, DynamoExtraction, LAYOUT_FILES
 from pyworkflow.tests import setupTestProject
 from pyworkflow.utils import magentaStr
 from tomo.objects import SetOfTomograms
@@ -64,13 +64,17 @@ class TestDynamoStaBase(TestBaseCentralizedLayer):
         return tomoImported
 
     @classmethod
-    def runBinTomograms(cls, inTomos=None, binning=None):
+    def runBinTomograms(cls, inTomos=None, binning=None, engine=ENGINE_DYNAMO, nLevels=1, returnProtocol=False):
         # Bin the tomogram to make it smaller
         print(magentaStr("\n==> Tomogram binning:"))
         protBinTomos = cls.newProtocol(DynamoBinTomograms,
                                        inputTomos=inTomos,
-                                       binning=binning)
+                                       binning=binning,
+                                       engine=engine,
+                                       nLevels=nLevels)
         cls.launchProtocol(protBinTomos)
+        if returnProtocol:
+            return protBinTomos
         tomosBinned = getattr(protBinTomos, protBinTomos._possibleOutputs.tomograms.name, None)
         cls.assertIsNotNone(tomosBinned, 'No tomograms were binned.')
         return tomosBinned
@@ -90,12 +94,16 @@ class TestDynamoStaBase(TestBaseCentralizedLayer):
 
     @classmethod
     def runExtractSubtomograms(cls, inCoords=None, tomoSource=SAME_AS_PICKING, tomograms=None, boxSize=None,
+                               engine=ENGINE_DYNAMO, outputLayout=LAYOUT_FILES, downsampling=1,
                                returnProtocol=False):
         print(magentaStr("\n==> Extracting the subtomograms:"))
         protLabel = 'Extraction - same as picking'
         argsDict = {IN_COORDS: inCoords,
                     'tomoSource': tomoSource,
                     'boxSize': boxSize,
+                    'engine': engine,
+                    'outputLayout': outputLayout,
+                    'downsampling': downsampling,
                     'doInvert': True}
         if tomoSource != SAME_AS_PICKING:
             argsDict['tomoSource'] = OTHER
@@ -113,13 +121,14 @@ class TestDynamoStaBase(TestBaseCentralizedLayer):
             return subtomosExtracted
 
     @classmethod
-    def runAverageSubtomograms(cls, inSubtomos):
+    def runAverageSubtomograms(cls, inSubtomos, engine=ENGINE_DYNAMO, compensateWedge=False, returnProtocol=False):
         print(magentaStr("\n==> Averaging the subtomograms:"))
-        protAvgSubtomo = cls.newProtocol(DynamoProtAvgSubtomograms, inSubtomos=inSubtomos)
+        protAvgSubtomo = cls.newProtocol(DynamoProtAvgSubtomograms, inSubtomos=inSubtomos, engine=engine,
+                                         compensateWedge=compensateWedge)
         cls.launchProtocol(protAvgSubtomo)
         avg = getattr(protAvgSubtomo, protAvgSubtomo._possibleOutputs.average.name, None)
         cls.assertIsNotNone(avg, "There was a problem with the subtomogram averaging")
-        return avg
+        return protAvgSubtomo if returnProtocol else avg
 
 
 
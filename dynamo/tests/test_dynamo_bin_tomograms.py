@@ -24,6 +24,7 @@
 # *
 # **************************************************************************
 import numpy as np
+from dynamo.protocols.protocol_base_dynamo import ENGINE_NATIVE
 from dynamo.tests.test_dynamo_base import TestDynamoStaBase
 from pyworkflow.tests import DataSet
 from tomo.tests import RE4_STA_TUTO, DataSetRe4STATuto, TS_03, TS_54
@@ -57,3 +58,43 @@ class TestDynamoBinTomograms(TestDynamoStaBase):
                             expectedSRate=self.bin8SRate,
                             expectedDimensions=self.testDimsDict,
                             testAcqObj=self.testAcqDict)
+
+    def testBinTomogramsNative(self):
+        binnedTomograms = super().runBinTomograms(self.importedTomos, binning=self.binningFactor,
+                                                  engine=ENGINE_NATIVE)
+        # Check the results
+        self.checkTomograms(binnedTomograms,
+                            expectedSetSize=2,
+                            expectedSRate=self.bin8SRate,
+                            expectedDimensions=self.testDimsDict,
+                            testAcqObj=self.testAcqDict)
+
+    def testBinTomogramsBinning4(self):
+        # As in Dynamo, the size is reduced by 2 ** (binning - 1)
+        binning = 4
+        protBinTomos = super().runBinTomograms(self.importedTomos, binning=binning, engine=ENGINE_NATIVE,
+                                               returnProtocol=True)
+        self.assertEqual(protBinTomos.getSizeReductionFactor(), 8)
+        testAcqDict, testDimsDict = DataSetRe4STATuto.genTestTomoDicts(tsIdList=(TS_03, TS_54), binning=8)
+        self.checkTomograms(getattr(protBinTomos, protBinTomos.getOutputName(), None),
+                            expectedSetSize=2,
+                            expectedSRate=self.bin4sRate * 8,
+                            expectedDimensions=testDimsDict,
+                            testAcqObj=testAcqDict)
+
+    def testBinTomogramsPyramid(self):
+        nLevels = 2
+        protBinTomos = super().runBinTomograms(self.importedTomos, binning=self.binningFactor,
+                                               engine=ENGINE_NATIVE, nLevels=nLevels, returnProtocol=True)
+        # Check the results: one set of tomograms per binning level
+        for level in range(1, nLevels + 1):
+            levelBinning = self.binningFactor ** level
+            binnedTomograms = getattr(protBinTomos, protBinTomos.getOutputName(level), None)
+            self.assertIsNotNone(binnedTomograms, 'No tomograms were binned in level %i.' % level)
+            testAcqDict, testDimsDict = DataSetRe4STATuto.genTestTomoDicts(tsIdList=(TS_03, TS_54),
+                                                                           binning=levelBinning)
+            self.checkTomograms(binnedTomograms,
+                                expectedSetSize=2,
+                                expectedSRate=self.bin4sRate * levelBinning,
+                                expectedDimensions=testDimsDict,
+                                testAcqObj=testAcqDict)
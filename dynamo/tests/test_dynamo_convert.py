@@ -0,0 +1,266 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+import os
+import shutil
+import sqlite3
+import mrcfile
+import numpy as np
+from dynamo import STAGING_MANIFEST, PRIVATE_STAGING_MANIFEST
+from dynamo.convert import DynamoTable, DYN_TBL_COLUMNS, eulerAngles2matrix, eulerAngles2matrices, \
+    matrix2eulerAngles, matrices2eulerAngles, getVolumeFileNames
+from dynamo.utils import bulkInsert, writeManifest, readManifest, stageSetOfVolumes, \
+    getStagingKey
+from pwem.objects import Transform, Volume
+from pyworkflow.tests import BaseTest, setupTestOutput
+from tomo.objects import SetOfSubTomograms, SubTomogram
+
+
+class TestDynamoTable(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testWriteAndRead(self):
+        nParticles = 100
+        table = DynamoTable.blank(nParticles)
+        table.setAngles(np.random.uniform(-180, 180, size=(nParticles, 3)))
+        table.setShifts(np.random.uniform(-5, 5, size=(nParticles, 3)))
+        table.setCoords(np.random.uniform(0, 500, size=(nParticles, 3)))
+        tblFile = self.getOutputPath('table.tbl')
+        table.write(tblFile)
+
+        readTable = DynamoTable.read(tblFile)
+        self.assertEqual(len(readTable), nParticles)
+        self.assertEqual(readTable.getColumnNames(), tuple(DYN_TBL_COLUMNS))
+        self.assertTrue(np.array_equal(readTable.getTags(), np.arange(1, nParticles + 1)))
+        for getter in ('getAngles', 'getShifts', 'getCoords'):
+            self.assertTrue(np.allclose(getattr(readTable, getter)(), getattr(table, getter)(), atol=1e-3))
+        self.assertTrue(np.all(readTable['class'] == 1))
+
+    def testReadDynamoStandardTable(self):
+        # Tables generated by Dynamo contain 35 columns
+        tblFile = self.getOutputPath('standard.tbl')
+        with open(tblFile, 'w') as fhTable:
+            fhTable.write('7 1 1 0.5 -0.5 1 10 20 30 0 0 0 1 -60 60 0 0 0 0 3 0 2 0 11 12 13 0 0 0 0 0 0 0 0 1.35\n')
+        table = DynamoTable.read(tblFile)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(len(table.getColumnNames()), 35)
+        row = table[0]
+        self.assertEqual(int(row['tag']), 7)
+        self.assertEqual(int(row['tomo']), 3)
+        self.assertEqual(int(row['class']), 2)
+        self.assertEqual((row['ymintilt'], row['ymaxtilt']), (-60, 60))
+        self.assertTrue(np.allclose(table.getCoords(), [[11, 12, 13]]))
+        self.assertEqual(row['apix'], 1.35)
+
+
+class TestDynamoBatchedTransformations(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        nParticles = 1000
+        cls.angles = np.random.uniform(-180, 180, size=(nParticles, 3))
+        # Include the gimbal lock cases
+        cls.angles[:5, 1] = 0
+        cls.angles[5:10, 1] = 180
+        cls.shifts = np.random.uniform(-10, 10, size=(nParticles, 3))
+
+    def testEulerAngles2matrices(self):
+        matrices = eulerAngles2matrices(self.angles, self.shifts)
+        self.assertEqual(matrices.shape, (len(self.angles), 4, 4))
+        for angles, shifts, matrix in zip(self.angles, self.shifts, matrices):
+            self.assertTrue(np.allclose(matrix, eulerAngles2matrix(*angles, *shifts)))
+
+    def testMatrices2eulerAngles(self):
+        matrices = np.array([eulerAngles2matrix(*angles, *shifts) for angles, shifts in zip(self.angles, self.shifts)])
+        angles, shifts = matrices2eulerAngles(matrices)
+        for matrix, particleAngles, particleShifts in zip(matrices, angles, shifts):
+            expectedAngShifts = matrix2eulerAngles(matrix)
+            self.assertTrue(np.allclose(particleAngles, expectedAngShifts[:3]))
+            self.assertTrue(np.allclose(particleShifts, expectedAngShifts[3:]))
+        # The round trip recovers the same transformations
+        self.assertTrue(np.allclose(eulerAngles2matrices(angles, shifts), matrices))
+
+
+class TestDynamoBulkInsert(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _createSubtomos(self, sqliteFile, nParticles, batchSize=None):
+        subtomos = SetOfSubTomograms(filename=self.getOutputPath(sqliteFile))
+        subtomos.setSamplingRate(2.5)
+        subtomo = SubTomogram()
+        transform = Transform()
+
+        def _appendAll():
+            for ind in range(1, nParticles + 1):
+                subtomo.cleanObjId()
+                subtomo.setLocation(ind, 'particles.mrc')
+                transform.setMatrix(np.diag([1, 1, 1, 1]) + ind)
+                subtomo.setTransform(transform)
+                subtomos.append(subtomo)
+
+        if batchSize:
+            with bulkInsert(subtomos, batchSize=batchSize):
+                _appendAll()
+        else:
+            _appendAll()
+        subtomos.write()
+        subtomos.close()
+        return self.getOutputPath(sqliteFile)
+
+    @staticmethod
+    def _readRows(sqliteFile):
+        with sqlite3.connect(sqliteFile) as conn:
+            conn.row_factory = sqlite3.Row
+            return [{key: row[key] for key in row.keys() if key != 'creation'}
+                    for row in conn.execute('SELECT * FROM Objects ORDER BY id')]
+
+    def testBulkInsert(self):
+        nParticles = 2500
+        bulkFile = self._createSubtomos('bulk.sqlite', nParticles, batchSize=1000)
+        with sqlite3.connect(bulkFile) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM Objects').fetchone()[0], nParticles)
+        subtomos = SetOfSubTomograms(filename=bulkFile)
+        self.assertEqual(subtomos.getSize(), nParticles)
+        self.assertEqual([subtomo.getObjId() for subtomo in subtomos], list(range(1, nParticles + 1)))
+        subtomos.close()
+        # Same rows as appending one by one
+        appendFile = self._createSubtomos('append.sqlite', nParticles)
+        self.assertEqual(self._readRows(bulkFile), self._readRows(appendFile))
+
+
+class TestDynamoManifest(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeFile(self, fileName, content):
+        fileName = self.getOutputPath(fileName)
+        with open(fileName, 'wb') as fh:
+            fh.write(content)
+        return fileName
+
+    def testModificationTime(self):
+        dataFile = self._writeFile('data.bin', b'1234')
+        manifestFile = self.getOutputPath('manifest.json')
+        writeManifest(manifestFile, 'key', [dataFile], inverted=True)
+        manifest = readManifest(manifestFile, 'key')
+        self.assertTrue(manifest['inverted'])
+        self.assertIsNone(readManifest(manifestFile, 'otherKey'))
+        # Same size, but modified
+        stat = os.stat(dataFile)
+        os.utime(dataFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(readManifest(manifestFile, 'key'))
+        self.assertIsNotNone(readManifest(manifestFile, 'key', verifyFiles=False))
+
+    def testChecksums(self):
+        dataFile = self._writeFile('checked.bin', b'1234')
+        manifestFile = self.getOutputPath('checked.json')
+        writeManifest(manifestFile, 'key', [dataFile], checksums=True)
+        # The content is checked instead of the modification time
+        stat = os.stat(dataFile)
+        os.utime(dataFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNotNone(readManifest(manifestFile, 'key'))
+        self._writeFile('checked.bin', b'4321')
+        self.assertIsNone(readManifest(manifestFile, 'key'))
+
+
+class TestDynamoStaging(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        # Plain MRC files, and volumes with ids not consecutive
+        cls.volumes = []
+        for ind, volId in enumerate([3, 10, 1200]):
+            volFile = cls.getOutputPath('volume_%i.mrc' % ind)
+            with mrcfile.new(volFile, overwrite=True) as mrc:
+                mrc.set_data(np.full((4, 4, 4), ind, dtype=np.float32))
+            volume = Volume(location=volFile)
+            volume.setObjId(volId)
+            cls.volumes.append(volume)
+
+    def _getDataDir(self, runsDir, runName):
+        return self.getOutputPath(runsDir, runName, 'extra', 'data')
+
+    def _getSearchPattern(self, runsDir):
+        return self.getOutputPath(runsDir, '*', 'extra', '*', STAGING_MANIFEST)
+
+    def _checkDataDir(self, dataDir):
+        dataFiles = getVolumeFileNames(os.path.join(dataDir, 'particle_'), [3, 10, 1200])
+        self.assertEqual([os.path.basename(dataFile) for dataFile in dataFiles],
+                         ['particle_0003.mrc', 'particle_0010.mrc', 'particle_1200.mrc'])
+        for volume, dataFile in zip(self.volumes, dataFiles):
+            self.assertTrue(os.path.samefile(dataFile, volume.getFileName()))
+        return dataFiles
+
+    def testVolumeFileNames(self):
+        self.assertEqual(getVolumeFileNames('vol_', [1, 2]), ['vol_001.mrc', 'vol_002.mrc'])
+        self.assertEqual(getVolumeFileNames('vol_', [1, 12345]), ['vol_00001.mrc', 'vol_12345.mrc'])
+
+    def testStageSetOfVolumes(self):
+        dataDir = self._getDataDir('stage', 'Run1')
+        stageSetOfVolumes(self.volumes, dataDir)
+        self._checkDataDir(dataDir)
+        manifestFile = os.path.join(dataDir, STAGING_MANIFEST)
+        mtime = os.stat(manifestFile).st_mtime_ns
+        # Already staged from the same volumes
+        stageSetOfVolumes(self.volumes, dataDir)
+        self.assertEqual(os.stat(manifestFile).st_mtime_ns, mtime)
+        # Staged again if any of the volumes is missing
+        os.remove(os.path.join(dataDir, 'particle_0010.mrc'))
+        stageSetOfVolumes(self.volumes, dataDir)
+        self._checkDataDir(dataDir)
+
+    def testReuseFromProject(self):
+        dataDir1 = self._getDataDir('reuse', 'Run1')
+        dataDir2 = self._getDataDir('reuse', 'Run2')
+        stageSetOfVolumes(self.volumes, dataDir1, searchPattern=self._getSearchPattern('reuse'))
+        stageSetOfVolumes(self.volumes, dataDir2, searchPattern=self._getSearchPattern('reuse'))
+        # The files of the first run are hard linked into a folder of the second one
+        self.assertFalse(os.path.islink(dataDir2))
+        for dataFile in self._checkDataDir(dataDir2):
+            self.assertFalse(os.path.islink(dataFile))
+        # So it does not depend on the first run
+        shutil.rmtree(self.getOutputPath('reuse', 'Run1'))
+        self._checkDataDir(dataDir2)
+        self.assertIsNotNone(readManifest(os.path.join(dataDir2, STAGING_MANIFEST),
+                                          getStagingKey(self.volumes, 'particle_', 'id')))
+
+    def testNotShared(self):
+        dataDir = self._getDataDir('private', 'Run1')
+        stageSetOfVolumes(self.volumes, dataDir, shared=False)
+        self._checkDataDir(dataDir)
+        self.assertFalse(os.path.exists(os.path.join(dataDir, STAGING_MANIFEST)))
+        self.assertTrue(os.path.exists(os.path.join(dataDir, PRIVATE_STAGING_MANIFEST)))
+        # Not found by the other protocols
+        self.assertEqual(glob.glob(self._getSearchPattern('private')), [])
@@ -23,12 +23,17 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-from dynamo.protocols.protocol_extraction import OTHER, SAME_AS_PICKING
+import numpy as np
+from dynamo.protocols.protocol_extraction import OTHER, SAME_AS_PICKING, ENGINE_NATIVE, LAYOUT_STACK, \
+    DynamoExtraction
 from dynamo.tests.test_dynamo_base import TestDynamoStaBase
-from pyworkflow.tests import DataSet
+from dynamo.utils import bulkInsert
+from pyworkflow.object import String
+from pyworkflow.tests import BaseTest, DataSet, setupTestOutput
 from pyworkflow.utils import magentaStr
 from tomo.constants import TR_DYNAMO
 from tomo.protocols import ProtTomoExtractCoords, ProtImportCoordinates3D
+from tomo.objects import Coordinate3D, SetOfSubTomograms, SubTomogram
 from tomo.protocols.protocol_extract_coordinates import Output3dCoordExtraction
 from tomo.tests import EMD_10439, DataSetEmd10439
 
@@ -41,6 +46,10 @@ class TestSubtomoExtractionCombinedWithCoordExtraction(TestDynamoStaBase):
     subtomosSameAsPicking = None
     subtomosSameAsPickingExcl = None
     subtomosAnotherTomo = None
+    subtomosNative = None
+    subtomosNativeExcl = None
+    subtomosNativeStack = None
+    subtomosNativeDownsampled = None
     bin2BoxSize = None
     unbinnedBoxSize = None
     bin2SRate = None
@@ -82,6 +91,23 @@ class TestSubtomoExtractionCombinedWithCoordExtraction(TestDynamoStaBase):
                                                                  tomoSource=OTHER,
                                                                  tomograms=cls.tomoImported,
                                                                  boxSize=cls.unbinnedBoxSize)
+        cls.subtomosNative = super().runExtractSubtomograms(cls.coordsImported,
+                                                            boxSize=cls.bin2BoxSize,
+                                                            engine=ENGINE_NATIVE)
+        cls.subtomosNativeExcl = super().runExtractSubtomograms(cls.coordsImported,
+                                                                boxSize=cls.excludingBoxSize,
+                                                                engine=ENGINE_NATIVE)
+        cls.subtomosNativeStack = super().runExtractSubtomograms(cls.coordsImported,
+                                                                 boxSize=cls.excludingBoxSize,
+                                                                 engine=ENGINE_NATIVE,
+                                                                 outputLayout=LAYOUT_STACK)
+        # Extraction from the unbinned tomogram, downsampling the particles to the binned size
+        cls.subtomosNativeDownsampled = super().runExtractSubtomograms(cls.coordsImported,
+                                                                       tomoSource=OTHER,
+                                                                       tomograms=cls.tomoImported,
+                                                                       boxSize=cls.bin2BoxSize,
+                                                                       engine=ENGINE_NATIVE,
+                                                                       downsampling=DataSetEmd10439.binFactor.value)
 
     @classmethod
     def runExtract3dCoords(cls, inputSubTomos=None, inputTomos=None, boxSize=None):
@@ -124,6 +150,49 @@ class TestSubtomoExtractionCombinedWithCoordExtraction(TestDynamoStaBase):
                                        convention=TR_DYNAMO,
                                        orientedParticles=True)  # Picked with PySeg
 
+    def test_extractParticlesNativeEngine(self):
+        super().checkExtractedSubtomos(self.coordsImported,
+                                       self.subtomosNative,
+                                       expectedSetSize=self.nParticles,
+                                       expectedSRate=self.bin2SRate,
+                                       expectedBoxSize=self.bin2BoxSize,
+                                       convention=TR_DYNAMO,
+                                       orientedParticles=True)  # Picked with PySeg
+
+    def test_extractParticlesNativeEngineWithSomeExcluded(self):
+        # The same particles as with dtcrop are expected to be excluded
+        super().checkExtractedSubtomos(self.coordsImported,
+                                       self.subtomosNativeExcl,
+                                       expectedSetSize=self.nParticles - len(self.excludedParticles),
+                                       expectedSRate=self.bin2SRate,
+                                       expectedBoxSize=self.excludingBoxSize,
+                                       convention=TR_DYNAMO,
+                                       orientedParticles=True)  # Picked with PySeg
+
+    def test_extractParticlesNativeEngineToStack(self):
+        super().checkExtractedSubtomos(self.coordsImported,
+                                       self.subtomosNativeStack,
+                                       expectedSetSize=self.nParticles - len(self.excludedParticles),
+                                       expectedSRate=self.bin2SRate,
+                                       expectedBoxSize=self.excludingBoxSize,
+                                       convention=TR_DYNAMO,
+                                       orientedParticles=True)  # Picked with PySeg
+        # All the particles of the tomogram are in the same stack
+        locations = [subtomo.getLocation() for subtomo in self.subtomosNativeStack]
+        self.assertEqual(len({fileName for _, fileName in locations}), 1)
+        self.assertEqual(sorted(index for index, _ in locations), list(range(1, len(locations) + 1)))
+        # It can be averaged as the subtomograms in individual files
+        self.assertIsNotNone(super().runAverageSubtomograms(self.subtomosNativeStack))
+
+    def test_extractParticlesNativeEngineDownsampling(self):
+        super().checkExtractedSubtomos(self.coordsImported,
+                                       self.subtomosNativeDownsampled,
+                                       expectedSetSize=self.nParticles,
+                                       expectedSRate=self.bin2SRate,
+                                       expectedBoxSize=self.bin2BoxSize,
+                                       convention=TR_DYNAMO,
+                                       orientedParticles=True)  # Picked with PySeg
+
     # __________________________________________________________________________________________________________________
     # NOTE:
     # Although the coordinates extraction is not a part of the plugin emantomo, a part of its functionality
@@ -277,3 +346,52 @@ class TestDynamoExtraction(TestDynamoStaBase):
                                        expectedSRate=self.bin2SRate,
                                        convention=TR_DYNAMO,
                                        orientedParticles=False)
+
+
+class TestExtractionCoordinates(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    @staticmethod
+    def _newCoordinate(ind):
+        coord = Coordinate3D()
+        coord._x.set(ind)
+        coord._y.set(2 * ind)
+        coord._z.set(3 * ind)
+        coord.setTomoId('tomo1')
+        matrix = np.eye(4)
+        matrix[:3, 3] = [ind, 0, -ind]
+        coord.setMatrix(matrix)
+        # Extended attributes, as the ones of the coordinates of the Dynamo models (see utils.readModels)
+        coord._dynModelName = String('model_%i' % ind)
+        coord._dynModelFile = String('model_%i.omd' % ind)
+        return coord
+
+    def testExtendedAttributes(self):
+        # The subtomograms are registered with the coordinates rebuilt from the values read at the beginning
+        inCoords = [self._newCoordinate(ind) for ind in range(1, 4)]
+        template = inCoords[0].clone()
+        coordinate = template.clone()
+        subtomos = SetOfSubTomograms(filename=self.getOutputPath('subtomos.sqlite'))
+        subtomos.setSamplingRate(1)
+        subtomo = SubTomogram()
+        with bulkInsert(subtomos):
+            for inCoord in inCoords:
+                DynamoExtraction._fillCoordinate(coordinate, inCoord.getObjId(),
+                                                 DynamoExtraction._getCoordinateValues(inCoord))
+                self.assertEqual(coordinate.getObjDict(), inCoord.getObjDict())
+                subtomo.cleanObjId()
+                subtomo.setLocation(1, 'particle.mrc')
+                subtomo.setCoordinate3D(coordinate)
+                subtomos.append(subtomo)
+        subtomos.write()
+        subtomos.close()
+        subtomos = SetOfSubTomograms(filename=self.getOutputPath('subtomos.sqlite'))
+        for subtomo, inCoord in zip(subtomos, inCoords):
+            outCoord = subtomo.getCoordinate3D()
+            self.assertEqual(outCoord._dynModelName.get(), inCoord._dynModelName.get())
+            self.assertEqual(outCoord._dynModelFile.get(), inCoord._dynModelFile.get())
+            self.assertTrue(np.allclose(outCoord.getMatrix(), inCoord.getMatrix()))
+        subtomos.close()
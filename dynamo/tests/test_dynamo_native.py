@@ -0,0 +1,394 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import mrcfile
+import numpy as np
+from scipy.ndimage import map_coordinates
+from dynamo.convert import eulerAngles2matrix
+from dynamo.native import binVolume, binTomogram, binTomogramPyramid, getSafeSlabSize, FOURIER_CROP, BLOCK_AVERAGE, \
+    getBoxStarts, getOutOfBoundsMask, getCroppedMask, getSpatialOrder, cropParticles, invertParticles, \
+    cropParticlesToStack, readStackVolume, alignParticle, averageParticles, sumParticles, getSphericalMask, RunningSum, \
+    sumHalfParticles, getHalves, getFsc, getFscFrequencies, getWedgeMask, alignWedge, sumHalfParticlesFourier, \
+    getWedgeCompensatedAverage
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+
+class TestNativeCropping(BaseTest):
+    boxSize = 10
+    sRate = 2.5
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.tomoData = np.random.rand(40, 60, 50).astype(np.float32)  # Dims (x, y, z) = (50, 60, 40)
+        cls.tomoFile = cls.getOutputPath('tomo.mrc')
+        with mrcfile.new(cls.tomoFile, overwrite=True) as mrc:
+            mrc.set_data(cls.tomoData)
+            mrc.voxel_size = cls.sRate
+        # In bounds, partially out in x, partially out in the three axes, totally out
+        cls.coords = np.array([[25, 30, 20], [2, 30, 20], [49.6, 59.4, 39.5], [100, 100, 100]])
+
+    def _getOutFiles(self, prefix):
+        return [self.getOutputPath('%s_%i.mrc' % (prefix, i)) for i in range(len(self.coords))]
+
+    def testBoxStarts(self):
+        # Rounded coordinate (1-based) at voxel boxSize // 2 + 1 of the box
+        self.assertTrue(np.array_equal(getBoxStarts(self.coords[:1], self.boxSize), [[19, 24, 14]]))
+        self.assertTrue(np.array_equal(getOutOfBoundsMask(self.coords, self.boxSize, (50, 60, 40)),
+                                       [False, True, True, True]))
+        self.assertTrue(np.array_equal(getCroppedMask(self.coords, self.boxSize, (50, 60, 40)),
+                                       [True, False, False, False]))
+        self.assertTrue(np.array_equal(getCroppedMask(self.coords, self.boxSize, (50, 60, 40), pad=True),
+                                       [True, True, True, False]))
+
+    def testSpatialOrder(self):
+        coords = np.array([[5, 5, 35], [30, 2, 3], [1, 9, 4], [2, 2, 12], [1, 9, 4]])
+        # Slabs of 10 slices: [1, 2, 4] (sorted by y and x), [3], [0]. Ties keep their order
+        self.assertTrue(np.array_equal(getSpatialOrder(coords, 10), [1, 2, 4, 3, 0]))
+
+    def testCropExcludingOutOfBounds(self):
+        outFiles = self._getOutFiles('excl')
+        cropped = cropParticles(self.tomoFile, self.coords, self.boxSize, outFiles, nThreads=3)
+        self.assertTrue(np.array_equal(cropped, [True, False, False, False]))
+        with mrcfile.open(outFiles[0]) as mrc:
+            self.assertTrue(np.array_equal(mrc.data, self.tomoData[14:24, 24:34, 19:29]))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), self.sRate, places=3)
+
+    def testCropPadding(self):
+        outFiles = self._getOutFiles('pad')
+        cropped = cropParticles(self.tomoFile, self.coords, self.boxSize, outFiles, nThreads=3, pad=True)
+        self.assertTrue(np.array_equal(cropped, [True, True, True, False]))
+        with mrcfile.open(outFiles[1]) as mrc:
+            self.assertEqual(mrc.data.shape, (self.boxSize,) * 3)
+            inData = self.tomoData[14:24, 24:34, 0:6]
+            self.assertTrue(np.array_equal(mrc.data[:, :, 4:], inData))
+            self.assertTrue(np.allclose(mrc.data[:, :, :4], inData.mean()))
+
+    def testCropInverting(self):
+        outFiles = self._getOutFiles('inv')
+        cropParticles(self.tomoFile, self.coords[:1], self.boxSize, outFiles, invert=True)
+        with mrcfile.open(outFiles[0]) as mrc:
+            self.assertTrue(np.array_equal(mrc.data, -self.tomoData[14:24, 24:34, 19:29]))
+
+    def testInvertInPlace(self):
+        data = np.random.rand(self.boxSize, self.boxSize, self.boxSize).astype(np.float32)
+        intData = np.random.randint(0, 100, size=data.shape).astype(np.int16)
+        particleFiles = [self.getOutputPath('float.mrc'), self.getOutputPath('int.mrc')]
+        for particleFile, particleData in zip(particleFiles, (data, intData)):
+            with mrcfile.new(particleFile, overwrite=True) as mrc:
+                mrc.set_data(particleData)
+        invertParticles(particleFiles, nThreads=2, sRate=self.sRate)
+        for particleFile, particleData in zip(particleFiles, (data, intData)):
+            with mrcfile.open(particleFile) as mrc:
+                self.assertEqual(mrc.data.dtype, np.float32)
+                self.assertTrue(np.array_equal(mrc.data, -particleData.astype(np.float32)))
+                self.assertAlmostEqual(float(mrc.header.dmax), -float(particleData.min()), places=4)
+                self.assertAlmostEqual(float(mrc.voxel_size.x), self.sRate, places=3)
+
+    def testCropDownsampling(self):
+        outFiles = self._getOutFiles('bin')
+        cropParticles(self.tomoFile, self.coords[:1], self.boxSize // 2, outFiles, binning=2,
+                      binningMethod=BLOCK_AVERAGE)
+        with mrcfile.open(outFiles[0]) as mrc:
+            self.assertTrue(np.allclose(mrc.data, binVolume(self.tomoData[14:24, 24:34, 19:29], 2,
+                                                            method=BLOCK_AVERAGE)))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 2 * self.sRate, places=3)
+
+    def testCropToStack(self):
+        stackFile = self.getOutputPath('stack.mrc')
+        cropped = cropParticlesToStack(self.tomoFile, self.coords, self.boxSize, stackFile, nThreads=3, pad=True)
+        self.assertTrue(np.array_equal(cropped, [True, True, True, False]))
+        with mrcfile.open(stackFile) as mrc:
+            self.assertTrue(mrc.is_volume_stack())
+            self.assertEqual(mrc.data.shape, (3, self.boxSize, self.boxSize, self.boxSize))
+        padFiles = self._getOutFiles('stackPad')
+        cropParticles(self.tomoFile, self.coords, self.boxSize, padFiles, pad=True)
+        for index in range(1, 4):
+            with mrcfile.open(padFiles[index - 1]) as mrc:
+                self.assertTrue(np.array_equal(readStackVolume(stackFile, index), mrc.data))
+
+
+class TestNativeBinning(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testBlockAverage(self):
+        data = np.random.rand(8, 12, 16).astype(np.float32)
+        binned = binVolume(data, 2, method=BLOCK_AVERAGE)
+        self.assertEqual(binned.shape, (4, 6, 8))
+        self.assertAlmostEqual(float(binned[1, 2, 3]), float(data[2:4, 4:6, 6:8].mean()), places=5)
+
+    def testFourierCrop(self):
+        # A signal band-limited below the new Nyquist frequency is kept unaltered
+        size, factor = 32, 2
+        z, y, x = np.meshgrid(*[np.arange(size)] * 3, indexing='ij')
+        data = 3 + np.cos(2 * np.pi * 2 * x / size) + np.sin(2 * np.pi * 3 * (y + z) / size)
+        binned = binVolume(data, factor, method=FOURIER_CROP)
+        self.assertEqual(binned.shape, (size // factor,) * 3)
+        self.assertTrue(np.allclose(binned, data[::factor, ::factor, ::factor], atol=1e-4))
+
+    def testBinTomogram(self):
+        # Odd dims, so the last voxels are discarded, and slabs that do not cover the whole tomogram evenly
+        data = np.random.rand(23, 18, 13).astype(np.float32)
+        tomoFile, outFile = self.getOutputPath('binTomo.mrc'), self.getOutputPath('binTomo_bin2.mrc')
+        with mrcfile.new(tomoFile, overwrite=True) as mrc:
+            mrc.set_data(data)
+            mrc.voxel_size = 1.5
+        binTomogram(tomoFile, outFile, 2, slabSize=5, nThreads=3)
+        with mrcfile.open(outFile) as mrc:
+            self.assertEqual(mrc.data.shape, (11, 9, 6))
+            self.assertTrue(np.allclose(mrc.data, binVolume(data, 2, method=BLOCK_AVERAGE)))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 3, places=3)
+
+    def testBinTomogramPyramid(self):
+        data = np.random.rand(37, 20, 18).astype(np.float32)
+        tomoFile = self.getOutputPath('pyramidTomo.mrc')
+        outFiles = [self.getOutputPath('pyramidTomo_level%i.mrc' % level) for level in (1, 2, 3)]
+        with mrcfile.new(tomoFile, overwrite=True) as mrc:
+            mrc.set_data(data)
+        # Slabs of 8 slices (rounded to 2 ** 3), the last one incomplete
+        binTomogramPyramid(tomoFile, outFiles, 2, slabSize=10, nThreads=2, sRates=[2, 4, 8])
+        expected = data
+        for level, outFile in enumerate(outFiles, start=1):
+            expected = binVolume(expected, 2, method=BLOCK_AVERAGE)
+            with mrcfile.open(outFile) as mrc:
+                self.assertEqual(mrc.data.shape, tuple(size // 2 ** level for size in data.shape))
+                self.assertTrue(np.allclose(mrc.data, expected, atol=1e-6))
+                self.assertAlmostEqual(float(mrc.voxel_size.x), 2 ** level, places=3)
+
+    def testSafeSlabSize(self):
+        dims = (1000, 1000, 500)  # 4 MB per float32 slice
+        # 1 GB, half of it for 6 slabs: 20 slices, rounded to a multiple of 4
+        self.assertEqual(getSafeSlabSize(dims, 4, 6, 10 ** 9, factor=4), 20)
+        # Never below the factor nor above the tomogram size
+        self.assertEqual(getSafeSlabSize(dims, 4, 6, 10 ** 6, factor=4), 4)
+        self.assertEqual(getSafeSlabSize(dims, 4, 1, 10 ** 12, factor=4), 500)
+
+
+class TestNativeAveraging(BaseTest):
+    boxSize = 12
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.data = np.random.RandomState(0).rand(cls.boxSize, cls.boxSize, cls.boxSize)
+        cls.particleFile = cls.getOutputPath('particle.mrc')
+        with mrcfile.new(cls.particleFile, overwrite=True) as mrc:
+            mrc.set_data(cls.data.astype(np.float32))
+
+    def testAlignParticle(self):
+        self.assertTrue(np.allclose(alignParticle(self.data, np.eye(4)), self.data))
+        # The particle is moved 2 voxels in x
+        shift = np.eye(4)
+        shift[0, 3] = 2
+        self.assertTrue(np.allclose(alignParticle(self.data, shift)[:, :, 2:], self.data[:, :, :-2]))
+        # Rotation of 90 degrees around z, so the voxel x = 1 (relative to the center) goes to y = 1
+        rot = np.eye(4)
+        rot[:2, :2] = [[0, -1], [1, 0]]
+        c = self.boxSize // 2
+        self.assertAlmostEqual(alignParticle(self.data, rot)[c, c + 1, c], self.data[c, c, c + 1])
+
+    def testAverageParticles(self):
+        # Copies of the particle moved by different shifts, with the matrices that bring them back
+        shifts = [(0, 0, 0), (1, 0, 0), (0, -2, 1)]
+        fileNames, matrices = [], []
+        for ind, shift in enumerate(shifts):
+            moved = np.eye(4)
+            moved[:3, 3] = shift
+            fileName = self.getOutputPath('moved_%i.mrc' % ind)
+            with mrcfile.new(fileName, overwrite=True) as mrc:
+                mrc.set_data(alignParticle(self.data, moved).astype(np.float32))
+            back = np.eye(4)
+            back[:3, 3] = -np.asarray(shift)
+            fileNames.append(fileName)
+            matrices.append(back)
+        avg = averageParticles(fileNames, [0] * len(shifts), matrices, nWorkers=2)
+        # Compared in the region not affected by the shifts
+        self.assertTrue(np.allclose(avg[3:-3, 3:-3, 3:-3], self.data[3:-3, 3:-3, 3:-3], atol=1e-6))
+        total = sumParticles(fileNames, [0] * len(shifts), matrices, rotationMasking=True)
+        self.assertTrue(np.allclose(total, 3 * avg * getSphericalMask(self.boxSize), atol=1e-5))
+        self.assertIsNone(sumParticles([], [], np.zeros((0, 4, 4))))
+
+    def testAverageDynamoShifts(self):
+        # In a Dynamo table, the shifts (dx, dy, dz) are the displacement of the particle from the reference, so
+        # the particles with the reference moved by them are brought back by the matrix of the table row
+        shifts = [(2, 0, 0), (0, -1, 1)]
+        fileNames, matrices = [], []
+        for ind, shift in enumerate(shifts):
+            moved = np.eye(4)
+            moved[:3, 3] = shift
+            fileName = self.getOutputPath('dynamoShifted_%i.mrc' % ind)
+            with mrcfile.new(fileName, overwrite=True) as mrc:
+                mrc.set_data(alignParticle(self.data, moved).astype(np.float32))
+            fileNames.append(fileName)
+            matrices.append(eulerAngles2matrix(0, 0, 0, *shift))
+        avg = averageParticles(fileNames, [0] * len(shifts), matrices)
+        self.assertTrue(np.allclose(avg[3:-3, 3:-3, 3:-3], self.data[3:-3, 3:-3, 3:-3], atol=1e-6))
+
+    @staticmethod
+    def _getDynamoRotation(tdrot, tilt, narot):
+        """Rotation matrix of some Dynamo angles, in degrees, as in dynamo_euler2matrix: ZXZ, tdrot around z, then
+        tilt around the new x and narot around the new z"""
+        ct, st = np.cos(np.deg2rad(tdrot)), np.sin(np.deg2rad(tdrot))
+        cti, sti = np.cos(np.deg2rad(tilt)), np.sin(np.deg2rad(tilt))
+        cn, sn = np.cos(np.deg2rad(narot)), np.sin(np.deg2rad(narot))
+        return np.array([[ct * cn - st * cti * sn, -cn * st - ct * cti * sn, sn * sti],
+                         [ct * sn + cn * st * cti, ct * cn * cti - st * sn, -cn * sti],
+                         [st * sti, ct * sti, cti]])
+
+    @classmethod
+    def _moveAsDynamo(cls, template, angles, shifts):
+        """Particle described by a Dynamo table row with the given angles and shifts: the template rotated with
+        dynamo_rot, which samples it at R @ x, and then shifted, so the particle at x is the template at
+        R @ (x - shifts), being x relative to the box center and R the rotation of the angles"""
+        boxSize = template.shape[0]
+        coords = np.arange(boxSize) - boxSize // 2
+        z, y, x = np.meshgrid(coords, coords, coords, indexing='ij')
+        positions = np.stack([x.ravel(), y.ravel(), z.ravel()]) - np.asarray(shifts, dtype=np.float64)[:, None]
+        sampled = cls._getDynamoRotation(*angles) @ positions + boxSize // 2
+        return map_coordinates(template, sampled[::-1], order=3, mode='constant').reshape(template.shape)
+
+    def testAlignDynamoConvention(self):
+        # Asymmetric and smooth reference: gaussian blobs of different sizes and heights out of the center
+        boxSize = 24
+        coords = np.arange(boxSize) - boxSize // 2
+        z, y, x = np.meshgrid(coords, coords, coords, indexing='ij', sparse=True)
+        reference = np.zeros((boxSize, boxSize, boxSize))
+        for bx, by, bz, height, sigma in [(4, 0, 0, 1, 2), (0, -5, 1, 0.7, 1.5), (-2, 2, 5, 0.5, 1.8),
+                                          (1, 3, -4, 0.8, 1.2)]:
+            reference += height * np.exp(-((x - bx) ** 2 + (y - by) ** 2 + (z - bz) ** 2) / (2 * sigma ** 2))
+        mask = getSphericalMask(boxSize)
+
+        def _correlation(vol):
+            return np.corrcoef(vol[mask], reference[mask])[0, 1]
+
+        rows = [((30, 50, -70), (1.5, -1, 2)), ((-120, 100, 15), (0, 2, -1)), ((200, 25, 80), (-2, 0.5, 0))]
+        fileNames, matrices = [], []
+        for ind, (angles, shifts) in enumerate(rows):
+            matrix = eulerAngles2matrix(*angles, *shifts)
+            # The rotation of the table row, and the shift, rotated, as it is applied after the rotation
+            rotation = self._getDynamoRotation(*angles)
+            self.assertTrue(np.allclose(matrix[:3, :3], rotation))
+            self.assertTrue(np.allclose(matrix[:3, 3], -rotation @ shifts))
+            particle = self._moveAsDynamo(reference, angles, shifts)
+            self.assertGreater(_correlation(alignParticle(particle, matrix)), 0.99)
+            # Not with the inverse transformation or the shift not rotated
+            self.assertLess(_correlation(alignParticle(particle, np.linalg.inv(matrix))), 0.9)
+            unrotatedShift = matrix.copy()
+            unrotatedShift[:3, 3] = -np.asarray(shifts)
+            self.assertLess(_correlation(alignParticle(particle, unrotatedShift)), 0.9)
+            fileNames.append(self.getOutputPath('dynamoMoved_%i.mrc' % ind))
+            with mrcfile.new(fileNames[-1], overwrite=True) as mrc:
+                mrc.set_data(particle.astype(np.float32))
+            matrices.append(matrix)
+        self.assertGreater(_correlation(averageParticles(fileNames, [0] * len(rows), matrices, nWorkers=2)), 0.99)
+
+    def testSumHalfParticles(self):
+        halves = getHalves([1, 2, 3, 5])
+        self.assertEqual(halves.tolist(), [1, 0, 1, 1])
+        evenSum, oddSum = sumHalfParticles([self.particleFile] * 4, [0] * 4, [np.eye(4)] * 4, halves, nWorkers=2)
+        self.assertTrue(np.allclose(evenSum, self.data, atol=1e-6))
+        self.assertTrue(np.allclose(oddSum, 3 * self.data, atol=1e-5))
+        self.assertEqual(sumHalfParticles([self.particleFile], [0], [np.eye(4)], [1])[0], None)
+
+    def testFsc(self):
+        fsc = getFsc(self.data, self.data)
+        self.assertEqual(len(fsc), self.boxSize // 2 + 1)
+        self.assertTrue(np.allclose(fsc, 1))
+        # Scaling does not change the correlation, and the one of two independent noise volumes is low
+        self.assertTrue(np.allclose(getFsc(self.data, 2 * self.data + 1)[1:], 1))
+        noise = np.random.RandomState(1).rand(*self.data.shape)
+        self.assertLess(np.abs(getFsc(self.data - self.data.mean(), noise - noise.mean())[1:]).mean(), 0.5)
+        freqs = getFscFrequencies(self.boxSize, 2.0)
+        self.assertAlmostEqual(freqs[-1], 1 / 4)  # Nyquist
+
+    def testRunningSum(self):
+        fileName = self.getOutputPath('runningSum.npz')
+        runningSum = RunningSum(fileName)
+        self.assertEqual(len(runningSum), 0)
+        self.assertIsNone(runningSum.getAverage())
+        runningSum.add(sumHalfParticles([self.particleFile] * 2, [0] * 2, [np.eye(4)] * 2, getHalves([1, 2])), [1, 2])
+        runningSum.write()
+        # Extended after reading it again, as done in each streaming poll
+        runningSum = RunningSum(fileName)
+        self.assertEqual(runningSum.getIds(), {1, 2})
+        runningSum.add(sumHalfParticles([self.particleFile], [0], [np.eye(4)], getHalves([5])), [5])
+        runningSum.write()
+        runningSum = RunningSum(fileName)
+        self.assertEqual(runningSum.getIds(), {1, 2, 5})
+        self.assertTrue(np.allclose(runningSum.getAverage(), self.data, atol=1e-6))
+        self.assertTrue(np.allclose(runningSum.getAverage(rotationMasking=True),
+                                    self.data * getSphericalMask(self.boxSize), atol=1e-6))
+        for halfAverage in runningSum.getHalfAverages():
+            self.assertTrue(np.allclose(halfAverage, self.data, atol=1e-6))
+
+    def testWedgeMask(self):
+        c = self.boxSize // 2
+        wedge = getWedgeMask(self.boxSize, -60, 60)
+        self.assertIs(getWedgeMask(self.boxSize, -60, 60), wedge)  # Cached
+        self.assertEqual(wedge.shape, (self.boxSize,) * 3)
+        self.assertEqual(wedge.dtype, bool)
+        self.assertFalse(wedge.flags.writeable)
+        # Sampled along x and y, missing along z, the beam direction, as [z, y, x]
+        self.assertEqual(wedge[c, c + 3, c + 3], 1)
+        self.assertEqual(wedge[c + 3, c, c], 0)
+        self.assertEqual(wedge[c + 1, c, c + 3], 1)  # 18 degrees
+        self.assertEqual(wedge[c + 3, c, c + 1], 0)  # 72 degrees
+        self.assertTrue(np.all(getWedgeMask(self.boxSize, 0, 0) == 1))  # No tilt range
+        # Rotated 90 degrees around y, the missing wedge goes to x
+        rot = np.eye(4)
+        rot[0, 0], rot[0, 2], rot[2, 0], rot[2, 2] = 0, 1, -1, 0
+        aligned = alignWedge(wedge, rot)
+        self.assertAlmostEqual(aligned[c, c, c + 3], 0)
+        self.assertAlmostEqual(aligned[c + 3, c, c], 1)
+
+    def testWedgeCompensatedAverage(self):
+        # The particle as stored (float32)
+        data = self.data.astype(np.float32).astype(np.float64)
+        # Without missing wedge, the same average as in real space
+        halfSums, halfWeights = sumHalfParticlesFourier([self.particleFile] * 3, [0] * 3, [np.eye(4)] * 3,
+                                                        getHalves([1, 2, 3]), [(0, 0)] * 3, nWorkers=2)
+        self.assertTrue(np.allclose(getWedgeCompensatedAverage(halfSums[1], halfWeights[1]), data, atol=1e-9))
+        self.assertTrue(np.allclose(halfWeights[1], 2))
+        # The coefficients missing in a particle are taken from the other one
+        halfSums, halfWeights = sumHalfParticlesFourier([self.particleFile] * 2, [0] * 2, [np.eye(4)] * 2,
+                                                        [0, 0], [(-60, 60), (-10, 10)])
+        self.assertIsNone(halfSums[1])
+        avg = getWedgeCompensatedAverage(halfSums[0], halfWeights[0])
+        ft = np.fft.fftshift(np.fft.fftn(data))
+        sampled = getWedgeMask(self.boxSize, -60, 60) > 0
+        # Tolerance relative to the largest coefficient (the sum of the particle), as the rounding errors of the
+        # transforms scale with it
+        self.assertTrue(np.allclose(np.fft.fftshift(np.fft.fftn(avg))[sampled], ft[sampled],
+                                    rtol=0, atol=1e-9 * np.abs(ft).max()))
+        # And stored in the running sum
+        runningSum = RunningSum(self.getOutputPath('runningSumWedge.npz'))
+        runningSum.add(halfSums, [2, 4], halfWeights=halfWeights)
+        runningSum.write()
+        runningSum = RunningSum(self.getOutputPath('runningSumWedge.npz'))
+        self.assertTrue(runningSum.isWedgeCompensated())
+        self.assertTrue(np.allclose(runningSum.getAverage(), avg, atol=1e-5))
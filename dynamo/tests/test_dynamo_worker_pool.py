@@ -0,0 +1,164 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import sys
+import time
+from concurrent.futures import TimeoutError
+from os.path import basename, exists
+from dynamo.worker_pool import DynamoWorkerPool
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+# Local stand-in for the Dynamo console: it reads the commands sent by the pool, line by line, prints the lines of
+# the script to run and reports the exit status as Dynamo would do. A script containing 'error' fails, a script
+# containing 'crash' kills the session and a line 'wait <file>' waits until that file exists
+STAND_IN_WORKER = r'''
+import os, re, sys, time
+status = 0
+for cmd in sys.stdin:
+    cmd = cmd.strip()
+    if cmd == 'exit':
+        break
+    elif cmd.startswith('dynJobStatus = 0'):
+        status = 0
+    elif cmd.startswith('eval('):
+        os.chdir(re.search(r"cd\(''(.*?)''\)", cmd).group(1))
+        with open(re.search(r"fileread\(''(.*?)''\)", cmd).group(1)) as fScript:
+            for line in fScript:
+                if 'crash' in line:
+                    sys.exit(3)
+                if 'error' in line:
+                    status = 1
+                if line.startswith('wait '):
+                    while not os.path.exists(line.split()[1]):
+                        time.sleep(0.1)
+                print('pid %i: %s' % (os.getpid(), line.strip()), flush=True)
+    elif cmd.startswith('fprintf('):
+        tag = re.search(r"fprintf\('\\n(\S+)", cmd).group(1)
+        print('\n%s %i' % (tag, status), flush=True)
+'''
+
+
+class TestDynamoWorkerPool(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.workerFile = cls.getOutputPath('standInWorker.py')
+        with open(cls.workerFile, 'w') as fWorker:
+            fWorker.write(STAND_IN_WORKER)
+
+    def setUp(self):
+        self.pool = DynamoWorkerPool(2, [sys.executable, self.workerFile])
+
+    def tearDown(self):
+        self.pool.close()
+
+    def _writeScript(self, name, content):
+        scriptFile = self.getOutputPath(name)
+        with open(scriptFile, 'w') as fScript:
+            fScript.write(content)
+        return scriptFile
+
+    def testRunScripts(self):
+        scriptFile = self._writeScript('ok.m', "disp('hello')\n")
+        pids = set()
+        for _ in range(6):
+            result = self.pool.run(scriptFile)
+            self.assertEqual(result.status, 0)
+            self.assertIn("disp('hello')", result.log)
+            pids.add(int(result.log.split()[1].replace(':', '')))
+        # The sessions are reused, not started again for each script
+        self.assertLessEqual(len(pids), 2)
+
+    def testRelativeScriptAndCwd(self):
+        scriptFile = self._writeScript('relative.m', "disp('relative')\n")
+        result = self.pool.run(basename(scriptFile), cwd=self.getOutputPath())
+        self.assertEqual(result.status, 0)
+        self.assertIn("disp('relative')", result.log)
+
+    def testScriptNotIdentifier(self):
+        # Names that are not valid MATLAB identifiers, as the ones made from the tsIds
+        scriptFile = self._writeScript('binTomograms_TS-01.m', "disp('not identifier')\n")
+        result = self.pool.run(scriptFile)
+        self.assertEqual(result.status, 0)
+        self.assertIn("disp('not identifier')", result.log)
+
+    def testStreamedLog(self):
+        logFile = self.getOutputPath('streamed.log')
+        releaseFile = self.getOutputPath('release')
+        scriptFile = self._writeScript('streamed.m', "disp('first')\nwait %s\ndisp('last')\n" % releaseFile)
+
+        def _readLog():
+            with open(logFile) as fLog:
+                return fLog.read()
+
+        future = self.pool.submit(scriptFile, logFile=logFile)
+        # The first line is in the log file while the script is still running
+        for _ in range(300):
+            if exists(logFile) and "disp('first')" in _readLog():
+                break
+            time.sleep(0.1)
+        self.assertFalse(future.done())
+        self.assertIn("disp('first')", _readLog())
+        open(releaseFile, 'w').close()
+        result = future.result(timeout=30)
+        self.assertEqual(result.status, 0)
+        self.assertEqual(_readLog(), result.log)
+        self.assertIn("disp('last')", result.log)
+
+    def testConcurrentScripts(self):
+        scriptFiles = [self._writeScript('concurrent_%i.m' % i, "disp(%i)\n" % i) for i in range(8)]
+        futures = [self.pool.submit(scriptFile) for scriptFile in scriptFiles]
+        for i, future in enumerate(futures):
+            result = future.result()
+            self.assertEqual(result.status, 0)
+            self.assertIn('disp(%i)' % i, result.log)
+
+    def testFailingScripts(self):
+        result = self.pool.run(self._writeScript('error.m', "error('failed')\n"))
+        self.assertEqual(result.status, 1)
+        self.assertIn('failed', result.log)
+        # A crashed session reports its exit code and is restarted for the following scripts
+        result = self.pool.run(self._writeScript('crash.m', "crash\n"))
+        self.assertEqual(result.status, 3)
+        okFile = self._writeScript('afterCrash.m', "disp('ok')\n")
+        for _ in range(3):
+            self.assertEqual(self.pool.run(okFile).status, 0)
+
+    def testWorkerNotStarted(self):
+        # The Dynamo console cannot be started (e.g. wrong DYNAMO_HOME): the scripts fail instead of waiting forever
+        pool = DynamoWorkerPool(2, [self.getOutputPath('nonExistingWorker')])
+        try:
+            future = pool.submit(self._writeScript('notRun.m', "disp('not run')\n"))
+            try:
+                future.result(timeout=30)
+            except TimeoutError:
+                self.fail('The script is still waiting for a worker that could not be started')
+            except OSError:
+                pass
+            else:
+                self.fail('No error raised running a script without workers')
+        finally:
+            pool.close()
@@ -25,15 +25,28 @@
 # **************************************************************************
 import datetime
 import glob
+import hashlib
+import json
+import logging
+import os
 import pathlib
-from os.path import join, basename, abspath, exists
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os.path import join, basename, abspath, exists, dirname, relpath, getsize
+from typing import List, Optional
+import numpy as np
 from dynamo import CATALOG_FILENAME, CATALOG_BASENAME, SUFFIX_COUNT, Plugin, \
-    BASENAME_CROPPED, BASENAME_PICKED, GUI_MW_FILE
-from dynamo.convert import eulerAngles2matrix
+    BASENAME_CROPPED, BASENAME_PICKED, GUI_MW_FILE, STAGING_MANIFEST, \
+    PRIVATE_STAGING_MANIFEST
+from dynamo.convert import eulerAngles2matrices, writeSetOfVolumes
 from pyworkflow.object import String
 from tomo.constants import BOTTOM_LEFT_CORNER
 from tomo.objects import SetOfCoordinates3D, Coordinate3D, SetOfMeshes
 
+logger = logging.getLogger(__name__)
+
 
 def getPickedFile(fPath, ext='.txt'):
     return join(fPath, BASENAME_PICKED + ext)
@@ -66,6 +79,17 @@ def genMCode4ReadDynModel(modelFile):
     return "m = dread('%s')\n" % abspath(modelFile)  # Load the model created in the boxing protocol
 
 
+def _runDynamoWithFallback(prot, args):
+    """Runs a Dynamo script from the protocol or, if it fails (e.g. called from a viewer), out of it. With a pool of
+    Dynamo workers the script is not run again, as it would be sent to the same pool and fail the same way"""
+    try:
+        Plugin.runDynamo(prot, args)
+    except:
+        if Plugin.getWorkerPool():
+            raise
+        Plugin.runDynamo(None, args)
+
+
 def readModels(prot, outPath, tmpPath, modelList, savePicked=True, saveCropped=True):
     """Read the models generated for each tomograms and write the info to a the corresponding file,
     depending if there was only a picking or a picking and a mesh calculation"""
@@ -74,11 +98,7 @@ def readModels(prot, outPath, tmpPath, modelList, savePicked=True, saveCropped=T
     with open(codeFile, 'w') as codeFid:
         codeFid.write(contents)
     args = ' %s' % codeFile
-    try:
-        Plugin.runDynamo(prot, args)
-    except:
-        from pyworkflow.utils.process import runJob
-        runJob(None, Plugin.getDynamoProgram(), args, env=Plugin.getEnviron())
+    _runDynamoWithFallback(prot, args)
 
 
 def genMCode4CheckModelWfFromGUI(modelFileList, outPath):
@@ -162,23 +182,23 @@ def createSetOfOutputCoords(protPath, outPath, precedentsPointer, boxSize=20, su
 
 def dynamoCroppingResults2Scipion(outCoords, croppedFile, tomoFileDict):
     with open(croppedFile, 'r') as coordFile:
-        for line in coordFile:
-            coord = Coordinate3D()
-            values = line.replace('\n', '').split('\t')
-            tomoFile = values[9]
-            tomo = tomoFileDict[tomoFile]
-            coord.setVolume(tomo)
-            coord.setTomoId(tomo.getTsId())
-            coordinates = float(values[0]), float(values[1]), float(values[2])
-            angles = float(values[3]), float(values[4]), float(values[5])
-            coord.setPosition(*coordinates, BOTTOM_LEFT_CORNER)
-            matrix = eulerAngles2matrix(*angles, 0, 0, 0)  # There are no shifts at this point
-            coord.setMatrix(matrix)
-            coord.setGroupId(int(values[6]))
-            # Extended attributes
-            coord._dynModelName = String(values[7])
-            coord._dynModelFile = String(values[8])
-            outCoords.append(coord)
+        rows = [line.replace('\n', '').split('\t') for line in coordFile]
+    # There are no shifts at this point
+    matrices = eulerAngles2matrices([values[3:6] for values in rows])
+    for values, matrix in zip(rows, matrices):
+        coord = Coordinate3D()
+        tomoFile = values[9]
+        tomo = tomoFileDict[tomoFile]
+        coord.setVolume(tomo)
+        coord.setTomoId(tomo.getTsId())
+        coordinates = float(values[0]), float(values[1]), float(values[2])
+        coord.setPosition(*coordinates, BOTTOM_LEFT_CORNER)
+        coord.setMatrix(matrix)
+        coord.setGroupId(int(values[6]))
+        # Extended attributes
+        coord._dynModelName = String(values[7])
+        coord._dynModelFile = String(values[8])
+        outCoords.append(coord)
 
 
 def getDynamoModels(fpath):
@@ -241,11 +261,7 @@ def didUserMwInGui(prot, dynamoModels) -> bool:
     with open(mCodeFile, 'w') as codeFid:
         codeFid.write(mCode)
     args = ' %s' % mCodeFile
-    try:
-        Plugin.runDynamo(prot, args)
-    except:
-        from pyworkflow.utils.process import runJob
-        runJob(None, Plugin.getDynamoProgram(), args, env=Plugin.getEnviron())
+    _runDynamoWithFallback(prot, args)
     return exists(getFileMwFromGUI(tmpPath))
 
 
@@ -253,3 +269,195 @@ def getNewestModelModDate(modelList) -> datetime.datetime:
     """Get the last modification datetime of the newest model file"""
     tSt = sorted([pathlib.Path(fname).stat().st_mtime for fname in modelList])[-1]
     return datetime.datetime.fromtimestamp(tSt)
+
+
+def getFileChecksum(fileName: str, blockSize: int = 2 ** 20) -> str:
+    """CRC32 of a file, read by blocks"""
+    checksum = 0
+    with open(fileName, 'rb') as fh:
+        for block in iter(lambda: fh.read(blockSize), b''):
+            checksum = zlib.crc32(block, checksum)
+    return '%08x' % checksum
+
+
+def getInputsKey(files: List[str], values: list) -> str:
+    """Key that identifies the inputs of a step: the contents of a list of files and a list of values"""
+    sha = hashlib.sha1()
+    for fileName in files:
+        with open(fileName, 'rb') as fh:
+            sha.update(fh.read())
+    sha.update(json.dumps(values).encode())
+    return sha.hexdigest()
+
+
+def writeManifest(manifestFile: str, key: str, files: List[str], nThreads: int = 1, checksums: bool = False,
+                  **kwargs) -> None:
+    """Writes a manifest (json) describing the results of a step: the key of its inputs (see getInputsKey),
+    the size and modification time of the files generated, with their paths relative to the manifest location, and
+    any additional field introduced. If checksums, the checksum of each file is also computed, which requires
+    reading all of them, so the files are validated by their content instead of by their modification time (e.g.
+    if the project is copied). Otherwise, it is null."""
+    manifestDir = dirname(abspath(manifestFile))
+    if checksums:
+        with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+            checksums = list(executor.map(getFileChecksum, files))
+    else:
+        checksums = [None] * len(files)
+    manifest = {'key': key,
+                'files': {relpath(abspath(fileName), manifestDir): [getsize(fileName),
+                                                                    os.stat(fileName).st_mtime_ns,
+                                                                    checksum]
+                          for fileName, checksum in zip(files, checksums)}}
+    manifest.update(kwargs)
+    with open(manifestFile, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+
+
+def readManifest(manifestFile: str, key: str, nThreads: int = 1, verifyFiles: bool = True) -> Optional[dict]:
+    """Reads a manifest written with writeManifest. It is returned only if it was generated from the same
+    inputs (key) and, if verifyFiles, all the files listed exist with the same size and checksum or, if it was not
+    computed, modification time. None otherwise."""
+    if not exists(manifestFile):
+        return None
+    try:
+        with open(manifestFile) as fh:
+            manifest = json.load(fh)
+    except ValueError:
+        return None
+    if manifest.get('key', None) != key:
+        return None
+    if not verifyFiles:
+        return manifest
+    manifestDir = dirname(abspath(manifestFile))
+    files = [join(manifestDir, fileName) for fileName in manifest['files']]
+    if not all(exists(fileName) and getsize(fileName) == size
+               and (checksum is not None or os.stat(fileName).st_mtime_ns == mtime)
+               for fileName, (size, mtime, checksum) in zip(files, manifest['files'].values())):
+        return None
+    checkedFiles = [(fileName, checksum) for fileName, (_, _, checksum) in zip(files, manifest['files'].values())
+                    if checksum is not None]
+    with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+        checksums = list(executor.map(getFileChecksum, [fileName for fileName, _ in checkedFiles]))
+    if checksums != [checksum for _, checksum in checkedFiles]:
+        return None
+    return manifest
+
+
+def getStagingKey(setOfVolumes, fnPrefix: str, name: str) -> str:
+    """Key that identifies the content of a data folder staged from a set of volumes (see stageSetOfVolumes): the
+    naming of the files and, for each volume, its id, file, with its size and modification time, and index"""
+    fileStats = {}
+    values = [fnPrefix, name]
+    for volume in setOfVolumes:
+        fileName = abspath(volume.getFileName())
+        if fileName not in fileStats:
+            stat = os.stat(fileName)
+            fileStats[fileName] = [stat.st_size, stat.st_mtime_ns]
+        values.append([volume.getObjId(), fileName, volume.getIndex()] + fileStats[fileName])
+    return getInputsKey([], values)
+
+
+def _linkFile(fileName: str, linkName: str) -> None:
+    """Hard links a file (the one pointed if it is a symbolic link), so the link does not depend on the folder of
+    the file, or links it symbolically if it is in another file system"""
+    fileName = os.path.realpath(fileName)
+    try:
+        os.link(fileName, linkName)
+    except OSError:
+        os.symlink(fileName, linkName)
+
+
+def stageSetOfVolumes(setOfVolumes, dataDir: str, fnPrefix: str = 'particle_', name: str = 'id', nThreads: int = 1,
+                      searchPattern: Optional[str] = None, shared: bool = True) -> None:
+    """Generates a data folder with the volumes of a set, formatted along the Dynamo convention (see
+    convert.writeSetOfVolumes), and a manifest of its content. Nothing is done if the data folder was already
+    generated from the same volumes. Otherwise, if a data folder generated from them is found in a manifest matching
+    the searchPattern (e.g. the data folders of the other protocols of the project), its files are linked (see
+    _linkFile) instead of generating them again. The manifest is STAGING_MANIFEST if shared, so the data folder can
+    be found by other protocols, or PRIVATE_STAGING_MANIFEST otherwise (e.g. if its content is modified later).
+    """
+    key = getStagingKey(setOfVolumes, fnPrefix, name)
+    manifestFile = join(dataDir, STAGING_MANIFEST if shared else PRIVATE_STAGING_MANIFEST)
+    if readManifest(manifestFile, key, nThreads=nThreads):
+        return
+    for candidate in sorted(glob.glob(searchPattern)) if searchPattern else []:
+        candidateDir = os.path.realpath(dirname(candidate))
+        if candidateDir == os.path.realpath(dataDir):
+            continue
+        manifest = readManifest(candidate, key, nThreads=nThreads)
+        if manifest:
+            logger.info('Reusing the files of the data folder %s' % candidateDir)
+            shutil.rmtree(dataDir, ignore_errors=True)
+            os.makedirs(dataDir)
+            outFiles = [join(dataDir, fileName) for fileName in manifest['files']]
+            with ThreadPoolExecutor(max_workers=max(nThreads, 1)) as executor:
+                # Consume the results to raise the exceptions, if any
+                list(executor.map(_linkFile, [join(candidateDir, fileName) for fileName in manifest['files']],
+                                  outFiles))
+            writeManifest(manifestFile, key, outFiles, nThreads=nThreads)
+            return
+    shutil.rmtree(dataDir, ignore_errors=True)
+    os.makedirs(dataDir)
+    outFiles = writeSetOfVolumes(setOfVolumes, join(dataDir, fnPrefix), name, nThreads=nThreads)
+    writeManifest(manifestFile, key, outFiles, nThreads=nThreads)
+
+
+@contextmanager
+def bulkInsert(outSet, batchSize: int = 10000):
+    """Within this context, the items appended to a set are inserted into its database in batches of batchSize
+    rows, each one with a single executemany, instead of with one INSERT per item. The items are appended as usual,
+    so the ids, the size and any other attribute set by the append method of the set are the same. The first item
+    of a new set is inserted as usual too, as it creates the tables. The rows are inserted complete, so they are
+    not updated later. As any other append, they are committed when the set is written.
+    """
+    mapper = outSet._getMapper()
+    rows = []
+
+    def _flush():
+        if rows:
+            mapper.db.cursor.executemany(mapper.db.INSERT_OBJECT, rows)
+            rows.clear()
+
+    def _insertItem(item):
+        if mapper.doCreateTables or mapper.db.INSERT_OBJECT is None:
+            mapper.insert(item)
+            return
+        rows.append((item.getObjId(), item.isEnabled(), item.getObjLabel(), item.getObjComment(),
+                     *mapper._getValuesFromObject(item).values()))
+        if len(rows) >= batchSize:
+            _flush()
+
+    outSet._insertItem = _insertItem
+    try:
+        yield outSet
+        _flush()
+    finally:
+        del outSet._insertItem
+
+
+def writeBinaryTable(fileName: str, data) -> None:
+    """Writes a 2D array as a binary table to be read at once from MATLAB (see genMCode4ReadBinaryTable): a header
+    with the number of rows and columns (int32) followed by the values (float64, column-major), all little-endian.
+    Unlike the text tables, there is neither parsing nor loss of precision."""
+    data = np.asarray(data, dtype='<f8')
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    with open(fileName, 'wb') as fh:
+        np.array(data.shape, dtype='<i4').tofile(fh)
+        data.T.tofile(fh)  # Column-major, as MATLAB stores the matrices
+
+
+def readBinaryTable(fileName: str) -> np.ndarray:
+    """Reads a binary table written with writeBinaryTable"""
+    with open(fileName, 'rb') as fh:
+        nRows, nCols = np.fromfile(fh, dtype='<i4', count=2)
+        return np.fromfile(fh, dtype='<f8', count=nRows * nCols).reshape(nCols, nRows).T
+
+
+def genMCode4ReadBinaryTable(varName: str, fileName: str) -> str:
+    """MATLAB code to read a binary table written with writeBinaryTable into the variable varName"""
+    content = "fid = fopen('%s', 'r', 'ieee-le')\n" % abspath(fileName)
+    content += "tableDims = fread(fid, [1, 2], 'int32')\n"
+    content += "%s = fread(fid, tableDims, 'float64')\n" % varName
+    content += "fclose(fid)\n"
+    return content
@@ -0,0 +1,176 @@
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Pool of long-lived Dynamo sessions. Each worker keeps a Dynamo console (and so the MATLAB Compiler Runtime) open
+and runs the .m scripts it receives through a local queue, so the MCR startup is paid only once per worker.
+"""
+import logging
+import queue
+import subprocess
+import threading
+from concurrent.futures import Future
+from contextlib import nullcontext
+from os import getcwd
+from os.path import abspath, join
+from typing import List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Line printed by the worker when a script has finished, followed by its exit status
+JOB_DONE_TAG = '__DYNAMO_JOB_DONE__'
+
+
+class DynamoJobResult(NamedTuple):
+    status: int
+    log: str
+
+
+def _quote(text: str) -> str:
+    """Text quoted as a MATLAB char array"""
+    return "'%s'" % text.replace("'", "''")
+
+
+def genJobCmd(scriptFile: str, cwd: str) -> str:
+    """MATLAB commands sent to a worker console to run a script from a given directory, one simple statement per
+    line, as typed in the console. The workspace is cleared before, so the script finds it as in a new Dynamo
+    session. The script is not called with run, which requires its name to be a valid MATLAB identifier, but read
+    and evaluated, together with the change of directory, inside eval, whose catch expression sets the exit status
+    reported at the end without needing a try/catch block"""
+    jobCode = 'cd(%s); eval(fileread(%s))' % (_quote(cwd), _quote(scriptFile))
+    catchCode = 'dynJobStatus = 1; disp(lasterr)'
+    return ('clearvars\n'
+            'dynJobStatus = 0;\n'
+            'eval(%s, %s)\n'
+            "fprintf('\\n%s %%i\\n', dynJobStatus)\n") % (_quote(jobCode), _quote(catchCode), JOB_DONE_TAG)
+
+
+class DynamoWorker:
+    """Dynamo console kept open to run scripts one after another"""
+
+    def __init__(self, cmd: List[str], env: Optional[dict] = None):
+        self.cmd = cmd
+        self.env = env
+        self._process = None
+
+    def start(self):
+        self._process = subprocess.Popen(self.cmd,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT,
+                                         env=self.env,
+                                         text=True,
+                                         bufsize=1)
+
+    def isAlive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def getPid(self) -> Optional[int]:
+        return self._process.pid if self._process else None
+
+    def run(self, scriptFile: str, cwd: Optional[str] = None, logFile: Optional[str] = None) -> DynamoJobResult:
+        """Runs the script and waits for it. If logFile is provided, the output is also written to it as it is
+        received, so it can be followed while the script runs"""
+        if not self.isAlive():
+            self.start()
+        cwd = abspath(cwd if cwd else getcwd())
+        self._process.stdin.write(genJobCmd(join(cwd, scriptFile), cwd))
+        self._process.stdin.flush()
+        logLines = []
+        with open(logFile, 'w') if logFile else nullcontext() as fLog:
+            for line in self._process.stdout:
+                tagInd = line.find(JOB_DONE_TAG)
+                logLine = line[:tagInd] if tagInd >= 0 else line
+                logLines.append(logLine)
+                if fLog:
+                    fLog.write(logLine)
+                    fLog.flush()
+                if tagInd >= 0:
+                    status = int(line[tagInd:].split()[1])
+                    return DynamoJobResult(status, ''.join(logLines))
+        # The session ended while running the script. It will be started again for the next one
+        returnCode = self._process.wait()
+        self._process = None
+        logger.warning('The Dynamo worker finished unexpectedly with code %s' % returnCode)
+        return DynamoJobResult(returnCode if returnCode else 1, ''.join(logLines))
+
+    def stop(self, timeout: int = 30):
+        if self.isAlive():
+            try:
+                self._process.stdin.write('exit\n')
+                self._process.stdin.close()
+                self._process.wait(timeout=timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+        self._process = None
+
+
+class DynamoWorkerPool:
+    """N Dynamo workers consuming the scripts submitted to a shared queue"""
+
+    def __init__(self, nWorkers: int, cmd: List[str], env: Optional[dict] = None):
+        self._jobs = queue.Queue()
+        self._workers = [DynamoWorker(cmd, env=env) for _ in range(nWorkers)]
+        self._threads = [threading.Thread(target=self._serve, args=(worker,), daemon=True)
+                         for worker in self._workers]
+        for thread in self._threads:
+            thread.start()
+
+    def _serve(self, worker: DynamoWorker):
+        try:
+            worker.start()  # Warm up the session before the first script arrives
+        except Exception as e:
+            # Started again when running each script (see DynamoWorker.run), so the error reaches the caller
+            logger.warning('The Dynamo worker could not be started: %s' % e)
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                worker.stop()
+                break
+            future, scriptFile, cwd, logFile = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(worker.run(scriptFile, cwd=cwd, logFile=logFile))
+                except Exception as e:
+                    future.set_exception(e)
+
+    def getWorkers(self) -> List[DynamoWorker]:
+        return self._workers
+
+    def submit(self, scriptFile: str, cwd: Optional[str] = None, logFile: Optional[str] = None) -> Future:
+        """Queues the script to be run by the first free worker (see DynamoWorker.run)"""
+        future = Future()
+        self._jobs.put((future, scriptFile, cwd, logFile))
+        return future
+
+    def run(self, scriptFile: str, cwd: Optional[str] = None, logFile: Optional[str] = None) -> DynamoJobResult:
+        """Runs the script in the first free worker and waits for it"""
+        return self.submit(scriptFile, cwd=cwd, logFile=logFile).result()
+
+    def close(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()